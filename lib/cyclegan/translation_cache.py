@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from collections.abc import Sequence
+from functools import lru_cache
+from pathlib import Path
+from typing import Literal
+
+import torch
+
+
+@lru_cache(maxsize=8)
+def get_projection(num_features: int, device: str) -> torch.Tensor:
+    """A fixed random projection of flattened images, by which the fingerprints of images are computed."""
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(num_features, 2, generator=generator, dtype=torch.float64).to(device)
+
+
+def get_fingerprints(images: torch.Tensor) -> list[str]:
+    """
+    The content fingerprint of each image of a batch, which identifies an (augmented) image when there is
+    no sample id. It only costs a matrix-vector product on the device and the transfer of 2 numbers per image.
+    """
+    flatten = images.detach().flatten(1).double()
+    values = (flatten @ get_projection(flatten.shape[1], str(flatten.device))).tolist()
+    shape = "x".join(str(n) for n in images.shape[1:])
+    # Rounded to 12 digits, so that the fingerprints computed on different devices agree
+    return [f"{shape}_{a:.12g}_{b:.12g}" for a, b in values]
+
+
+class TranslationCache:
+    """
+    Cache of the images translated by a frozen CycleGAN.
+
+    The translations are generated under `torch.inference_mode()`, so that no graph of the generators is recorded,
+    and are kept in an in-memory LRU cache keyed by sample ids (or content fingerprints if no id is given).
+    If `cache_dir` is given, the translations are also written to and read from `cache_dir/<from_domain>/<key>.pt`,
+    which can be filled by an offline pass over a dataset, see `scripts/pretranslate_cyclegan.py`.
+
+    Note that translations can only be reused if the same input image recurs, i.e. if the training transforms
+    are deterministic. With random augmentations, the fingerprints do not match and the images are translated again,
+    so the cache is disabled by default.
+
+    Args:
+        cyclegan: The CycleGAN model with `generate_image(input_image, from_domain)`. It is set to evaluation mode.
+        capacity (int): The number of translated images kept in memory (on CPU, and moved to the device of the
+            inputs when reused). Defaults to 0, i.e. no in-memory cache.
+        cache_dir (str | Path | None): The directory of the translations on disk. Defaults to None.
+        write (bool): Whether the translations missing in `cache_dir` are written to it. Otherwise `cache_dir` is
+            only read, e.g. after an offline pass. Defaults to False.
+    """
+
+    def __init__(self, cyclegan, capacity: int = 0, cache_dir: str | Path | None = None, write: bool = False):
+        self.cyclegan = cyclegan
+        self.cyclegan.eval()
+        self.capacity = capacity
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.write = write
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def generate(self, images: torch.Tensor, from_domain: Literal["A", "B"]) -> torch.Tensor:
+        with torch.inference_mode():
+            fake_images = self.cyclegan.generate_image(input_image=images, from_domain=from_domain)
+        # Inference tensors cannot be saved for backward, so a normal copy is returned
+        return fake_images.clone()
+
+    def get_path(self, key: str, from_domain: str) -> Path:
+        return self.cache_dir / from_domain / f"{key}.pt"
+
+    def lookup(self, key: str, from_domain: str, device: torch.device) -> torch.Tensor | None:
+        if (from_domain, key) in self.cache:
+            self.cache.move_to_end((from_domain, key))
+            return self.cache[(from_domain, key)].to(device, non_blocking=True)
+        if self.cache_dir is not None and self.get_path(key, from_domain).exists():
+            fake_image = torch.load(self.get_path(key, from_domain), map_location="cpu")
+            self.store(key, from_domain, fake_image, write=False)
+            return fake_image.to(device, non_blocking=True)
+        return None
+
+    def store(self, key: str, from_domain: str, fake_image: torch.Tensor, write: bool = True) -> None:
+        # The translations are kept on CPU, so that the cache does not hold device memory
+        fake_image = fake_image.cpu()
+        if self.capacity > 0:
+            self.cache[(from_domain, key)] = fake_image
+            if len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        if write and self.write and self.cache_dir is not None:
+            self.get_path(key, from_domain).parent.mkdir(parents=True, exist_ok=True)
+            torch.save(fake_image, self.get_path(key, from_domain))
+
+    def translate(
+        self, images: torch.Tensor, from_domain: Literal["A", "B"], keys: Sequence[str] | None = None
+    ) -> torch.Tensor:
+        """
+        Translate a batch of images from the given domain, where only the images missing in the cache are generated.
+
+        Args:
+            images (torch.Tensor): Images of shape (batch, channel, spatial...).
+            from_domain (str): "A" or "B", the domain of the images.
+            keys (Sequence[str] | None): The sample ids of the images. Defaults to None, i.e. content fingerprints.
+        """
+        if self.capacity <= 0 and self.cache_dir is None:
+            return self.generate(images, from_domain)
+
+        keys = [str(key) for key in keys] if keys is not None else get_fingerprints(images)
+        fake_images = [self.lookup(key, from_domain, images.device) for key in keys]
+        missing = [i for i, fake_image in enumerate(fake_images) if fake_image is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        # Generate the missing translations as a batch
+        if missing:
+            generated = self.generate(images[missing], from_domain)
+            for i, fake_image in zip(missing, generated):
+                fake_images[i] = fake_image
+                self.store(keys[i], from_domain, fake_image)
+        return torch.stack(fake_images)
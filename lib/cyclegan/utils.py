@@ -1,6 +1,9 @@
 import dataclasses
+import threading
 from pathlib import Path
+from typing import Literal
 
+import torch
 import yaml
 
 from networks.cyclegan import CustomCycleGANModel, CycleGANModel
@@ -23,11 +26,90 @@ def get_option(opt_file_path: str):
     return opt
 
 
-def load_cyclegan(checkpoints_dir, option_filename="opt.txt", which_epoch="latest"):
+def load_cyclegan(
+    checkpoints_dir,
+    option_filename="opt.txt",
+    which_epoch="latest",
+    meta=True,
+    mmap=True,
+    freeze=True,
+    compile=False,
+):
+    """
+    Load the generators of a CycleGAN for inference.
+
+    Args:
+        checkpoints_dir: The checkpoint directory of the CycleGAN, with the option file and the weights.
+        option_filename: The option file. Defaults to "opt.txt".
+        which_epoch: The epoch of the weights. Defaults to "latest".
+        meta: Whether to build the generators on the meta device, which skips the random initialization
+            of weights that are overwritten by the checkpoint anyway. Defaults to True.
+        mmap: Whether to memory-map the checkpoint files instead of reading them at once. Defaults to True.
+        freeze: Whether to set the generators to evaluation mode without gradients. Defaults to True.
+        compile: Whether to compile the generators with `torch.compile`. Defaults to False.
+    """
     options = get_option(Path(checkpoints_dir) / option_filename)
     options.isTrain = False
     options.checkpoints_dir = Path(checkpoints_dir).parent.absolute()
+    # Run on CPU if the GPUs of the training run are not available
+    if not torch.cuda.is_available():
+        options.gpu_ids = []
     cyclegan = CycleGANModel()
-    cyclegan.initialize(options)
-    cyclegan.load_networks(which_epoch)
+    cyclegan.initialize(options, meta=meta)
+    cyclegan.load_networks(which_epoch, mmap=mmap)
+    if freeze:
+        cyclegan.freeze()
+    if compile:
+        cyclegan.netG_A = torch.compile(cyclegan.netG_A)
+        cyclegan.netG_B = torch.compile(cyclegan.netG_B)
     return cyclegan
+
+
+class LazyCycleGAN:
+    """
+    A frozen CycleGAN which is loaded by `load_cyclegan` on the first call of `generate_image`, so that modules
+    (e.g. in `test.py`) that never translate images do not pay for loading it.
+
+    Args:
+        checkpoints_dir: The checkpoint directory of the CycleGAN.
+        which_epoch: The epoch of the weights. Defaults to "latest".
+        **kwargs: The other arguments of `load_cyclegan`.
+    """
+
+    def __init__(self, checkpoints_dir, which_epoch="latest", **kwargs):
+        self.checkpoints_dir = checkpoints_dir
+        self.which_epoch = which_epoch
+        self.kwargs = kwargs
+        self.cyclegan = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.cyclegan is not None
+
+    def load(self) -> CycleGANModel:
+        with self.lock:
+            if self.cyclegan is None:
+                self.cyclegan = load_cyclegan(self.checkpoints_dir, which_epoch=self.which_epoch, **self.kwargs)
+        return self.cyclegan
+
+    def eval(self):
+        # The generators are frozen when loaded
+        return self
+
+    def generate_image(self, input_image, from_domain: Literal["A", "B"]):
+        return self.load().generate_image(input_image, from_domain)
+
+
+_shared_cyclegans: dict[tuple[str, str], LazyCycleGAN] = {}
+
+
+def get_shared_cyclegan(checkpoints_dir, which_epoch="latest", **kwargs) -> LazyCycleGAN:
+    """
+    The process-wide lazily-loaded CycleGAN of the checkpoint directory, so that several modules referencing
+    the same checkpoint share a single copy of the generators.
+    """
+    key = (str(Path(checkpoints_dir).resolve()), which_epoch)
+    if key not in _shared_cyclegans:
+        _shared_cyclegans[key] = LazyCycleGAN(checkpoints_dir, which_epoch, **kwargs)
+    return _shared_cyclegans[key]
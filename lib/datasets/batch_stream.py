@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import random
+from collections.abc import Iterable
+from typing import Literal
+
+import numpy as np
+import torch
+
+
+class BatchStream:
+    """
+    An infinite, epoch-aware stream of batches drawn from a dataloader.
+
+    Calling `next(iter(dataloader))` at every training step restarts the workers and drops the prefetched
+    batches of the dataloader. A BatchStream keeps one iterator alive instead, and only recreates it when
+    an epoch is exhausted, so that the sampler of the dataloader re-shuffles the data at epoch boundaries.
+
+    Args:
+        dataloader (Iterable): The dataloader (or any re-iterable object) to draw batches from.
+
+    The position of the stream can be saved with `state_dict()` and restored with `load_state_dict()`.
+    The RNG state used to create the iterator of the current epoch is saved along with the number of consumed
+    batches, so that the restored stream yields the same batches (in the same order) as the original one.
+
+    Examples:
+        >>> stream = BatchStream(train_dataloader)
+        >>> for step in range(max_iter):
+        ...     batch = next(stream)
+    """
+
+    def __init__(self, dataloader: Iterable):
+        self.dataloader = dataloader
+        self.epoch = 0
+        self.position = 0
+        self.epoch_rng_state = None
+        self.iterator = None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            self.iterator = self.new_epoch()
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.epoch += 1
+            self.iterator = self.new_epoch()
+            try:
+                batch = next(self.iterator)
+            except StopIteration as e:
+                raise ValueError("The dataloader of BatchStream yields no batch.") from e
+        self.position += 1
+        return batch
+
+    def new_epoch(self):
+        # Samplers like DistributedSampler need to be informed of the epoch to re-shuffle
+        sampler = getattr(self.dataloader, "sampler", None)
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(self.epoch)
+        # Shuffling and worker seeds are drawn from the global torch RNG when the iterator is created
+        self.position = 0
+        self.epoch_rng_state = torch.get_rng_state()
+        return iter(self.dataloader)
+
+    def state_dict(self) -> dict:
+        return {"epoch": self.epoch, "position": self.position, "epoch_rng_state": self.epoch_rng_state}
+
+    def load_state_dict(self, state_dict: dict):
+        """Restore the stream by recreating the iterator of the saved epoch and skipping the consumed batches."""
+        self.epoch = state_dict["epoch"]
+        self.iterator = None
+        self.position = 0
+        if state_dict["epoch_rng_state"] is None:
+            return
+
+        # Samplers of single-process dataloaders draw their seeds lazily, so the batches are skipped under the same RNG
+        rng_state = torch.get_rng_state()
+        torch.set_rng_state(state_dict["epoch_rng_state"])
+        self.iterator = self.new_epoch()
+        for _ in range(state_dict["position"]):
+            next(self.iterator)
+        self.position = state_dict["position"]
+        torch.set_rng_state(rng_state)
+
+
+def get_batch(ct_dataloader, mr_dataloader, mode: Literal["sequential", "random_swap", "random_choice"]):
+    """
+    Draw a pair of batches from CT and MR data based on the sampling mode.
+
+    `ct_dataloader` and `mr_dataloader` are expected to be BatchStreams, whose iterators stay alive between steps.
+    Plain dataloaders are also accepted, but a new iterator is then created for every batch.
+    """
+    if mode == "sequential":
+        batch1 = next(iter(ct_dataloader))
+        batch2 = next(iter(mr_dataloader))
+    elif mode == "random_swap":
+        batch1 = next(iter(ct_dataloader))
+        batch2 = next(iter(mr_dataloader))
+        if random.random() > 0.5:
+            batch1, batch2 = batch2, batch1
+    elif mode == "random_choice":
+        batch1 = next(iter(ct_dataloader)) if np.random.random(1) < 0.5 else next(iter(mr_dataloader))
+        batch2 = next(iter(ct_dataloader)) if np.random.random(1) < 0.5 else next(iter(mr_dataloader))
+    else:
+        raise ValueError("Invalid mode.")
+    return batch1, batch2
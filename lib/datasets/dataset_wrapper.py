@@ -8,6 +8,8 @@ from jsonargparse.typing import Path_drw
 from monai.data import DataLoader
 from monai.data import Dataset as MonaiDataset
 
+from .slice_cache import CachedTransform
+
 
 class Dataset(ABC):
     """
@@ -26,8 +28,11 @@ class Dataset(ABC):
         cache_rate (float): The rate at which data should be cached.
         num_workers (int): Number of worker processes for data loading.
         train_batch_size (int): Batch size for training data.
+        val_batch_size (int): Batch size for validation and testing data.
         return_datasets (bool): Whether to return the datasets or data loaders.
         dev (bool): Flag indicating whether the code is in development mode.
+        slice_cache_dir (Optional[str]): The directory of the on-disk cache of the deterministic prefix of the
+            transforms (see `CachedTransform`), shared across runs and workers. Defaults to None, i.e. no cache.
 
     Returns:
         If 'return_datasets' is True, returns a tuple of train, validation, and test datasets.
@@ -47,9 +52,11 @@ class Dataset(ABC):
         cache_rate: float = 0.1,
         num_workers: int = 2,
         train_batch_size: int = 1,
+        val_batch_size: int = 1,
         return_dataloader: bool = True,
         dev: bool = False,
         random_seed: int = 42,
+        slice_cache_dir: str | None = None,
     ):
         self.in_use = in_use
 
@@ -64,10 +71,18 @@ class Dataset(ABC):
             self.cache_rate = cache_rate
             self.num_workers = num_workers
             self.train_batch_size = train_batch_size
+            self.val_batch_size = val_batch_size
             self.return_dataloader = return_dataloader
             self.dev = dev
             self.random_seed = random_seed
 
+            # Load, preprocess and store each sample once, then memory-map it in later epochs and runs
+            if slice_cache_dir is not None:
+                if self.train_transform is not None:
+                    self.train_transform = CachedTransform(self.train_transform, slice_cache_dir)
+                if self.test_transform is not None:
+                    self.test_transform = CachedTransform(self.test_transform, slice_cache_dir)
+
             if not (0 <= holdout_ratio <= 1):
                 raise ValueError(f"The value of holdout_ratio is expected to be between 0 and 1, get {holdout_ratio}.")
             if 0 not in train_background_classes:
@@ -87,8 +102,8 @@ class Dataset(ABC):
         if self.return_dataloader:
             return (
                 DataLoader(self.train_dataset, batch_size=self.train_batch_size, shuffle=~self.dev, drop_last=True),
-                DataLoader(self.val_dataset, batch_size=1, shuffle=False),
-                DataLoader(self.test_dataset, batch_size=1, shuffle=False),
+                DataLoader(self.val_dataset, batch_size=self.val_batch_size, shuffle=False),
+                DataLoader(self.test_dataset, batch_size=self.val_batch_size, shuffle=False),
             )
         else:
             return self.train_dataset, self.val_dataset, self.test_dataset
@@ -1,15 +1,97 @@
 from __future__ import annotations
 
-from collections.abc import Sequence
+from collections.abc import Callable, Sequence
+from functools import lru_cache
 
 import numpy as np
 import torch
 from monai.transforms import AsDiscrete, Compose
+from monai.utils import convert_to_tensor
 
 from medaset.transforms import BackgroundifyClasses
 
 
-def discretize_and_backgroundify_preds(samples: Sequence, num_classes: int, background: Sequence = (0,)) -> list:
+def as_background_tuple(background: Sequence) -> tuple:
+    if isinstance(background, (np.ndarray, torch.Tensor)):
+        background = background.tolist()
+    if isinstance(background, list):
+        background = tuple(background)
+    assert isinstance(background, tuple)
+    return tuple(int(c) for c in background)
+
+
+@lru_cache(maxsize=None)
+def get_postprocess_transform(num_classes: int, background: tuple = (0,), argmax: bool = False) -> Callable:
+    """
+    The composed per-sample transform of discretization and backgroundification.
+    It is cached for each (num_classes, background, argmax), so that it is built only once.
+    """
+    discretize = AsDiscrete(argmax=argmax, to_onehot=num_classes)
+    if background != (0,):
+        return Compose([discretize, BackgroundifyClasses(channel_dim=0, classes=list(background))])
+    else:
+        return discretize
+
+
+@lru_cache(maxsize=None)
+def get_background_lut(num_classes: int, background: tuple, device: str) -> torch.Tensor:
+    """A lookup table mapping every class to itself, except for the background classes which are mapped to 0."""
+    lut = torch.arange(num_classes, device=device)
+    lut[list(background)] = 0
+    return lut
+
+
+def backgroundify_labels(
+    labels: torch.Tensor, num_classes: int, background: Sequence = (0,), one_hot: bool = True
+) -> torch.Tensor:
+    """
+    Merge the background classes of a batch of label maps into class 0 and one-hot encode them if needed.
+
+    Args:
+        labels (torch.Tensor): Label maps of shape (batch, 1, spatial...).
+        num_classes (int): The number of classes for one-hot encoding.
+        background (Sequence): The background classes. Defaults to (0,).
+        one_hot (bool): If False, the label maps are returned instead of the dense one-hot tensors.
+
+    Returns:
+        torch.Tensor: One-hot tensors of shape (batch, num_classes, spatial...), or label maps of shape
+        (batch, 1, spatial...) if one_hot is False.
+    """
+    background = as_background_tuple(background)
+    labels = convert_to_tensor(labels, track_meta=False).long()
+    if background != (0,):
+        labels = get_background_lut(num_classes, background, str(labels.device))[labels]
+    if not one_hot:
+        return labels
+    classes = torch.arange(num_classes, device=labels.device).view(1, -1, *([1] * (labels.ndim - 2)))
+    return (labels == classes).float()
+
+
+def discretize_and_backgroundify_batch_preds(
+    logits: torch.Tensor, num_classes: int, background: Sequence = (0,), one_hot: bool = True
+) -> torch.Tensor:
+    """
+    Argmax and one-hot-encoded a batch of prediction logits of shape (batch, channel, spatial...) at once.
+    Masked the background class if needed. See `backgroundify_labels` for the arguments.
+    """
+    # Reducing over the last (contiguous) dimension is much faster than over the channel dimension
+    logits = convert_to_tensor(logits, track_meta=False).movedim(1, -1).contiguous()
+    return backgroundify_labels(torch.argmax(logits, dim=-1).unsqueeze(1), num_classes, background, one_hot)
+
+
+def discretize_and_backgroundify_batch_masks(
+    masks: torch.Tensor, num_classes: int, background: Sequence = (0,), one_hot: bool = True
+) -> torch.Tensor:
+    """
+    One-hot-encoded a batch of ground truth masks of shape (batch, 1, spatial...) at once.
+    Masked the background class if needed. See `backgroundify_labels` for the arguments.
+    """
+    return backgroundify_labels(masks, num_classes, background, one_hot)
+
+
+def discretize_and_backgroundify_preds(
+    samples: Sequence, num_classes: int, background: Sequence = (0,), one_hot: bool = True
+) -> list:
     """
     Argmax and one-hot-encoded the given prediction logits. Masked the background class if needed.
 
@@ -17,29 +99,26 @@ def discretize_and_backgroundify_preds(samples: Sequence, num_classes: int, back
         samples (Sequence): The input samples containing predictions and ground truth masks.
         num_classes (int): The number of classes for one-hot encoding.
         background (Sequence): The background classes to be considered during postprocessing. Defaults to (0,).
+        one_hot (bool): If False, label maps are returned instead. Defaults to True.
 
     Returns:
         List[torch.Tensor]: Processed predictions.
     """
-    if isinstance(background, (np.ndarray, torch.Tensor)):
-        background = background.tolist()
-    if isinstance(background, tuple):
-        background = list(background)
-    assert isinstance(background, list)
-
-    if background != [0]:
-        postprocess_pred = Compose(
-            AsDiscrete(argmax=True, to_onehot=num_classes),
-            BackgroundifyClasses(channel_dim=0, classes=background),
-        )
-    else:
-        postprocess_pred = AsDiscrete(argmax=True, to_onehot=num_classes)
+    background = as_background_tuple(background)
+    preds = [sample["prediction"] for sample in samples]
+    if len(preds) > 0 and all(p.shape == preds[0].shape for p in preds):
+        return list(discretize_and_backgroundify_batch_preds(torch.stack(preds), num_classes, background, one_hot))
 
-    preds = [postprocess_pred(sample["prediction"]) for sample in samples]
-    return preds
+    # Samples of different shapes are processed one by one
+    if not one_hot:
+        return [discretize_and_backgroundify_batch_preds(p[None], num_classes, background, one_hot)[0] for p in preds]
+    postprocess_pred = get_postprocess_transform(num_classes, background, argmax=True)
+    return [postprocess_pred(p) for p in preds]
 
 
-def discretize_and_backgroundify_masks(samples: Sequence, num_classes: int, background: Sequence = (0,)) -> list:
+def discretize_and_backgroundify_masks(
+    samples: Sequence, num_classes: int, background: Sequence = (0,), one_hot: bool = True
+) -> list:
     """
     One-hot-encoded the given ground truth masks. Masked the background class if needed.
 
@@ -47,23 +126,18 @@ def discretize_and_backgroundify_masks(samples: Sequence, num_classes: int, back
         samples (Sequence): The input samples containing predictions and ground truth masks.
         num_classes (int): The number of classes for one-hot encoding.
         background (Sequence): The background classes to be considered during postprocessing. Defaults to (0,).
+        one_hot (bool): If False, label maps are returned instead. Defaults to True.
 
     Returns:
         List[torch.Tensor]: Processed masks.
     """
-    if isinstance(background, (np.ndarray, torch.Tensor)):
-        background = background.tolist()
-    if isinstance(background, tuple):
-        background = list(background)
-    assert isinstance(background, list)
-
-    if background != [0]:
-        postprocess_mask = Compose(
-            AsDiscrete(to_onehot=num_classes),
-            BackgroundifyClasses(channel_dim=0, classes=background),
-        )
-    else:
-        postprocess_mask = AsDiscrete(to_onehot=num_classes)
+    background = as_background_tuple(background)
+    masks = [sample["ground_truth"] for sample in samples]
+    if len(masks) > 0 and all(m.shape == masks[0].shape for m in masks):
+        return list(discretize_and_backgroundify_batch_masks(torch.stack(masks), num_classes, background, one_hot))
 
-    masks = [postprocess_mask(sample["ground_truth"]) for sample in samples]
-    return masks
+    # Samples of different shapes are processed one by one
+    if not one_hot:
+        return [discretize_and_backgroundify_batch_masks(m[None], num_classes, background, one_hot)[0] for m in masks]
+    postprocess_mask = get_postprocess_transform(num_classes, background, argmax=False)
+    return [postprocess_mask(m) for m in masks]
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import hashlib
+import inspect
+import json
+import os
+from collections.abc import Callable, Sequence
+from pathlib import Path
+
+import numpy as np
+import torch
+from monai.data import MetaTensor
+from monai.transforms import Compose, Randomizable, Transform
+
+# Bump to invalidate the caches written by former versions of the storage format
+CACHE_VERSION = 1
+
+
+def split_deterministic_prefix(transform: Callable) -> tuple[list[Callable], list[Callable]]:
+    """
+    Split a transform chain into its deterministic prefix and the rest, which starts at the first random transform.
+
+    The chain is either a `Compose`, or a transform wrapping a `Compose` as its `transform` attribute
+    (e.g. `CtTransform` of `smat_default_transform`).
+    """
+    compose = transform if isinstance(transform, Compose) else getattr(transform, "transform", None)
+    if not isinstance(compose, Compose):
+        raise ValueError(f"Expected a Compose or a transform wrapping a Compose, got {transform.__class__.__name__}.")
+    transforms = list(compose.flatten().transforms)
+    for i, t in enumerate(transforms):
+        if isinstance(t, Randomizable):
+            return transforms[:i], transforms[i:]
+    return transforms, []
+
+
+def describe(obj, depth=0, max_depth=6):
+    """A JSON-able description of the configuration of a transform, without memory addresses."""
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, (np.generic, np.ndarray, torch.Tensor)):
+        return np.asarray(obj).tolist()
+    if isinstance(obj, type) or inspect.isroutine(obj):
+        return f"{obj.__module__}.{obj.__qualname__}"
+    if depth >= max_depth:
+        return type(obj).__qualname__
+    if isinstance(obj, (list, tuple)):
+        return [describe(x, depth + 1, max_depth) for x in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted((describe(x, depth + 1, max_depth) for x in obj), key=json.dumps)
+    if isinstance(obj, dict):
+        return {str(k): describe(v, depth + 1, max_depth) for k, v in obj.items()}
+    if not hasattr(obj, "__dict__"):
+        text = repr(obj)
+        return type(obj).__qualname__ if " at 0x" in text else text
+    state = {k: v for k, v in vars(obj).items() if not k.startswith("__")}
+    return {"class": type(obj).__qualname__, **{k: describe(v, depth + 1, max_depth) for k, v in state.items()}}
+
+
+def get_source_signature(path: str) -> list:
+    # A source file is identified by its path, size and modification time
+    stat = os.stat(path)
+    return [str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns]
+
+
+def to_json_meta(meta: dict) -> dict:
+    # Keep the metadata which round-trips through JSON, e.g. the filename and the affine
+    output = {}
+    for key, value in meta.items():
+        if isinstance(value, (torch.Tensor, np.ndarray)):
+            value = np.asarray(value).tolist()
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+        output[key] = value
+    return output
+
+
+class CachedTransform(Transform):
+    """
+    Cache the output of the deterministic prefix of a transform chain on disk, e.g. loading, intensity scaling,
+    foreground cropping and padding, and run the random transforms after it on every call.
+
+    Each sample is stored as one `.npy` file per array, which is memory-mapped when loaded, and a JSON entry with
+    the metadata. The entry is keyed by a hash of the configuration of the prefix and the path, size and
+    modification time of the source files, so the cache is reused across runs and data loader workers, and
+    invalidated once either changes. Files are written to temporary names and renamed, and the JSON entry is
+    written last, so that concurrent workers never read partial entries.
+
+    Args:
+        transform: The transform chain, a `Compose` or a transform wrapping a `Compose` as its `transform`.
+        cache_dir: The cache directory.
+        keys: The keys of the source files, each of which must be the path of a single file (otherwise a ValueError
+            is raised). Defaults to ("image", "label").
+    """
+
+    def __init__(self, transform: Callable, cache_dir: str, keys: Sequence[str] = ("image", "label")):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.keys = tuple(keys)
+        prefix, suffix = split_deterministic_prefix(transform)
+        self.prefix = Compose(prefix)
+        self.suffix = Compose(suffix) if suffix else None
+        self.config_hash = hashlib.sha1(
+            json.dumps([CACHE_VERSION, describe(prefix)], sort_keys=True, default=str).encode()
+        ).hexdigest()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, data: dict) -> str:
+        # Every keyed source must identify the sample, otherwise different samples would share an entry
+        for key in self.keys:
+            if not isinstance(data.get(key), (str, Path)):
+                raise ValueError(
+                    f"CachedTransform needs the path of a single source file for '{key}', "
+                    f"got {type(data.get(key)).__name__}."
+                )
+        sources = [get_source_signature(data[key]) for key in self.keys]
+        return hashlib.sha1(json.dumps([self.config_hash, sources]).encode()).hexdigest()
+
+    def get_path(self, key: str, name: str) -> Path:
+        # Spread the entries over subdirectories to keep the directories small
+        return self.cache_dir / key[:2] / f"{key}.{name}"
+
+    def lookup(self, key: str) -> dict | None:
+        entry_path = self.get_path(key, "json")
+        if not entry_path.exists():
+            return None
+        entry = json.loads(entry_path.read_text())
+        output = dict(entry["values"])
+        for name, meta in entry["arrays"].items():
+            # Copy-on-write mapping: pages are read lazily and the random transforms may modify the array in place
+            array = torch.from_numpy(np.load(self.get_path(key, f"{name}.npy"), mmap_mode="c"))
+            affine = meta.pop("affine", None)
+            output[name] = MetaTensor(array, affine=torch.tensor(affine) if affine is not None else None, meta=meta)
+        return output
+
+    def store(self, key: str, data: dict) -> None:
+        self.get_path(key, "json").parent.mkdir(exist_ok=True)
+        suffix = f".{os.getpid()}.tmp"
+        entry = {"arrays": {}, "values": {}}
+        for name, value in data.items():
+            if isinstance(value, (torch.Tensor, np.ndarray)):
+                path = self.get_path(key, f"{name}.npy")
+                with open(str(path) + suffix, "wb") as file:
+                    np.save(file, np.ascontiguousarray(value.cpu().numpy() if torch.is_tensor(value) else value))
+                os.replace(str(path) + suffix, path)
+                entry["arrays"][name] = to_json_meta(value.meta) if isinstance(value, MetaTensor) else {}
+            else:
+                entry["values"][name] = value
+        entry["values"] = to_json_meta(entry["values"])
+        path = self.get_path(key, "json")
+        with open(str(path) + suffix, "w") as file:
+            json.dump(entry, file)
+        os.replace(str(path) + suffix, path)
+
+    def __call__(self, data: dict):
+        key = self.get_key(data)
+        output = self.lookup(key)
+        if output is None:
+            self.misses += 1
+            output = self.prefix(data)
+            self.store(key, output)
+        else:
+            self.hits += 1
+            # The entries of the input which are not produced by the prefix, e.g. the ids of the dataset
+            output = {**{k: v for k, v in data.items() if k not in output}, **output}
+        return self.suffix(output) if self.suffix is not None else output
@@ -1,5 +1,5 @@
 import torch
-from torch import nn
+import torch.nn.functional as F
 
 from .mmd import MMD
 
@@ -8,13 +8,9 @@ def get_mu(cond1, cond2):
     return cond1.reshape(-1, 1) * cond2.reshape(1, -1) * 1.0
 
 
-class DCC(nn.Module):
+class DCC(MMD):
     """class-aware domain discrepancy"""
 
-    def __init__(self, gamma=None):
-        super().__init__()
-        self.gamma = gamma
-
     def compute_dcc(self, dist, mu, gamma):
         rbf_kernel_dist = {}
         rbf_kernel_dist["ss"] = torch.exp(-gamma * dist["ss"])
@@ -43,23 +39,58 @@ class DCC(nn.Module):
 
 
 class CDD(MMD):
-    """Contrastive Domain Discrepancy"""
+    """
+    Contrastive Domain Discrepancy, the mean class-conditional MMD of the same classes (intra) minus the mean
+    class-conditional MMD of different classes (inter) between the source and target samples.
+
+    The kernel sums of all pairs of classes are computed at once as A_s^T K A_t, where A is the one-hot assignment
+    matrix of samples to classes, instead of one masked kernel mean for each pair of classes. Samples with a label
+    out of [0, num_classes), e.g. -1, and classes without samples are ignored.
+
+    Args:
+        inter_class: Whether to subtract the discrepancy of different classes. Defaults to True.
+        **kwargs: The arguments of MMD, e.g. gamma.
+    """
+
+    def __init__(self, inter_class=True, **kwargs):
+        super().__init__(**kwargs)
+        self.inter_class = inter_class
 
     def forward(self, source, target, source_label, target_label, num_classes):
         dist = {}
         dist["ss"] = self.compute_pairwise_squared_dist(source, source)
         dist["tt"] = self.compute_pairwise_squared_dist(target, target)
         dist["st"] = self.compute_pairwise_squared_dist(source, target)
+        gamma = self.estimate_rbf_gamma(dist) if self.gamma is None else self.gamma
 
-        cdd = 0
-        M = num_classes
-        dcc = DCC()
-
-        # intra
-        for c in range(M):
-            cdd += dcc(c1=c, c2=c, label1=source_label, label2=target_label, dist=dist) / M
-        # inter
-        for c1, c2 in zip(range(M), range(M)):
-            if c1 != c2:
-                cdd -= dcc(c1, c2, label1=source_label, label2=target_label, dist=dist) / (M * (M - 1))
+        # One-hot assignment matrices of shape (samples, classes)
+        source_assignment = get_assignment(source_label, num_classes).to(source)
+        target_assignment = get_assignment(target_label, num_classes).to(target)
+        source_count = source_assignment.sum(dim=0)
+        target_count = target_assignment.sum(dim=0)
+
+        # Kernel means of all pairs of classes, of shape (classes,) for ss and tt, and (classes, classes) for st
+        ss = torch.einsum("ic,ij,jc->c", source_assignment, self.kernel(dist["ss"], gamma), source_assignment)
+        tt = torch.einsum("ic,ij,jc->c", target_assignment, self.kernel(dist["tt"], gamma), target_assignment)
+        st = source_assignment.T @ self.kernel(dist["st"], gamma) @ target_assignment
+        ss = ss / source_count.clamp(min=1) ** 2
+        tt = tt / target_count.clamp(min=1) ** 2
+        st = st / (source_count[:, None] * target_count[None, :]).clamp(min=1)
+
+        # The class-conditional MMD of each (source class, target class)
+        dcc = ss[:, None] + tt[None, :] - 2 * st
+        observed = (source_count > 0)[:, None] & (target_count > 0)[None, :]
+        intra = torch.eye(num_classes, dtype=torch.bool, device=dcc.device) & observed
+        inter = ~torch.eye(num_classes, dtype=torch.bool, device=dcc.device) & observed
+
+        cdd = torch.sum(dcc * intra) / intra.sum().clamp(min=1)
+        if self.inter_class:
+            cdd = cdd - torch.sum(dcc * inter) / inter.sum().clamp(min=1)
         return cdd
+
+
+def get_assignment(label, num_classes):
+    # Labels out of range have no class
+    label = label.long()
+    valid = (label >= 0) & (label < num_classes)
+    return F.one_hot(label.clamp(0, num_classes - 1), num_classes) * valid[:, None]
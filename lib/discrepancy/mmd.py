@@ -1,16 +1,58 @@
-import numpy as np
+from __future__ import annotations
+
+from collections.abc import Sequence
+from typing import Literal
+
 import torch
 from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
 
 
 def get_tril_values(x, offset=-1):
-    return torch.Tensor(x)[torch.tril_indices(*x.shape, offset=offset).unbind()]
+    return x[torch.tril_indices(*x.shape, offset=offset, device=x.device).unbind()]
 
 
 class MMD(nn.Module):
-    def __init__(self, gamma=None):
+    """
+    Maximum mean discrepancy between source and target samples, with the kernel exp(-gamma * ||a - b||).
+
+    Args:
+        gamma: The kernel parameter. If None, then it is estimated by the median heuristic. Defaults to None.
+        estimator: How the MMD is computed. Value must be one of ['quadratic', 'block', 'linear'].
+            If 'quadratic', then the full kernel matrices are computed. If 'block', then the same value is computed
+            from tiles of block_size x block_size kernel values, which are recomputed in the backward pass instead
+            of being stored. If 'linear', then the linear-time estimator of Gretton et al. (2012) over pairs of
+            consecutive samples is used, which is unbiased but has a higher variance. Defaults to 'quadratic'.
+        unbiased: Whether the quadratic (block) estimator excludes the kernel values of the samples with themselves.
+            Defaults to False.
+        kernel_multipliers: The multipliers of gamma of a multi-kernel MMD, whose kernel is the sum of the kernels
+            of each bandwidth, e.g. (0.25, 0.5, 1, 2, 4). Defaults to (1,), i.e. a single kernel.
+        block_size: The number of samples of a tile of the block estimator. Defaults to 1024.
+        median_samples: The maximum number of pairwise distances for the median heuristic. If there are more pairs,
+            then a random subset of them is used. If None, then all pairs are used. Defaults to 4096.
+        median_momentum: The momentum of the exponential moving average of the median distance across steps.
+            Defaults to 0, i.e. the median distance of the current samples.
+    """
+
+    def __init__(
+        self,
+        gamma: float | None = None,
+        estimator: Literal["quadratic", "block", "linear"] = "quadratic",
+        unbiased: bool = False,
+        kernel_multipliers: Sequence[float] = (1.0,),
+        block_size: int = 1024,
+        median_samples: int | None = 4096,
+        median_momentum: float = 0.0,
+    ):
         super().__init__()
         self.gamma = gamma
+        self.estimator = estimator
+        self.unbiased = unbiased
+        self.kernel_multipliers = tuple(kernel_multipliers)
+        self.block_size = block_size
+        self.median_samples = median_samples
+        self.median_momentum = median_momentum
+        self.register_buffer("median_dist", None, persistent=False)
 
     def compute_pairwise_squared_dist(self, A: Tensor, B: Tensor) -> Tensor:
         # https://alex.smola.org/posts/4-second-binomial/
@@ -21,24 +63,57 @@ class MMD(nn.Module):
         #     return dist
         return torch.cdist(A[None], B[None])[0]
 
+    def kernel(self, dist: Tensor, gamma) -> Tensor:
+        if len(self.kernel_multipliers) == 1:
+            return torch.exp(-gamma * self.kernel_multipliers[0] * dist)
+        return sum(torch.exp(-gamma * multiplier * dist) for multiplier in self.kernel_multipliers)
+
+    @torch.no_grad()
+    def get_gamma(self, median_dist: Tensor, default_gamma=1) -> Tensor:
+        # Track the median distance across steps, and keep it on the device to avoid synchronization
+        if self.median_momentum > 0 and self.median_dist is not None:
+            median_dist = self.median_momentum * self.median_dist + (1 - self.median_momentum) * median_dist
+        self.median_dist = median_dist
+        return torch.where(median_dist > 1e-8, 1 / (0.5 * median_dist.clamp(min=1e-8)) ** 0.5, default_gamma)
+
+    def sample_median(self, values: Tensor) -> Tensor:
+        if self.median_samples is not None and len(values) > self.median_samples:
+            values = values[torch.randint(len(values), (self.median_samples,), device=values.device)]
+        return torch.median(values)
+
+    @torch.no_grad()
     def estimate_rbf_gamma(self, dist, default_gamma=1):
         # Calculate parameter gamma using median heuristic
         # https://arxiv.org/pdf/1707.07269.pdf
         dist_ss = get_tril_values(dist["ss"]).flatten()
         dist_tt = get_tril_values(dist["tt"]).flatten()
         dist_st = dist["st"].flatten()
-        median_dist = torch.median(torch.cat([dist_ss, dist_tt, dist_st])).item()
-        if np.allclose(median_dist, 0):
-            gamma = default_gamma
-        else:
-            gamma = 1 / (0.5 * median_dist) ** 0.5
-        return gamma
+        median_dist = self.sample_median(torch.cat([dist_ss, dist_tt, dist_st]))
+        return self.get_gamma(median_dist, default_gamma)
+
+    @torch.no_grad()
+    def estimate_rbf_gamma_from_samples(self, source: Tensor, target: Tensor, default_gamma=1):
+        # The median heuristic over the distances of distinct pairs of samples, without the full distance matrices
+        samples = torch.cat([source, target]).detach()
+        n = len(samples)
+        if self.median_samples is None or n * (n - 1) // 2 <= self.median_samples:
+            return self.get_gamma(torch.median(torch.pdist(samples)), default_gamma)
+        i = torch.randint(n, (self.median_samples,), device=samples.device)
+        j = (i + torch.randint(1, n, (self.median_samples,), device=samples.device)) % n
+        median_dist = torch.median(torch.linalg.vector_norm(samples[i] - samples[j], dim=1))
+        return self.get_gamma(median_dist, default_gamma)
 
     def compute_mmd(self, dist, gamma):
         rbf_kernel_dist = {}
-        rbf_kernel_dist["ss"] = torch.exp(-gamma * dist["ss"])
-        rbf_kernel_dist["tt"] = torch.exp(-gamma * dist["tt"])
-        rbf_kernel_dist["st"] = torch.exp(-gamma * dist["st"])
+        rbf_kernel_dist["ss"] = self.kernel(dist["ss"], gamma)
+        rbf_kernel_dist["tt"] = self.kernel(dist["tt"], gamma)
+        rbf_kernel_dist["st"] = self.kernel(dist["st"], gamma)
+        if self.unbiased:
+            return (
+                mean_off_diagonal(rbf_kernel_dist["ss"])
+                + mean_off_diagonal(rbf_kernel_dist["tt"])
+                - 2.0 * torch.mean(rbf_kernel_dist["st"])
+            )
         mmd = (
             torch.mean(rbf_kernel_dist["ss"])
             + torch.mean(rbf_kernel_dist["tt"])
@@ -46,11 +121,62 @@ class MMD(nn.Module):
         )
         return mmd
 
+    def compute_tile_kernel_sum(self, A: Tensor, B: Tensor, gamma) -> Tensor:
+        return torch.sum(self.kernel(self.compute_pairwise_squared_dist(A, B), gamma))
+
+    def compute_block_kernel_mean(self, A: Tensor, B: Tensor, gamma, exclude_diagonal=False) -> Tensor:
+        # Sum up the kernel values tile by tile, where each tile is recomputed in the backward pass
+        total = 0
+        for i in range(0, len(A), self.block_size):
+            for j in range(0, len(B), self.block_size):
+                tile = (A[i : i + self.block_size], B[j : j + self.block_size], gamma)
+                if torch.is_grad_enabled():
+                    total = total + checkpoint(self.compute_tile_kernel_sum, *tile, use_reentrant=False)
+                else:
+                    total = total + self.compute_tile_kernel_sum(*tile)
+        if exclude_diagonal:
+            # The distance of each sample to itself is 0, whose kernel value is the number of kernels
+            return (total - len(A) * len(self.kernel_multipliers)) / (len(A) * (len(A) - 1))
+        return total / (len(A) * len(B))
+
+    def compute_block_mmd(self, source: Tensor, target: Tensor, gamma) -> Tensor:
+        return (
+            self.compute_block_kernel_mean(source, source, gamma, exclude_diagonal=self.unbiased)
+            + self.compute_block_kernel_mean(target, target, gamma, exclude_diagonal=self.unbiased)
+            - 2.0 * self.compute_block_kernel_mean(source, target, gamma)
+        )
+
+    def compute_linear_mmd(self, source: Tensor, target: Tensor, gamma) -> Tensor:
+        # https://jmlr.org/papers/v13/gretton12a.html, Lemma 14
+        m = min(len(source), len(target)) // 2
+        assert m > 0, "The linear-time MMD needs at least 2 source and 2 target samples."
+        x1, x2 = source[0 : 2 * m : 2], source[1 : 2 * m : 2]
+        y1, y2 = target[0 : 2 * m : 2], target[1 : 2 * m : 2]
+
+        def k(a, b):
+            return self.kernel(torch.linalg.vector_norm(a - b, dim=1), gamma)
+
+        return torch.mean(k(x1, x2) + k(y1, y2) - k(x1, y2) - k(x2, y1))
+
     def forward(self, source: Tensor, target: Tensor):
-        dist = {}
-        dist["ss"] = self.compute_pairwise_squared_dist(source, source)
-        dist["tt"] = self.compute_pairwise_squared_dist(target, target)
-        dist["st"] = self.compute_pairwise_squared_dist(source, target)
-        gamma = self.estimate_rbf_gamma(dist) if self.gamma is None else self.gamma
-        mmd = self.compute_mmd(dist, gamma)
-        return mmd
+        if self.estimator == "quadratic":
+            dist = {}
+            dist["ss"] = self.compute_pairwise_squared_dist(source, source)
+            dist["tt"] = self.compute_pairwise_squared_dist(target, target)
+            dist["st"] = self.compute_pairwise_squared_dist(source, target)
+            gamma = self.estimate_rbf_gamma(dist) if self.gamma is None else self.gamma
+            mmd = self.compute_mmd(dist, gamma)
+            return mmd
+
+        gamma = self.estimate_rbf_gamma_from_samples(source, target) if self.gamma is None else self.gamma
+        if self.estimator == "block":
+            return self.compute_block_mmd(source, target, gamma)
+        elif self.estimator == "linear":
+            return self.compute_linear_mmd(source, target, gamma)
+        else:
+            raise ValueError(f"Unknown estimator {self.estimator}, expected 'quadratic', 'block' or 'linear'.")
+
+
+def mean_off_diagonal(x: Tensor) -> Tensor:
+    n = len(x)
+    return (torch.sum(x) - torch.sum(torch.diagonal(x))) / (n * (n - 1))
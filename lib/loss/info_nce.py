@@ -1,7 +1,10 @@
+from typing import Literal
+
 import torch
 import torch.nn.functional as F
 from torch import nn
 from torch.nn.modules.loss import _Loss
+from torch.utils.checkpoint import checkpoint
 
 
 # Dimension hint for pytorch tensors
@@ -31,6 +34,14 @@ class InfoNCE(_Loss, nn.Module):
             If 'paired', then each query sample is paired with a number of negative keys.
             Comparable to a triplet loss, but with multiple negatives per sample.
             If 'unpaired', then the set of negative keys are all unrelated to any positive key.
+        sampling: How the queries of each class are subsampled by `sample_queries()`.
+            Value must be one of ['all', 'random', 'hard'].
+            If 'all', then all queries are used. If 'random', then at most max_queries_per_class queries of each class
+            are sampled uniformly. If 'hard', then the queries least similar to their positive key are kept.
+        max_queries_per_class: The query budget of each class for sampling. If None, then all queries are used.
+        chunk_size: The maximum number of queries whose logits are materialized at once. The logits of each chunk
+            are recomputed in the backward pass instead of being stored, so that the memory is bounded by
+            chunk_size * (M + 1) logits. If None, then the logits of all queries are computed at once.
 
     Input shape:
         query: (N, D) Tensor with query samples (e.g. embeddings of the input).
@@ -39,6 +50,9 @@ class InfoNCE(_Loss, nn.Module):
             If negative_mode = 'paired', then negative_keys is a (N, M, D) Tensor.
             If negative_mode = 'unpaired', then negative_keys is a (M, D) Tensor.
             If None, then the negative keys for a sample are the positive keys for the other samples.
+        negative_mask (optional): (N, M) boolean Tensor, whether each negative key is used for each query sample.
+            Only with negative_mode = 'unpaired' or 'paired'. Masked out keys do not contribute to the loss, so that
+            queries with different sets of negative keys are computed in a single call.
 
     Returns:
          Value of the InfoNCE Loss.
@@ -52,24 +66,83 @@ class InfoNCE(_Loss, nn.Module):
         >>> output = loss(query, positive_key, negative_keys)
     """
 
-    def __init__(self, temperature=0.1, reduction="mean", negative_mode="unpaired"):
+    def __init__(
+        self,
+        temperature=0.1,
+        reduction="mean",
+        negative_mode="unpaired",
+        sampling: Literal["all", "random", "hard"] = "all",
+        max_queries_per_class: int | None = None,
+        chunk_size: int | None = None,
+    ):
         super().__init__()
         self.temperature = temperature
         self.reduction = reduction
         self.negative_mode = negative_mode
+        self.sampling = sampling
+        self.max_queries_per_class = max_queries_per_class
+        self.chunk_size = chunk_size
 
-    def forward(self, query, positive_key, negative_keys=None, temperature=None):
+    def forward(self, query, positive_key, negative_keys=None, temperature=None, negative_mask=None, reduction=None):
         return info_nce(
             query,
             positive_key,
             negative_keys,
             temperature=temperature if temperature is not None else self.temperature,
-            reduction=self.reduction,
+            reduction=reduction if reduction is not None else self.reduction,
             negative_mode=self.negative_mode,
+            negative_mask=negative_mask,
+            chunk_size=self.chunk_size,
         )
 
-
-def info_nce(query, positive_key, negative_keys=None, temperature=0.1, reduction="mean", negative_mode="unpaired"):
+    def sample_queries(self, query, positive_key, labels):
+        """
+        The indices of the queries sampled by the query budget of each class (label), or None to use all queries.
+
+        Input shape:
+            query: (N, D) Tensor with query samples.
+            positive_key: (N, D) or (D,) Tensor with the positive keys of the query samples.
+            labels: (N,) Tensor with the classes of the query samples.
+        """
+        if self.sampling == "all" or self.max_queries_per_class is None:
+            return None
+        if self.sampling == "random":
+            return sample_per_class(labels, self.max_queries_per_class)
+        if self.sampling == "hard":
+            with torch.no_grad():
+                similarity = torch.sum(F.normalize(query, dim=-1) * F.normalize(positive_key, dim=-1), dim=-1)
+            return sample_per_class(labels, self.max_queries_per_class, scores=-similarity)
+        raise ValueError(f"Unknown sampling {self.sampling}, expected 'all', 'random' or 'hard'.")
+
+
+def sample_per_class(labels, max_per_class, scores=None):
+    """
+    The indices of at most max_per_class samples of each class, those with the highest scores if given,
+    otherwise random ones. All classes are sampled at once by sorting the samples by class and score.
+    """
+    n = labels.shape[0]
+    if scores is None:
+        scores = torch.rand(n, device=labels.device)
+    order: tensor[n] = torch.argsort(scores, descending=True)
+    order = order[torch.argsort(labels[order], stable=True)]
+
+    # The rank of each sample within its class, by the start of the class in the sorted samples
+    sizes = torch.bincount(labels)
+    starts = torch.cumsum(sizes, dim=0) - sizes
+    ranks: tensor[n] = torch.arange(n, device=labels.device) - starts[labels[order]]
+    return order[ranks < max_per_class]
+
+
+def info_nce(
+    query,
+    positive_key,
+    negative_keys=None,
+    temperature=0.1,
+    reduction="mean",
+    negative_mode="unpaired",
+    negative_mask=None,
+    chunk_size=None,
+):
 
     n, d = query.shape
 
@@ -77,21 +150,59 @@ def info_nce(query, positive_key, negative_keys=None, temperature=0.1, reduction
     query: tensor[n, d] = F.normalize(query, dim=-1)
     positive_key: tensor[n, d] = F.normalize(positive_key, dim=-1)
     if negative_keys is not None:
-        m = negative_keys.shape[-2]
         negative_keys = F.normalize(negative_keys, dim=-1)
 
+    if chunk_size is None or n <= chunk_size:
+        out: tensor[n] = info_nce_rows(query, positive_key, negative_keys, negative_mask, temperature, negative_mode)
+    else:
+        # Compute the losses of chunk_size queries at once, where the logits are recomputed in the backward pass
+        chunks = []
+        for start in range(0, n, chunk_size):
+            rows = slice(start, start + chunk_size)
+            args = (
+                query[rows],
+                positive_key[rows] if negative_keys is not None and positive_key.dim() > 1 else positive_key,
+                negative_keys[rows] if negative_keys is not None and negative_mode == "paired" else negative_keys,
+                negative_mask[rows] if negative_mask is not None else None,
+                temperature,
+                negative_mode,
+                start,
+            )
+            if torch.is_grad_enabled():
+                chunks.append(checkpoint(info_nce_rows, *args, use_reentrant=False))
+            else:
+                chunks.append(info_nce_rows(*args))
+        out: tensor[n] = torch.concat(chunks)
+
+    if reduction == "mean":
+        return out.mean()
+    elif reduction == "sum":
+        return out.sum()
+    elif reduction == "none":
+        return out
+    else:
+        raise ValueError(f"Invalid reduction {reduction}.")
+
+
+def info_nce_rows(query, positive_key, negative_keys, negative_mask, temperature, negative_mode, offset=0):
+    """The InfoNCE of each of the (normalized) query samples, where `offset` is the index of the first query."""
+
+    n = query.shape[0]
+
     # Compute InfoNCE
     if negative_keys is None:
         logits: tensor[n, n] = query @ positive_key.t()
-        target: tensor[n] = torch.arange(n, device=query.device)
+        target: tensor[n] = torch.arange(offset, offset + n, device=query.device)
 
     elif negative_mode == "unpaired":
+        m = negative_keys.shape[-2]
         positive_logit: tensor[n, 1] = torch.sum(query * positive_key, dim=1, keepdim=True)
         negative_logits: tensor[n, m] = query @ negative_keys.t()
         logits: tensor[n, m + 1] = torch.concat([positive_logit, negative_logits], dim=1)
         target: tensor[n] = torch.zeros(n, device=query.device).long()
 
     elif negative_mode == "paired":
+        m = negative_keys.shape[-2]
         positive_logit: tensor[n, 1] = torch.sum(query * positive_key, dim=1, keepdim=True)
         negative_logits: tensor[n, m] = torch.einsum("N D, N M D -> N M", query, negative_keys)
         logits: tensor[n, m + 1] = torch.concat([positive_logit, negative_logits], dim=1)
@@ -100,7 +211,9 @@ def info_nce(query, positive_key, negative_keys=None, temperature=0.1, reduction
     else:
         raise Exception("Invalid negative mode.")
 
-    out = F.cross_entropy(logits / temperature, target, reduction=reduction)
-    if out.isnan():
-        breakpoint()
-    return out
+    # Exclude the masked out negative keys from the softmax
+    if negative_keys is not None and negative_mask is not None:
+        positive_mask: tensor[n, 1] = torch.ones(n, 1, dtype=torch.bool, device=query.device)
+        logits = logits.masked_fill(~torch.concat([positive_mask, negative_mask], dim=1), float("-inf"))
+
+    return F.cross_entropy(logits / temperature, target, reduction="none")
@@ -1,29 +1,28 @@
 from typing import Literal
 
 import torch
-import torch.nn.functional as F
 from numpy import ndarray
 from torch import Tensor
-from torch.nn import NLLLoss
 from torch.nn.modules.loss import _Loss
 
 
-def channelwise_matmul(x1, x2):
-    if len(x1.shape) == 4:
-        perm_index = (0, 2, 3, 1)
-        inv_perm_index = (0, 3, 1, 2)
-    elif len(x1.shape) == 5:
-        perm_index = (0, 2, 3, 4, 1)
-        inv_perm_index = (0, 4, 1, 2, 3)
-    else:
-        raise ValueError("Invalid x1 dimension.")
-    x1_reshaped = x1.permute(*perm_index)
-    y = torch.matmul(x1_reshaped, x2).permute(*inv_perm_index)
-    return y
+class TargetAdaptativeLoss(_Loss):
+    """
+    The negative log-likelihood of partially labeled targets, where the probabilities of the background classes
+    (and class 0), which are not labeled in the target domain, are merged into one.
 
+    The merged log-probability of the background is the logsumexp of their logits, and the log-probabilities
+    are only gathered at the target classes, so that the full log-probabilities are never materialized.
+    The logits are 2D or 3D, of shape (batch, num_classes, spatial...), and are computed in float32 under autocast.
 
-class TargetAdaptativeLoss(_Loss):
-    def __init__(self, num_classes: int, background_classes: list, device: Literal["cuda", "cpu"] = "cuda"):
+    Args:
+        num_classes (int): The number of classes.
+        background_classes (list): The classes merged into the background.
+        device (str | None): The device of the constant buffers. Defaults to None, i.e. they are moved with the
+            module (or the logits).
+    """
+
+    def __init__(self, num_classes: int, background_classes: list, device: Literal["cuda", "cpu"] | None = None):
         super().__init__()
         self.num_classes = num_classes
         if isinstance(background_classes, (Tensor, ndarray)):
@@ -32,23 +31,13 @@ class TargetAdaptativeLoss(_Loss):
             self.background = list(background_classes)
         self.foreground = list(set(range(1, self.num_classes)) - set(self.background))
 
-        # probability mergeing matrix
-        self.prob_merge_mat = torch.ones((num_classes, 1), requires_grad=False)
-        self.prob_merge_mat[self.foreground, 0] = 0
-        self.prob_merge_mat = self.prob_merge_mat.to(device)
-
-        # Weighting matrix
-        self.mat_a = torch.eye(num_classes, num_classes)
-        self.mat_a[0, 0] = 0
-        self.mat_a[self.background, self.background] = 0
-        self.mat_a = self.mat_a.to(device)
-
-        self.mat_b = torch.zeros(1, num_classes)
-        for i in [0] + self.background:
-            self.mat_b[0, i] = 1
-        self.mat_b = self.mat_b.to(device)
-
-        self.nll = NLLLoss()
+        # Whether each class is merged into the background, and the indices of the merged classes
+        background_mask = torch.zeros(num_classes, dtype=torch.bool)
+        background_mask[[0] + self.background] = True
+        self.register_buffer("background_mask", background_mask, persistent=False)
+        self.register_buffer("background_index", background_mask.nonzero()[:, 0], persistent=False)
+        if device is not None:
+            self.to(device)
 
     def forward(self, logits, target):
         logits_ch, target_ch = logits.shape[1], target.shape[1]
@@ -56,16 +45,21 @@ class TargetAdaptativeLoss(_Loss):
             target = torch.squeeze(target, dim=1)
             target = target.long()
 
-        log_prob = F.log_softmax(logits, dim=1)
-        fg_log_prob = channelwise_matmul(log_prob, self.mat_a).contiguous()
+        # Compute the log-probabilities in full precision
+        if logits.dtype in (torch.float16, torch.bfloat16):
+            logits = logits.float()
+        background_mask = self.background_mask.to(logits.device)
+        background_index = self.background_index.to(logits.device)
 
-        prob = torch.exp(log_prob)
-        bg_log_prob_value = torch.log(channelwise_matmul(prob, self.prob_merge_mat)).contiguous()
-        bg_log_prob = channelwise_matmul(bg_log_prob_value, self.mat_b).contiguous()
+        # log p(c) = logits[c] - logsumexp(logits) for the foreground classes, and
+        # log p(background) = logsumexp(logits[background]) - logsumexp(logits) for the merged background classes
+        log_normalizer = torch.logsumexp(logits, dim=1)
+        bg_logit = torch.logsumexp(logits.index_select(1, background_index), dim=1)
+        target_logit = logits.gather(1, target.unsqueeze(1)).squeeze(1)
+        log_prob_m = torch.where(background_mask[target], bg_logit, target_logit) - log_normalizer
 
-        log_prob_m = fg_log_prob + bg_log_prob
-        loss = self.nll(log_prob_m, target)
-        return loss
+        # The mean negative log-likelihood, as NLLLoss
+        return -log_prob_m.mean()
 
     def __repr__(self):
         return (
@@ -73,6 +67,5 @@ class TargetAdaptativeLoss(_Loss):
             f"  (num_classes): {self.num_classes}\n"
             f"  (foreground): {self.foreground}\n"
             f"  (background): {self.background}\n"
-            f"  (nll): {self.nll}\n"
             ")"
         )
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+from typing import Literal
+
+import pandas as pd
+import torch
+from monai.utils import MetricReduction
+
+from lib.metrics.label_map import LabelMapMetric, to_label_maps
+
+SCORE_NAMES = ("dice", "iou", "precision", "recall")
+
+
+def batch_confusion_matrix(y_pred: torch.Tensor, y: torch.Tensor, num_classes: int) -> torch.Tensor:
+    """
+    Compute the confusion matrix of each sample with a single `bincount` on the device of the inputs.
+
+    Args:
+        y_pred (torch.Tensor): Predicted label maps of shape (B, N).
+        y (torch.Tensor): Ground truth label maps of shape (B, N).
+        num_classes (int): The number of classes.
+
+    Returns:
+        torch.Tensor: Confusion matrices of shape (B, num_classes, num_classes), indexed by [sample, truth, prediction].
+    """
+    batch_size = y.shape[0]
+    offsets = torch.arange(batch_size, device=y.device).view(-1, 1) * num_classes**2
+    index = offsets + y * num_classes + y_pred
+    return torch.bincount(index.flatten(), minlength=batch_size * num_classes**2).view(-1, num_classes, num_classes)
+
+
+def compute_confusion_scores(
+    confusion: torch.Tensor, score_name: Literal["dice", "iou", "precision", "recall"], ignore_empty: bool = True
+) -> torch.Tensor:
+    """
+    Derive the score of each class from confusion matrices of shape (..., C, C).
+
+    As in monai.metrics.DiceMetric, the score of a class missing in the ground truth is nan if `ignore_empty`,
+    otherwise it is 1 if the class is also missing in the prediction and 0 if not.
+    """
+    confusion = confusion.double()
+    tp = torch.diagonal(confusion, dim1=-2, dim2=-1)
+    fn = confusion.sum(dim=-1) - tp
+    fp = confusion.sum(dim=-2) - tp
+
+    if score_name == "dice":
+        numerator, denominator = 2 * tp, 2 * tp + fp + fn
+    elif score_name == "iou":
+        numerator, denominator = tp, tp + fp + fn
+    elif score_name == "precision":
+        numerator, denominator = tp, tp + fp
+    elif score_name == "recall":
+        numerator, denominator = tp, tp + fn
+    else:
+        raise ValueError(f"Unknown score {score_name}, expected one of {SCORE_NAMES}.")
+
+    scores = numerator / denominator
+    empty = (tp + fn) == 0
+    if ignore_empty:
+        scores = torch.where(empty, torch.nan, scores)
+    else:
+        scores = torch.where(empty, ((tp + fp) == 0).double(), scores)
+    return scores.float()
+
+
+class StreamingConfusionMetric(LabelMapMetric):
+    """
+    A drop-in replacement of monai.metrics.DiceMetric based on confusion matrices of label maps.
+
+    Instead of dense one-hot tensors, it accepts label maps of shape (B, 1, spatial...) (one-hot tensors and logits
+    are also accepted and argmaxed). The confusion matrix of each sample is computed with a single `bincount`, and
+    the per-sample, per-class score is stored in the buffer as in DiceMetric, so it works with the validators as is.
+
+    Besides, the confusion matrices are summed on the device for each modality given by the `modality` argument,
+    and are not cleared by `reset()` but by `reset_statistics()`. `summary()` derives the per-class
+    Dice/IoU/precision/recall of each modality from them at the end of validation.
+
+    Args:
+        num_classes (int): The number of classes.
+        score_name (str): The score stored in the buffer, one of "dice", "iou", "precision" and "recall".
+        include_background (bool): Whether to include the score of class 0. Defaults to True.
+        reduction (MetricReduction | str): The reduction of `aggregate()`. Defaults to "mean".
+        get_not_nans (bool): Whether to return the number of not-nan values in `aggregate()`. Defaults to False.
+        ignore_empty (bool): Whether the score of classes missing in the ground truth are ignored (nan).
+
+    Examples:
+        >>> metric = StreamingConfusionMetric(num_classes=4)
+        >>> metric(y_pred=pred_labels, y=labels, modality="ct")
+        >>> metric.aggregate().item()
+        >>> metric.summary()
+    """
+
+    def __init__(
+        self,
+        num_classes: int,
+        score_name: Literal["dice", "iou", "precision", "recall"] = "dice",
+        include_background: bool = True,
+        reduction: MetricReduction | str = MetricReduction.MEAN,
+        get_not_nans: bool = False,
+        ignore_empty: bool = True,
+    ):
+        super().__init__(reduction, get_not_nans)
+        if score_name not in SCORE_NAMES:
+            raise ValueError(f"Unknown score {score_name}, expected one of {SCORE_NAMES}.")
+        self.num_classes = num_classes
+        self.score_name = score_name
+        self.include_background = include_background
+        self.ignore_empty = ignore_empty
+        self.confusion_matrices = {}
+
+    def _compute_tensor(self, y_pred: torch.Tensor, y: torch.Tensor, modality: str = "all") -> torch.Tensor:
+        confusion = batch_confusion_matrix(to_label_maps(y_pred), to_label_maps(y), self.num_classes)
+        if modality in self.confusion_matrices:
+            self.confusion_matrices[modality] += confusion.sum(dim=0)
+        else:
+            self.confusion_matrices[modality] = confusion.sum(dim=0)
+
+        scores = compute_confusion_scores(confusion, self.score_name, self.ignore_empty)
+        return scores if self.include_background else scores[:, 1:]
+
+    def reset_statistics(self):
+        self.confusion_matrices = {}
+
+    def summary(self) -> pd.DataFrame:
+        """
+        The scores derived from the accumulated confusion matrices, with one row for each class
+        and one column for each (modality, score), e.g. ("ct", "dice").
+        """
+        table = {}
+        for modality, confusion in sorted(self.confusion_matrices.items()):
+            confusion = confusion.cpu()
+            for score_name in SCORE_NAMES:
+                table[(modality, score_name)] = compute_confusion_scores(confusion, score_name, self.ignore_empty)
+        return pd.DataFrame({k: v.numpy() for k, v in table.items()}, index=range(self.num_classes))
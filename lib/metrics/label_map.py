@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import torch
+from monai.metrics import CumulativeIterationMetric
+from monai.metrics.utils import do_metric_reduction
+from monai.utils import MetricReduction, convert_to_tensor
+
+
+def to_label_maps(x: torch.Tensor, flatten: bool = True) -> torch.Tensor:
+    """
+    Convert a batch of label maps (B, 1, spatial...) or of one-hot tensors / logits (B, C, spatial...)
+    to label maps of shape (B, N), or (B, spatial...) if `flatten` is False.
+    """
+    x = convert_to_tensor(x, track_meta=False)
+    labels = torch.argmax(x, dim=1) if x.shape[1] > 1 else x[:, 0]
+    return labels.reshape(x.shape[0], -1).long() if flatten else labels.long()
+
+
+class LabelMapMetric(CumulativeIterationMetric):
+    """
+    The base class of metrics computed from label maps instead of dense one-hot tensors.
+
+    Like monai.metrics.DiceMetric, each call stores the per-sample, per-class values in the buffer, so that
+    the metric works with the validators as is. Validators pass label maps to these metrics, together with
+    the modality of the samples, so that statistics can be accumulated for each modality across `reset()`.
+    """
+
+    def __init__(self, reduction: MetricReduction | str = MetricReduction.MEAN, get_not_nans: bool = False):
+        super().__init__()
+        self.reduction = reduction
+        self.get_not_nans = get_not_nans
+
+    def _compute_list(self, y_pred, y=None, **kwargs):
+        # Compute samples of the same shape as a batch instead of one by one
+        if y is not None and len(y_pred) > 0 and all(p.shape == y_pred[0].shape for p in [*y_pred, *y]):
+            return self._compute_tensor(torch.stack(list(y_pred)).detach(), torch.stack(list(y)).detach(), **kwargs)
+        return super()._compute_list(y_pred, y, **kwargs)
+
+    def aggregate(self, reduction: MetricReduction | str | None = None):
+        data = self.get_buffer()
+        if not isinstance(data, torch.Tensor):
+            raise ValueError(f"the data to aggregate must be PyTorch Tensor, got {type(data)}.")
+        f, not_nans = do_metric_reduction(data, reduction or self.reduction)
+        return (f, not_nans) if self.get_not_nans else f
+
+    def reset_statistics(self):
+        """Clear the statistics accumulated across `reset()`, e.g. at the beginning of a validation."""
+        pass
+
+    def summary(self):
+        return None
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import copy
+from collections import OrderedDict
+from collections.abc import Sequence
+
+import torch
+from torch import nn
+
+from lib.cyclegan.translation_cache import get_fingerprints
+
+
+class PseudoLabelProvider:
+    """
+    Pseudo labels (argmax of the predicted logits) of images, e.g. the CycleGAN translations of labeled images.
+
+    The predictions run under `torch.no_grad()`, so that no activations are stored for them. They are made either
+    by the network itself (`module.encoder` and `module.decoder`, in their current mode, as before), or by an EMA
+    teacher copy of the network in evaluation mode if `ema_decay` is given. With `refresh_interval` > 1, the pseudo
+    labels are kept in a per-sample cache, keyed by sample ids or content fingerprints, and only predicted again
+    once they are `refresh_interval` steps old.
+
+    Args:
+        ema_decay (float | None): The decay of the EMA teacher, e.g. 0.999. Defaults to None, i.e. no teacher.
+        refresh_interval (int): The number of steps for which cached pseudo labels are reused. Defaults to 1,
+            i.e. the pseudo labels are predicted every step without a cache.
+        capacity (int): The number of pseudo labels kept in the cache (on the device). Defaults to 4096.
+    """
+
+    def __init__(self, ema_decay: float | None = None, refresh_interval: int = 1, capacity: int = 4096):
+        assert ema_decay is None or 0 <= ema_decay < 1, "ema_decay should be in [0, 1)."
+        assert refresh_interval >= 1, "refresh_interval should be at least 1."
+        self.ema_decay = ema_decay
+        self.refresh_interval = refresh_interval
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.teacher = None
+        self.num_steps = 0
+        self.num_classes = None
+
+    def register_module(self, module: nn.Module) -> PseudoLabelProvider:
+        if self.ema_decay is not None:
+            self.teacher = copy.deepcopy(nn.ModuleDict({"encoder": module.encoder, "decoder": module.decoder}))
+            self.teacher.eval()
+            self.teacher.requires_grad_(False)
+        return self
+
+    @torch.no_grad()
+    def predict(self, module: nn.Module, images: torch.Tensor) -> torch.Tensor:
+        network = self.teacher if self.teacher is not None else module
+        logits = network.decoder(*network.encoder(images))
+        self.num_classes = logits.shape[1]
+        return torch.argmax(logits, dim=1, keepdim=True)
+
+    def get_labels(self, module: nn.Module, images: torch.Tensor, keys: Sequence[str] | None = None) -> torch.Tensor:
+        """
+        The pseudo labels of a batch of images, of shape (batch, 1, spatial...), where only the missing or
+        outdated labels are predicted.
+
+        Args:
+            module (nn.Module): The module with `encoder` and `decoder`.
+            images (torch.Tensor): Images of shape (batch, channel, spatial...).
+            keys (Sequence[str] | None): The sample ids of the images. Defaults to None, i.e. content fingerprints.
+        """
+        if self.refresh_interval <= 1 or self.capacity <= 0:
+            return self.predict(module, images)
+
+        keys = [str(key) for key in keys] if keys is not None else get_fingerprints(images)
+        labels = [self.lookup(key) for key in keys]
+        missing = [i for i, label in enumerate(labels) if label is None]
+
+        # Predict the missing pseudo labels as a batch
+        if missing:
+            predicted = self.predict(module, images[missing])
+            for i, label in zip(missing, predicted):
+                labels[i] = label
+                self.store(keys[i], label)
+        return torch.stack([label.long() for label in labels])
+
+    def lookup(self, key: str) -> torch.Tensor | None:
+        if key not in self.cache:
+            return None
+        label, step = self.cache[key]
+        if self.num_steps - step >= self.refresh_interval:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return label
+
+    def store(self, key: str, label: torch.Tensor) -> None:
+        # Labels are stored as bytes if possible, which also copies them out of the batch
+        dtype = torch.uint8 if self.num_classes <= 256 else torch.int32
+        self.cache[key] = (label.to(dtype), self.num_steps)
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    @torch.no_grad()
+    def step(self, module: nn.Module) -> None:
+        """Update the EMA teacher after an optimization step of the module, and advance the age of cached labels."""
+        self.num_steps += 1
+        if self.teacher is None:
+            return
+        student = nn.ModuleDict({"encoder": module.encoder, "decoder": module.decoder})
+        teacher_parameters = list(self.teacher.parameters())
+        student_parameters = [parameter.detach() for parameter in student.parameters()]
+        torch._foreach_lerp_(teacher_parameters, student_parameters, 1 - self.ema_decay)
+        for teacher_buffer, student_buffer in zip(self.teacher.buffers(), student.buffers()):
+            teacher_buffer.copy_(student_buffer)
+
+    def state_dict(self) -> dict:
+        return {"teacher": self.teacher.state_dict()} if self.teacher is not None else {}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        if "teacher" in state_dict and self.teacher is not None:
+            self.teacher.load_state_dict(state_dict["teacher"])
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import os
+import warnings
+from contextlib import nullcontext
+from typing import Literal
+
+import torch
+
+
+def get_default_device() -> Literal["cuda", "cpu"]:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def resolve_device(device: str | torch.device | None) -> str | torch.device:
+    # Fall back to the default device if none is specified, so that the same config runs on CPU-only machines
+    return get_default_device() if device is None else device
+
+
+def get_num_cpus() -> int:
+    # The CPUs the process may run on (respecting taskset / cgroup cpusets), which may be fewer than os.cpu_count()
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class CPUProfile:
+    """
+    The execution profile of training and inference on CPU, e.g. smoke-scale runs on CPU-only CI and inference nodes.
+
+    Args:
+        num_threads: The number of intra-op threads (torch.set_num_threads). If None, then the number of CPUs
+            available to the process is used. Defaults to None.
+        num_interop_threads: The number of inter-op threads. It can only be set before the first parallel work,
+            and is kept as is otherwise. If None, then the default of PyTorch is kept. Defaults to None.
+        onednn: Whether the oneDNN (MKLDNN) kernels of convolutions are enabled. Defaults to True.
+        bf16: Whether the forward passes of inference run under bfloat16 autocast. It is only faster on CPUs with
+            native bfloat16 support (e.g. AVX512-BF16 or AMX). Training uses the `amp` option of the updater instead,
+            which autocasts to bfloat16 on CPU. Defaults to False.
+        flush_denormal: Whether denormal floats are flushed to zero, which avoids the slow paths of denormal
+            arithmetic of x86 CPUs. Defaults to True.
+    """
+
+    def __init__(
+        self,
+        num_threads: int | None = None,
+        num_interop_threads: int | None = None,
+        onednn: bool = True,
+        bf16: bool = False,
+        flush_denormal: bool = True,
+    ):
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.onednn = onednn
+        self.bf16 = bf16
+        self.flush_denormal = flush_denormal
+
+    def apply(self) -> CPUProfile:
+        torch.set_num_threads(self.num_threads or get_num_cpus())
+        if self.num_interop_threads is not None and self.num_interop_threads != torch.get_num_interop_threads():
+            try:
+                torch.set_num_interop_threads(self.num_interop_threads)
+            except RuntimeError:
+                warnings.warn("The number of inter-op threads cannot be set after parallel work has started.")
+        torch.backends.mkldnn.enabled = self.onednn
+        torch.set_flush_denormal(self.flush_denormal)
+        return self
+
+    def autocast(self):
+        """The autocast context of inference on CPU."""
+        if not self.bf16:
+            return nullcontext()
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+
+    def print_info(self):
+        print(
+            "CPU profile:",
+            f"{torch.get_num_threads()} threads, {torch.get_num_interop_threads()} inter-op threads,",
+            f"oneDNN {'on' if torch.backends.mkldnn.enabled else 'off'},",
+            f"bfloat16 inference {'on' if self.bf16 else 'off'}",
+        )
@@ -5,12 +5,13 @@ from lib.tensor_shape import tensor
 
 
 def get_prototype_mapping(
-    features: tensor["n d"],
+    features: tensor["... n d"],
     prototypes: tensor["k d"],
     smoothness: float,
     cluster_dist: tensor["k 1"] | None = None,
     niter=None,
     eps=None,
+    check_every=10,
 ):
     """
     Get the pixel-to-prototype mapping in ProtoSeg (https://arxiv.org/pdf/2203.15102)
@@ -18,174 +19,169 @@ def get_prototype_mapping(
     with Sinkhorn-Knopp iteration.
 
     args:
-        features: A (N, D) tensor. N stands for the batch size.
+        features: A (N, D) tensor, or a (B, N, D) tensor of B problems. N stands for the batch size.
         prototypes: A (K, D) tensor. K is the number of prototypes and D is the dimension of feature space.
         smoothness: the parameter that controls the smoothness of distribution.
             The notation is epsilon in the SwAV paper and kappa in ProtoSeg.
         cluster_dist: A (K, 1) tensor. If None, the cluster distributes uniformly.
-        niter: The number of SK iteration.
+        niter: The (maximum) number of SK iteration.
         eps: The stopping deviation of SK iteration. Either `niter` or `eps` should be specified.
+        check_every: The number of SK iterations between the checks of the stopping deviation.
 
     return:
-        Q: A (K, N) tensor, the code matrix / the mapping from instance to prototypes.
+        Q: A (K, N) tensor, or a (B, K, N) tensor, the code matrix / the mapping from instance to prototypes.
             The notation is $L_c$ in ProtoSeg and $Q$ in SwAV.
     """
-    n = features.shape[0]
+    n = features.shape[-2]
     k = prototypes.shape[0]
     assert (
-        features.shape[1] == prototypes.shape[1]
+        features.shape[-1] == prototypes.shape[1]
     ), "The number of dimensions of features should be the same as that of prototypes."
 
-    solver = SinkhornKnopp(niter, eps)
+    solver = SinkhornKnopp(niter, eps, check_every)
 
-    M: tensor[k, n] = prototypes @ features.T
+    # The cost of assigning a feature to a prototype is their negative similarity
+    M: tensor[..., k, n] = -prototypes @ features.transpose(-1, -2)
     lbd = 1 / smoothness
 
-    sample_dist: tensor[n, 1] = torch.ones(n, 1) / n
+    sample_dist: tensor[n] = features.new_ones(n) / n
     if cluster_dist is None:
-        cluster_dist: tensor[k, 1] = torch.ones(k, 1) / k
+        cluster_dist: tensor[k] = features.new_ones(k) / k
 
-    Q: tensor[k, n] = solver.get_P(M, lbd, r=cluster_dist, c=sample_dist)
+    Q: tensor[..., k, n] = solver.get_P(M, lbd, r=cluster_dist, c=sample_dist)
     return Q
 
 
-def self_labelling(logits, lbd, cluster_dist=None, ncluster=None, niter=None, eps=None):
+def self_labelling(logits, lbd, cluster_dist=None, ncluster=None, niter=None, eps=None, check_every=10):
     """
     Self-labelling via simultaneous clustering and representation learning
 
     Solved with Sinkhorn-Knopp iteration.
 
     args:
-        logits: A (N, D) tensor. N stands for the number of samples.
+        logits: A (N, K) tensor, or a (B, N, K) tensor of B problems. N stands for the number of samples.
         ldb: the parameter of langrange multiplier lambda
         cluster_dist: A (K, 1) tensor. If None, `ncluster` should be assigned a int.
         ncluster: The number of clusters.
-        niter: The number of SK iteration.
+        niter: The (maximum) number of SK iteration.
         eps: The stopping deviation of SK iteration. Either `niter` or `eps` should be specified.
+        check_every: The number of SK iterations between the checks of the stopping deviation.
 
     return:
-        Q: A (K, N) tensor.
+        Q: A (K, N) tensor, or a (B, K, N) tensor.
     """
 
-    n = logits.shape[0]
+    n = logits.shape[-2]
     k = cluster_dist.shape[0] if cluster_dist is not None else ncluster
     assert k is not None, "Either cluster_dist or ncluster should be specified. "
 
-    solver = SinkhornKnopp(niter, eps)
+    solver = SinkhornKnopp(niter, eps, check_every)
 
-    P: tensor[k, n] = F.softmax(logits)
+    # -log(P), computed in the log domain
+    M: tensor[..., k, n] = -F.log_softmax(logits, dim=-1).transpose(-1, -2)
 
-    sample_dist = tensor[n, 1] = torch.ones(n, 1) / n
+    sample_dist: tensor[n] = logits.new_ones(n) / n
     if cluster_dist is None:
-        cluster_dist: tensor[k, 1] = torch.ones(k, 1) / k
+        cluster_dist: tensor[k] = logits.new_ones(k) / k
 
-    Q: tensor[k, n] = solver.get_P(-torch.log(P), lbd, r=cluster_dist, c=sample_dist)
+    Q: tensor[..., k, n] = solver.get_P(M, lbd, r=cluster_dist, c=sample_dist)
     return Q
 
 
 class SinkhornKnopp:
-    def __init__(self, niter=None, eps=None):
-        self.u = None
-        self.v = None
-        self.K = None
+    def __init__(self, niter=None, eps=None, check_every=10):
+        self.log_u = None
+        self.log_v = None
+        self.log_K = None
 
         assert (niter is not None) or (eps is not None)
         self.eps = eps
         self.niter = niter
+        self.check_every = check_every
 
     def get_P(self, M=None, lbd=None, r=None, c=None):
         """
         Obtain the optimal joint probility matrix of entropic OT problem.
 
         args:
-            M: A (n, n) Tensor, cost matrix
+            M: A (..., k, n) Tensor, cost matrices
             ldb: the parameter of langrange multiplier lambda
-            r: A (n, 1) Tensor, which is the vector of source histogram
-            C: A (n, m) Tensor, which is the collection of m target histograms
+            r: A (..., k) or (k, 1) Tensor, the source histograms (row sums)
+            c: A (..., n) or (n, 1) Tensor, the target histograms (column sums)
 
         return:
-            out: A (m, n, n) Tensor. If m == 1, then a (n, n) Tensor is returned.
+            out: A (..., k, n) Tensor, the transport plans.
         """
         # Solve the OT problem if inputs are provided
         if (M is not None) and (lbd is not None) and (r is not None) and (c is not None):
             self.solve(M, lbd, r, c)
-        elif (self.u is not None) and (self.v is not None) and (self.K is not None):
+        elif (self.log_u is not None) and (self.log_v is not None) and (self.log_K is not None):
             pass
         else:
             raise ValueError(
                 "The value of u, v, and K should be computed in advance. Otherwise inputs should be provided."
             )
 
-        n, m = self.u.shape
-
-        # Compute P based on Sinkhorn’s theorem:: P = diag(u) K diag(v), K = exp(-lbd * M)
-        u: tensor[m, n, 1] = self.u.T[:, :, None]
-        v: tensor[m, 1, n] = self.v.T[:, None, :]
-        # the first dimension of out corresponds to the number of target histograms
-        out: tensor[m, n, n] = u * self.K[None, :, :] * v
-
-        if u.shape[0] == 1:
-            out: tensor[n, n] = out.squeeze()
-        return out
+        # Compute P based on Sinkhorn’s theorem: P = diag(u) K diag(v), K = exp(-lbd * M), in the log domain
+        return torch.exp(self.log_u[..., :, None] + self.log_K + self.log_v[..., None, :])
 
     def solve(self, M, ldb, r, c):
-        self.u, self.v, self.K = sinkhorn_knopp(M, ldb, r, c, self.niter, self.eps)
+        self.log_u, self.log_v, self.log_K = sinkhorn_knopp(M, ldb, r, c, self.niter, self.eps, self.check_every)
 
 
 def sinkhorn_knopp(
-    M: tensor["n n"],
-    lbd: int,
-    r: tensor["n 1"],
-    C: tensor["n m"],
+    M: tensor["... k n"],
+    lbd: float,
+    r: tensor["... k"],
+    c: tensor["... n"],
     niter: int | None = None,
     eps: float | None = 1e-4,
+    check_every: int = 10,
+    max_iter: int = 1000,
 ):
     """
-    Solve the entropic OT problem using matrix scaling algorithm:
+    Solve the entropic OT problems using matrix scaling algorithm in the log domain:
         P^{lbd} = argmin_{P} <P, M> - h(P)/lbd,
         P in transport polytope U(r, c)
 
     where
-        M: A (n, n) Tensor, cost matrix
+        M: A (..., k, n) Tensor, cost matrices, whose leading dimensions are solved as a batch of problems
         ldb: the parameter of langrange multiplier lambda
-        r: A (n, 1) Tensor, which is the vector of row sums (i.e. P @ ones(m) = r)
-        C: A (n, m) Tensor, which is the collection of n-dimensional column sums (i.e. ones(n).T @ P = c.T)
+        r: A (..., k) or (k, 1) Tensor, the vector of row sums (i.e. P @ ones(n) = r)
+        c: A (..., n) or (n, 1) Tensor, the vector of column sums (i.e. ones(k).T @ P = c.T)
+
+    The histograms are normalized to sum to 1. The scaling vectors are updated with logsumexp, so that the kernel
+    exp(-lbd * M) never underflows for large lbd. If `eps` is given, the iteration stops once the L1 deviation of
+    the row sums of all problems is below `eps`, which is checked every `check_every` iterations only (each check
+    synchronizes with the device), up to `niter` (or `max_iter`) iterations.
 
     See: [Algorithm 1] in https://marcocuturi.net/Papers/cuturi13sinkhorn.pdf
 
     return:
-        u: A (n, m) Tensor, row coefficients
-        v: A (n, m) Tensor, column coefficients
-        K: A (n, n) Tensor, exp(-lbd * M)
+        log_u: A (..., k) Tensor, log of row coefficients
+        log_v: A (..., n) Tensor, log of column coefficients
+        log_K: A (..., k, n) Tensor, -lbd * M
     """
-    n = r.shape[0]
-    m = C.shape[1]
-
-    assert r.sum(dim=0) == 1, "The source histogram should sum to 1."
-    assert (C.sum(dim=0) == torch.ones((1, m))).all(), "The target histograms should sum to 1."
-
-    r: tensor[n] = r.squeeze()
-    positive_i = r > 0
-    r, M = r[positive_i], M[positive_i, :]
-
-    K: tensor[n, n] = torch.exp(-lbd * M)
+    if r.dim() == 2 and r.shape[-1] == 1:
+        r = r[:, 0]
+    if c.dim() == 2 and c.shape[-1] == 1:
+        c = c[:, 0]
+    log_r: tensor[..., k] = torch.log(r / r.sum(dim=-1, keepdim=True)).to(M)
+    log_c: tensor[..., n] = torch.log(c / c.sum(dim=-1, keepdim=True)).to(M)
 
-    old_d = torch.inf
-    u: tensor[n, m] = torch.ones(n, m) / n
-    v: tensor[n, m] = C / (K.T @ u)
+    log_K: tensor[..., k, n] = -lbd * M
+    log_u: tensor[..., k] = torch.zeros_like(log_K[..., :, 0])
+    log_v: tensor[..., n] = log_c - torch.logsumexp(log_K + log_u[..., :, None], dim=-2)
 
     # Sinkhorn’s fixed point iteration (u, v) <- (r./Kv, c./K'u).
-    if niter is not None:
-        for _ in range(niter):
-            u = r / (K @ v)
-            v = C / (K.T @ u)
-    else:
-        while True:
-            u = r / (K @ v)
-            v = C / (K.T @ u)
-            d = (u * ((K * M) @ v)).sum(dim=0)
-            if torch.max(torch.abs(d - old_d)) < eps:
+    num_iterations = niter if niter is not None else max_iter
+    for i in range(1, num_iterations + 1):
+        log_u = log_r - torch.logsumexp(log_K + log_v[..., None, :], dim=-1)
+        log_v = log_c - torch.logsumexp(log_K + log_u[..., :, None], dim=-2)
+
+        if eps is not None and i % check_every == 0:
+            # The column sums are exact after the update of v, so the deviation is that of the row sums
+            row_sums = torch.exp(log_u + torch.logsumexp(log_K + log_v[..., None, :], dim=-1))
+            if torch.max(torch.sum(torch.abs(row_sums - log_r.exp()), dim=-1)) < eps:
                 break
-            else:
-                old_d = d
-    return u, v, K
+    return log_u, log_v, log_K
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import weakref
+from collections.abc import Callable, Sequence
+from typing import Literal
+
+import numpy as np
+import torch
+from monai.inferers import sliding_window_inference as monai_sliding_window_inference
+
+# The sw_batch_size found for each predictor, and each (channels, window shape, dtype, device) of its inputs.
+# Predictors are weakly referenced, so that a new predictor never inherits the entries of a collected one.
+_auto_sw_batch_sizes = weakref.WeakKeyDictionary()
+
+
+def sliding_window_inference(
+    inputs: torch.Tensor,
+    roi_size: Sequence[int] | int,
+    sw_batch_size: int | Literal["auto"],
+    predictor: Callable,
+    *args,
+    **kwargs,
+):
+    """
+    The same as `monai.inferers.sliding_window_inference`, but `sw_batch_size` can be set to "auto".
+
+    With "auto", the windows of all samples in `inputs` are inferred together as long as they fit into the
+    available memory of the device. The memory footprint of a window is probed once for each predictor and
+    window shape. If the device still runs out of memory, the batch size is halved and the inference is retried.
+    """
+    if sw_batch_size != "auto":
+        return monai_sliding_window_inference(inputs, roi_size, sw_batch_size, predictor, *args, **kwargs)
+
+    # Bound methods (e.g. module.forward) are recreated on every access, so their owners are used as the key
+    owner = getattr(predictor, "__self__", predictor)
+    sw_batch_sizes = _auto_sw_batch_sizes.setdefault(owner, {})
+    key = (inputs.shape[1], get_window_shape(inputs, roi_size), inputs.dtype, str(inputs.device))
+    num_windows = count_windows(inputs, roi_size, kwargs.get("overlap", 0.25))
+    if key not in sw_batch_sizes:
+        sw_batch_sizes[key] = probe_sw_batch_size(inputs, roi_size, predictor)
+
+    while True:
+        sw_batch_size = max(1, min(sw_batch_sizes[key], num_windows))
+        try:
+            return monai_sliding_window_inference(inputs, roi_size, sw_batch_size, predictor, *args, **kwargs)
+        except torch.cuda.OutOfMemoryError:
+            if sw_batch_size == 1:
+                raise
+            torch.cuda.empty_cache()
+            sw_batch_sizes[key] = sw_batch_size // 2
+
+
+def get_window_shape(inputs: torch.Tensor, roi_size: Sequence[int] | int) -> tuple:
+    spatial_shape = inputs.shape[2:]
+    if isinstance(roi_size, int):
+        roi_size = [roi_size] * len(spatial_shape)
+    # Non-positive roi sizes take the size of the inputs, as in monai
+    return tuple(s if r is None or r <= 0 else r for r, s in zip(roi_size, spatial_shape))
+
+
+def count_windows(inputs: torch.Tensor, roi_size: Sequence[int] | int, overlap: float = 0.25) -> int:
+    """The total number of windows of all samples in `inputs`."""
+    window_shape = get_window_shape(inputs, roi_size)
+    num_windows = 1
+    for size, window in zip(inputs.shape[2:], window_shape):
+        interval = max(int(window * (1 - overlap)), 1)
+        num_windows *= int(np.ceil(max(size - window, 0) / interval)) + 1
+    return num_windows * inputs.shape[0]
+
+
+def probe_sw_batch_size(
+    inputs: torch.Tensor,
+    roi_size: Sequence[int] | int,
+    predictor: Callable,
+    memory_fraction: float = 0.8,
+    max_sw_batch_size: int = 64,
+) -> int:
+    """
+    Estimate the number of windows which fit into the free memory of the device.
+
+    On CUDA devices, the peak memory of inferring a single window is measured. On other devices,
+    where the free memory cannot be queried, `max_sw_batch_size` is returned.
+    """
+    if inputs.device.type != "cuda":
+        return max_sw_batch_size
+
+    window = torch.zeros(
+        (1, inputs.shape[1], *get_window_shape(inputs, roi_size)), dtype=inputs.dtype, device=inputs.device
+    )
+    torch.cuda.synchronize(inputs.device)
+    baseline = torch.cuda.memory_allocated(inputs.device)
+    torch.cuda.reset_peak_memory_stats(inputs.device)
+    with torch.no_grad():
+        predictor(window)
+    torch.cuda.synchronize(inputs.device)
+    window_memory = max(torch.cuda.max_memory_allocated(inputs.device) - baseline, 1)
+
+    free_memory, _ = torch.cuda.mem_get_info(inputs.device)
+    return int(np.clip(free_memory * memory_fraction // window_memory, 1, max_sw_batch_size))
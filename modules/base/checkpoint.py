@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import os
+import queue
+import random
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+
+
+def to_cpu(obj):
+    """Recursively copy the tensors in a (nested) state dict to CPU memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path: str | Path):
+    """Save an object with `torch.save` to a temporary file, and then rename it to the target path."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_rng_states() -> dict:
+    """Collect the states of the python, numpy and torch (cpu and cuda) random number generators."""
+    states = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: dict):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def load_training_state(path: str | Path) -> dict:
+    """Load a training state saved by `CheckpointManager.save_state`, given the file or its checkpoint directory."""
+    path = Path(path)
+    if path.is_dir():
+        path = path / CheckpointManager.state_filename
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+class CheckpointManager:
+    """
+    Save the state dicts of a module without blocking the training loop.
+
+    The state dicts are copied to CPU memory in the calling thread, and written to disk by a background
+    thread. Every file is written to a temporary path and renamed atomically, so that an interrupted
+    write never leaves a corrupted checkpoint behind.
+
+    The best checkpoint is always written at the top level of `checkpoint_dir`, which is where `module.load`
+    looks for it. If `keep_last > 0` or `keep_best > 1`, checkpoints are also written to `checkpoint_dir/step_{step}`,
+    and only the latest `keep_last` and the best `keep_best` of these directories are kept.
+
+    Modules provide their files through `get_state_dicts()`, which maps file names to state dicts.
+    Modules without it are saved synchronously with `module.save`.
+
+    A complete training state (see `BaseTrainer.get_training_state`) is written to `checkpoint_dir/training_state.pth`
+    by `save_state()`, which is used to resume training.
+
+    Args:
+        checkpoint_dir (str): The directory to save checkpoints.
+        keep_last (int): The number of latest checkpoints to keep. Defaults to 0.
+        keep_best (int): The number of best checkpoints to keep. Defaults to 1.
+        asynchronous (bool): If False, checkpoints are written in the calling thread. Defaults to True.
+
+    Examples:
+        >>> checkpoint = CheckpointManager("./checkpoints/", keep_last=2, keep_best=1)
+        >>> checkpoint.save(module, step, val_metric, is_best=val_metric > best_metric)
+        >>> checkpoint.wait()
+    """
+
+    state_filename = "training_state.pth"
+
+    def __init__(self, checkpoint_dir: str, keep_last: int = 0, keep_best: int = 1, asynchronous: bool = True):
+        assert keep_last >= 0 and keep_best >= 1, "keep_last should be >= 0 and keep_best should be >= 1."
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.asynchronous = asynchronous
+
+        self.history = []  # (step, metric) of the checkpoints in step directories
+        self.queue = queue.Queue()
+        self.worker = None
+        self.error = None
+
+    @property
+    def keep_history(self):
+        return self.keep_last > 0 or self.keep_best > 1
+
+    def save(self, module: nn.Module, step: int, metric: float | None = None, is_best: bool = False):
+        """Snapshot the state dicts of the module and schedule them to be written."""
+        self.raise_error()
+        if not (is_best or self.keep_history):
+            return
+
+        if not getattr(module, "get_state_dicts", False):
+            self.wait()
+            if is_best:
+                module.save(str(self.checkpoint_dir))
+            return
+
+        state_dicts = to_cpu(module.get_state_dicts())
+        self.schedule(self.write, state_dicts, step, metric, is_best)
+
+    def save_state(self, state: dict):
+        """Snapshot a complete training state and schedule it to be written."""
+        self.raise_error()
+        self.schedule(atomic_save, to_cpu(state), self.checkpoint_dir / self.state_filename)
+
+    def schedule(self, func, *args):
+        if self.asynchronous:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+            self.queue.put((func, args))
+        else:
+            func(*args)
+
+    def run(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, state_dicts: dict, step: int, metric: float | None, is_best: bool):
+        if is_best:
+            for filename, state_dict in state_dicts.items():
+                atomic_save(state_dict, self.checkpoint_dir / filename)
+
+        if self.keep_history:
+            for filename, state_dict in state_dicts.items():
+                atomic_save(state_dict, self.checkpoint_dir / f"step_{step}" / filename)
+            self.history.append((step, metric))
+            self.evict()
+
+    def evict(self):
+        latest = sorted(self.history, key=lambda x: x[0], reverse=True)[: self.keep_last]
+        scored = [h for h in self.history if h[1] is not None]
+        best = sorted(scored, key=lambda x: x[1], reverse=True)[: self.keep_best]
+        kept = set(latest) | set(best)
+        for step, metric in self.history:
+            if (step, metric) not in kept:
+                shutil.rmtree(self.checkpoint_dir / f"step_{step}", ignore_errors=True)
+        self.history = [h for h in self.history if h in kept]
+
+    def wait(self):
+        """Block until all scheduled checkpoints are written."""
+        self.queue.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Failed to write checkpoint.") from error
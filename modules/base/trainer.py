@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import queue
+import threading
 import warnings
 from collections.abc import Callable, Sequence
 from pathlib import Path
@@ -15,6 +17,9 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm.auto import tqdm
 from tqdm.autonotebook import tqdm
 
+from lib.datasets.batch_stream import BatchStream
+from lib.runtime import resolve_device
+from modules.base.checkpoint import CheckpointManager, get_rng_states, load_training_state, set_rng_states
 from modules.base.updater import BaseUpdater
 from modules.base.validator import BaseValidator, SmatDatasetValidator
 
@@ -29,34 +34,76 @@ def get_metric_str(metric, prefix=None, suffix=None):
 
 
 class TrainLogger:
-    def __init__(self, checkpoint_dir):
+    """
+    Write training metrics to the summary writer and messages to `train.log` (and the console).
+
+    The loguru sinks are registered once when the logger is created, and only receive the messages
+    of this logger. The sinks of other loggers are left untouched, except for the default stderr
+    sink of loguru, which would otherwise break the progress bars.
+
+    Args:
+        checkpoint_dir (str): The directory of the log file and the tensorboard events.
+        asynchronous (bool): If True, log messages and scalars are written by background workers,
+            so that logging never blocks the training step. Call `close()` to flush them.
+    """
+
+    def __init__(self, checkpoint_dir, asynchronous: bool = False):
         self.checkpoint_dir = checkpoint_dir
         self.log_file = Path(self.checkpoint_dir) / "train.log"
+        self.asynchronous = asynchronous
 
         self.writer = SummaryWriter(log_dir=checkpoint_dir)
-        self.msg = ""
-
-    def catch_msg(self, s):
-        self.msg = s[:-1]
+        self.scalar_queue = None
+        if asynchronous:
+            self.scalar_queue = queue.SimpleQueue()
+            self.scalar_worker = threading.Thread(target=self.write_scalars, daemon=True)
+            self.scalar_worker.start()
+
+        # Only the messages of this logger are sent to its sinks
+        self.uid = id(self)
+        self.logger = logger.bind(train_logger=self.uid)
+        try:
+            logger.remove(0)
+        except ValueError:
+            pass
+        self.handler_ids = [
+            logger.add(self.log_file, filter=self.is_own_record, enqueue=asynchronous),
+            logger.add(self.write_console, filter=self.is_console_record, colorize=True, enqueue=asynchronous),
+        ]
+
+    def is_own_record(self, record):
+        return record["extra"].get("train_logger") == self.uid
+
+    def is_console_record(self, record):
+        return self.is_own_record(record) and record["extra"].get("console", False)
+
+    def write_console(self, msg):
+        tqdm.write(msg[:-1])
+
+    def write_scalars(self):
+        while True:
+            item = self.scalar_queue.get()
+            if item is None:
+                break
+            self.writer.add_scalar(*item)
 
     def add_to_summary_writer(self, metric, value, step, prefix=None, suffix=None):
         metric = get_metric_str(metric, prefix, suffix)
-        self.writer.add_scalar(metric, value, step)
+        if self.scalar_queue is not None:
+            self.scalar_queue.put((metric, value, step))
+        else:
+            self.writer.add_scalar(metric, value, step)
 
     def add_to_log_file(self, metric, value, step, prefix=None, suffix=None):
         metric = get_metric_str(metric, prefix, suffix)
-        logger.remove()
-        logger.add(self.log_file)
-        logger.info(f"Step {step} | {metric} = {value}")
+        self.logger.info(f"Step {step} | {metric} = {value}")
 
     def log_train(self, metric, value, step):
         self.add_to_summary_writer(metric, value, step, prefix="train")
 
     def log_val(self, metric, suffix, value, step):
         if isinstance(suffix, (list, tuple)):
-            logger.remove()
-            logger.add(self.log_file)
-            logger.info(f"Step {step} | Validation")
+            self.logger.info(f"Step {step} | Validation")
             for suf, val in zip(suffix, value):
                 self.add_to_summary_writer(metric, val, step, prefix="val", suffix=suf)
                 self.add_to_log_file(metric, val, step, suffix=suf)
@@ -65,20 +112,21 @@ class TrainLogger:
             self.add_to_log_file(metric, value, step, suffix=suffix)
 
     def success(self, msg):
-        logger.remove()
-        logger.add(self.log_file)
-        logger.add(self.catch_msg, colorize=True)
-        logger.success(msg)
-        tqdm.write(self.msg)
-        self.msg = ""
+        self.logger.bind(console=True).success(msg)
 
     def info(self, msg):
-        logger.remove()
-        logger.add(self.log_file)
-        logger.add(self.catch_msg, colorize=True)
-        logger.info(msg)
-        tqdm.write(self.msg)
-        self.msg = ""
+        self.logger.bind(console=True).info(msg)
+
+    def close(self):
+        """Flush the pending messages and scalars, and release the sinks of this logger."""
+        if self.scalar_queue is not None:
+            self.scalar_queue.put(None)
+            self.scalar_worker.join()
+            self.scalar_queue = None
+        self.writer.close()
+        for handler_id in self.handler_ids:
+            logger.remove(handler_id)
+        self.handler_ids = []
 
 
 class BaseTrainer:
@@ -89,14 +137,22 @@ class BaseTrainer:
         metric: Metric | None = None,
         validator: BaseValidator | None = None,
         checkpoint_dir: str = "./checkpoints/",
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         unpack_item: Callable | Literal["monai", "pytorch"] = "pytorch",
         dev: bool = False,
+        async_logging: bool = False,
+        keep_last: int = 0,
+        keep_best: int = 1,
+        async_checkpoint: bool = True,
     ):
         self.max_iter = max_iter
         self.eval_step = eval_step
         self.checkpoint_dir = checkpoint_dir
-        self.device = device
+        self.device = resolve_device(device)
+        self.async_logging = async_logging
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.async_checkpoint = async_checkpoint
 
         self.pbar_description = "Training ({step} / {max_iter} Steps) (loss={loss:2.5f})"
 
@@ -132,6 +188,37 @@ class BaseTrainer:
     def get_alias(self):
         return getattr(self, "alias", self.__class__.__name__)
 
+    def get_training_state(self, module, updater, step, best_metric, streams) -> dict:
+        """Collect the complete state needed to resume training from the step after `step`."""
+        state = {
+            "step": step + 1,
+            "best_metric": best_metric,
+            "module": module.state_dict(),
+            "optimizer": module.optimizer.state_dict(),
+            "streams": [stream.state_dict() for stream in streams],
+            "rng": get_rng_states(),
+        }
+        if getattr(updater, "state_dict", False):
+            state["updater"] = updater.state_dict()
+        return state
+
+    def resume(self, resume_from, module, updater, streams) -> tuple[int, float]:
+        """Restore the training state saved in `resume_from`, and return the step to start from and the best metric."""
+        state = load_training_state(resume_from)
+        module.load_state_dict(state["module"])
+        module.optimizer.load_state_dict(state["optimizer"])
+        if "updater" in state:
+            updater.load_state_dict(state["updater"])
+        # Streams are restored first, since recreating their iterators consumes random numbers
+        for stream, stream_state in zip(streams, state["streams"]):
+            stream.load_state_dict(stream_state)
+        set_rng_states(state["rng"])
+        return state["step"], state["best_metric"]
+
+    def get_checkpoint_manager(self):
+        """Create the manager writing checkpoints to the (possibly renamed) checkpoint directory in background."""
+        return CheckpointManager(self.checkpoint_dir, self.keep_last, self.keep_best, self.async_checkpoint)
+
     def show_training_info(self, module, *, train_dataloader, val_dataloader):
         """An auxilary function to show training info before training procedure starts"""
         print("--------")
@@ -152,13 +239,14 @@ class BaseTrainer:
         *,
         train_dataloader: DataLoader | None = None,
         val_dataloader: DataLoader | None = None,
+        resume_from: str | None = None,
     ):
         self.show_training_info(module, train_dataloader=train_dataloader, val_dataloader=val_dataloader)
 
-        # Initalize progress bar and logger
-        # 初始化進度條和紀錄器
-        train_pbar = tqdm(range(self.max_iter), dynamic_ncols=True)
-        logger = TrainLogger(self.checkpoint_dir)
+        # Initalize logger and checkpoint manager
+        # 初始化紀錄器
+        logger = TrainLogger(self.checkpoint_dir, asynchronous=self.async_logging)
+        checkpoint = self.get_checkpoint_manager()
 
         # Initial stage. Note: updater(module) checks the module and returns a partial func of updating parameters.
         # 初始化訓練狀態和更新函式
@@ -166,13 +254,26 @@ class BaseTrainer:
         best_metric = 0
         module_update = updater(module)
 
+        # Keep the iterator of training dataloader alive across steps
+        # 保持訓練資料的迭代器
+        train_stream = BatchStream(train_dataloader)
+
+        # Resume from the saved training state if specified
+        # 從儲存的訓練狀態繼續訓練
+        start_step = 0
+        if resume_from:
+            start_step, best_metric = self.resume(resume_from, module, updater, streams=(train_stream,))
+            logger.info(f"Training resumed from {resume_from} at step {start_step}")
+        train_pbar = tqdm(range(start_step, self.max_iter), initial=start_step, total=self.max_iter, dynamic_ncols=True)
+
         for step in train_pbar:
             module.train()
 
             # Backpropagation
             # 反向傳播
-            batch = next(iter(train_dataloader))
+            batch = next(train_stream)
             images, targets = self.unpack_item(batch)
+            updater.set_progress(step, self.max_iter)
             loss = module_update(images, targets)
 
             # Update progress bar and summary writer
@@ -194,13 +295,21 @@ class BaseTrainer:
 
                 # Update best metric
                 # 更新驗證分數
+                checkpoint.save(module, step, val_metric, is_best=val_metric > best_metric)
                 if val_metric > best_metric:
-                    module.save(self.checkpoint_dir)
                     logger.success(f"Model saved! Validation: (New) {val_metric:2.5f} > (Old) {best_metric:2.5f}")
                     best_metric = val_metric
                 else:
                     logger.info(f"No improvement. Validation: (New) {val_metric:2.5f} <= (Old) {best_metric:2.5f}")
 
+                # Save the complete training state to resume from
+                checkpoint.save_state(
+                    self.get_training_state(module, updater, step, best_metric, streams=(train_stream,))
+                )
+
+        checkpoint.wait()
+        logger.close()
+
 
 class SmatDatasetTrainer(BaseTrainer):
     """A trainer class designed for SMAT dataset"""
@@ -212,10 +321,27 @@ class SmatDatasetTrainer(BaseTrainer):
         metric: Metric | None = None,
         validator: BaseValidator | None = None,
         checkpoint_dir: str = "./checkpoints/",
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         dev: bool = False,
+        async_logging: bool = False,
+        keep_last: int = 0,
+        keep_best: int = 1,
+        async_checkpoint: bool = True,
     ):
-        super().__init__(max_iter, eval_step, metric, validator, checkpoint_dir, device, unpack_item="monai", dev=dev)
+        super().__init__(
+            max_iter,
+            eval_step,
+            metric,
+            validator,
+            checkpoint_dir,
+            device,
+            unpack_item="monai",
+            dev=dev,
+            async_logging=async_logging,
+            keep_last=keep_last,
+            keep_best=keep_best,
+            async_checkpoint=async_checkpoint,
+        )
         self.metric = metric
         self.validator = (
             validator if validator else SmatDatasetValidator(self.metric, is_train=True, device=self.device)
@@ -230,26 +356,38 @@ class SmatDatasetTrainer(BaseTrainer):
         *,
         train_dataloader: DataLoader | None = None,
         val_dataloader: DataLoader | None = None,
+        resume_from: str | None = None,
     ):
         self.show_training_info(module, train_dataloader=train_dataloader, val_dataloader=val_dataloader)
 
-        # Initalize progress bar and logger
-        train_pbar = tqdm(range(self.max_iter), dynamic_ncols=True)
-        logger = TrainLogger(self.checkpoint_dir)
+        # Initalize logger and checkpoint manager
+        logger = TrainLogger(self.checkpoint_dir, asynchronous=self.async_logging)
+        checkpoint = self.get_checkpoint_manager()
 
         # Initial stage. Note: updater(module) checks the module and returns a partial func of updating parameters.
         best_metric = 0
         module_update = updater(module)
 
+        # Keep the iterator of training dataloader alive across steps
+        train_stream = BatchStream(train_dataloader)
+
+        # Resume from the saved training state if specified
+        start_step = 0
+        if resume_from:
+            start_step, best_metric = self.resume(resume_from, module, updater, streams=(train_stream,))
+            logger.info(f"Training resumed from {resume_from} at step {start_step}")
+        train_pbar = tqdm(range(start_step, self.max_iter), initial=start_step, total=self.max_iter, dynamic_ncols=True)
+
         for step in train_pbar:
             module.train()
 
             # Backpropagation
-            batch = next(iter(train_dataloader))
+            batch = next(train_stream)
             images, masks = batch["image"].to(self.device), batch["label"].to(self.device)
             modality_label = batch["modality"][0]
             assert modality_label in {"ct", "mr"}
             modality = 0 if modality_label == "ct" else 1
+            updater.set_progress(step, self.max_iter)
             loss = module_update(images, masks, modality)
 
             # Update progress bar and summary writer
@@ -279,8 +417,8 @@ class SmatDatasetTrainer(BaseTrainer):
                     val_metric = val_metrics["mean"]
 
                 # Update best metric
+                checkpoint.save(module, step, val_metric, is_best=val_metric > best_metric)
                 if val_metric > best_metric:
-                    module.save(self.checkpoint_dir)
                     logger.success(
                         f"Model saved! Validation: (New) {val_metric:2.7f} > (Old) {best_metric:2.7f} "
                         f"(CT) {val_metrics['ct']:2.7f} (MR) {val_metrics['mr']:2.7f}"
@@ -291,3 +429,11 @@ class SmatDatasetTrainer(BaseTrainer):
                         f"No improvement. Validation: (New) {val_metric:2.7f} <= (Old) {best_metric:2.7f} "
                         f"(CT) {val_metrics['ct']:2.7f} (MR) {val_metrics['mr']:2.7f}"
                     )
+
+                # Save the complete training state to resume from
+                checkpoint.save_state(
+                    self.get_training_state(module, updater, step, best_metric, streams=(train_stream,))
+                )
+
+        checkpoint.wait()
+        logger.close()
@@ -1,22 +1,103 @@
 from __future__ import annotations
 
 import warnings
+from contextlib import nullcontext
 from functools import partial
+from typing import Literal
 
+import numpy as np
+import torch
 from torch import TensorType, nn
 
 
+def to_channels_last(x):
+    """Convert 4D (5D) tensors to the channels-last (3d) memory format. Other inputs are returned as is."""
+    if isinstance(x, (list, tuple)):
+        return type(x)(to_channels_last(item) for item in x)
+    if isinstance(x, torch.Tensor) and x.ndim == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    if isinstance(x, torch.Tensor) and x.ndim == 5:
+        return x.contiguous(memory_format=torch.channels_last_3d)
+    return x
+
+
+def module_to_channels_last(module: nn.Module) -> nn.Module:
+    """Convert the 4D (5D) parameters and buffers of the module to the channels-last (3d) memory format in place."""
+    for tensor in [*module.parameters(), *module.buffers()]:
+        tensor.data = to_channels_last(tensor.data)
+    return module
+
+
+def split_domains(x, sizes: list[int]) -> tuple:
+    """
+    Split the (nested list / tuple of) outputs of a batch concatenated from several domains back into domains,
+    e.g. ((skips, feature), ...) -> ((ct_skips, ct_feature), (mr_skips, mr_feature)). Non-tensors are repeated.
+    """
+    if isinstance(x, torch.Tensor):
+        return x.split(sizes)
+    if isinstance(x, (list, tuple)):
+        parts = [split_domains(item, sizes) for item in x]
+        return tuple(type(x)(part[i] for part in parts) for i in range(len(sizes)))
+    return (x,) * len(sizes)
+
+
 class BaseUpdater:
-    """Base class of updaters."""
+    """
+    Base class of updaters.
 
-    def __init__(self):
-        pass
+    Args:
+        amp (bool): Whether to run the forward passes under autocast (mixed precision). The losses are scaled
+            by a GradScaler on CUDA with float16. Defaults to False.
+        amp_dtype (str | None): The autocast dtype. Defaults to None, i.e. float16 on CUDA and bfloat16 on CPU.
+        channels_last (bool): Whether to convert the module and the images to the channels-last memory format.
+            Defaults to False.
+        fused_backward (bool): Whether to back-propagate the weighted sum of the loss terms of `backward_losses()`
+            at once, instead of one backward pass for each term. Defaults to True.
+        loss_weights (dict[str, float] | None): The weights of the loss terms by name, e.g. {"adv_loss": 0.5}.
+            Defaults to None, i.e. `default_loss_weights` of the updater.
+        loss_schedules (dict[str, str] | None): The schedules of the loss weights by name, which scale the weights
+            by the training progress p = step / max_iter: "constant" (1), "linear" (p) or "sigmoid"
+            (2 / (1 + exp(-10p)) - 1, as the lambda of DANN). Defaults to None, i.e. constant.
+    """
+
+    default_loss_weights = {}
+
+    def __init__(
+        self,
+        amp: bool = False,
+        amp_dtype: Literal["float16", "bfloat16"] | None = None,
+        channels_last: bool = False,
+        fused_backward: bool = True,
+        loss_weights: dict[str, float] | None = None,
+        loss_schedules: dict[str, Literal["constant", "linear", "sigmoid"]] | None = None,
+    ):
+        self.amp = amp
+        self.amp_dtype = amp_dtype
+        self.channels_last = channels_last
+        self.fused_backward = fused_backward
+        self.loss_weights = {**self.default_loss_weights, **(loss_weights or {})}
+        self.loss_schedules = loss_schedules or {}
+        self.progress = 1.0
+        self.device_type = "cuda"
+        self.scaler = torch.amp.GradScaler("cuda", enabled=False)
 
     def __call__(self, module):
         return self.register_module(module)
 
     def register_module(self, module):
         self.check_module(module)
+
+        # Set up the autocast and the gradient scaler for the device of the module
+        parameter = next(module.parameters(), None)
+        self.device_type = parameter.device.type if parameter is not None else "cpu"
+        use_scaler = self.amp and self.device_type == "cuda" and self.get_amp_dtype() == torch.float16
+        scaler_state = self.scaler.state_dict() if self.scaler.is_enabled() else None
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=use_scaler)
+        if use_scaler and scaler_state:
+            self.scaler.load_state_dict(scaler_state)
+
+        if self.channels_last:
+            module_to_channels_last(module)
         return partial(self.update, module)
 
     def check_module(self, module: nn.Module) -> None:
@@ -29,10 +110,83 @@ class BaseUpdater:
     def get_alias(self):
         return getattr(self, "alias", self.__class__.__name__)
 
+    def get_amp_dtype(self) -> torch.dtype:
+        if self.amp_dtype is not None:
+            return getattr(torch, self.amp_dtype)
+        return torch.float16 if self.device_type == "cuda" else torch.bfloat16
+
+    def autocast(self):
+        """The autocast context of forward passes and losses. Backward passes should be called outside of it."""
+        if not self.amp:
+            return nullcontext()
+        return torch.autocast(self.device_type, dtype=self.get_amp_dtype())
+
+    def prepare(self, images):
+        """Convert the input images to the memory format of the module."""
+        return to_channels_last(images) if self.channels_last else images
+
+    def backward(self, loss: torch.Tensor, retain_graph: bool = False) -> None:
+        # The scale is fixed until `step()`, so that the gradients of several backward passes
+        # (e.g. segmentation and adversarial losses with retain_graph=True) are accumulated in the same scale
+        self.scaler.scale(loss).backward(retain_graph=retain_graph)
+
+    def set_progress(self, step: int, max_iter: int) -> None:
+        """Set the training progress, by which the loss weights are scheduled."""
+        self.progress = float(step) / max_iter
+
+    def get_loss_weight(self, name: str) -> float:
+        weight = self.loss_weights.get(name, 1.0)
+        schedule = self.loss_schedules.get(name, "constant")
+        if schedule == "constant":
+            return weight
+        elif schedule == "linear":
+            return weight * self.progress
+        elif schedule == "sigmoid":
+            return weight * (2.0 / (1.0 + np.exp(-10 * self.progress)) - 1)
+        else:
+            raise ValueError(f"Unknown schedule {schedule}, expected 'constant', 'linear' or 'sigmoid'.")
+
+    def backward_losses(self, losses: dict[str, torch.Tensor | float]) -> dict[str, float]:
+        """
+        Back-propagate the weighted loss terms, and return the (unweighted) value of each term.
+
+        If `fused_backward`, the weighted sum of the terms is back-propagated in a single pass, so that the graph
+        shared by the terms (e.g. the encoder) is traversed once and freed right after. Otherwise, each term is
+        back-propagated separately with `retain_graph=True` as before. The gradients are the same either way.
+        """
+        names = [name for name, loss in losses.items() if isinstance(loss, torch.Tensor) and loss.requires_grad]
+        weighted = [losses[name] * self.get_loss_weight(name) for name in names]
+        if self.fused_backward and weighted:
+            self.backward(sum(weighted))
+        else:
+            for i, loss in enumerate(weighted):
+                self.backward(loss, retain_graph=i < len(weighted) - 1)
+
+        # Transfer the values of all terms at once
+        tensors = [loss for loss in losses.values() if isinstance(loss, torch.Tensor)]
+        if not tensors:
+            return {name: float(loss) for name, loss in losses.items()}
+        device = tensors[0].device
+        values = [torch.as_tensor(loss, dtype=torch.float, device=device).detach() for loss in losses.values()]
+        return dict(zip(losses, torch.stack(values).tolist()))
+
+    def step(self, optimizer: torch.optim.Optimizer) -> None:
+        # Unscale the accumulated gradients, skip the step on inf/nan, and update the scale
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self) -> dict:
+        return {"scaler": self.scaler.state_dict()} if self.scaler.is_enabled() else {}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        if "scaler" in state_dict and self.scaler.is_enabled():
+            self.scaler.load_state_dict(state_dict["scaler"])
+
     def update(self, module: nn.Module, images: TensorType, targets: TensorType, **kwargs) -> float:
         module.optimizer.zero_grad()
-        preds = module(images)
-        loss = module.criterion(preds, targets)
-        loss.backward()
-        module.optimizer.step()
+        with self.autocast():
+            preds = module(self.prepare(images))
+            loss = module.criterion(preds, targets)
+        self.backward(loss)
+        self.step(module.optimizer)
         return loss.item()
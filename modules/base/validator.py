@@ -7,15 +7,83 @@ from typing import Literal
 import numpy as np
 import torch
 import tqdm
-from monai.data import DataLoader, decollate_batch
+from monai.data import DataLoader
 from monai.metrics import Metric
+from monai.metrics.utils import do_metric_reduction
+from monai.utils import MetricReduction
 from torch import nn
 from tqdm.auto import tqdm
 
 from lib.datasets.dnb import (
-    discretize_and_backgroundify_masks,
-    discretize_and_backgroundify_preds,
+    discretize_and_backgroundify_batch_masks,
+    discretize_and_backgroundify_batch_preds,
 )
+from lib.metrics.label_map import LabelMapMetric
+from lib.runtime import resolve_device
+
+
+def split_batch(batch: dict) -> list[tuple[list[int], str, int, np.ndarray]]:
+    """
+    Group the samples of a batch by their modality, number of classes and background classes,
+    so that samples of mixed modalities or partial labels can be validated in the same batch.
+
+    Returns:
+        list: The (indices, modality_label, num_classes, background_classes) of each group.
+    """
+    modality_labels = list(batch["modality"])
+    batch_size = len(modality_labels)
+    num_classes = torch.as_tensor(batch["num_classes"]).reshape(-1).tolist()
+    num_classes = num_classes * batch_size if len(num_classes) == 1 else num_classes
+    if isinstance(batch["background_classes"], (list, tuple)):
+        background_classes = [np.asarray(bg).flatten() for bg in batch["background_classes"]]
+    else:
+        background_classes = np.asarray(batch["background_classes"]).reshape(batch_size, -1)
+
+    groups = {}
+    for i in range(batch_size):
+        key = (modality_labels[i], int(num_classes[i]), tuple(background_classes[i].tolist()))
+        groups.setdefault(key, []).append(i)
+    return [(indices, m, n, np.array(bg)) for (m, n, bg), indices in groups.items()]
+
+
+def select_samples(x: torch.Tensor, indices: list[int]) -> torch.Tensor:
+    """Select the samples of a group from a batched tensor. The tensor is returned as is if all samples are selected."""
+    return x if len(indices) == len(x) else x[indices]
+
+
+def uses_label_maps(metric: Callable | Metric) -> bool:
+    """Whether the metric takes label maps (e.g. StreamingConfusionMetric) instead of one-hot tensors."""
+    return isinstance(metric, LabelMapMetric)
+
+
+def get_metric_kwargs(metric: Callable | Metric, modality: str | None = None) -> dict:
+    """The extra arguments of a metric call, i.e. the modality for which the statistics are accumulated."""
+    return {"modality": modality} if uses_label_maps(metric) and modality is not None else {}
+
+
+def get_metric_buffer(
+    metric: Metric, preds: list | torch.Tensor, masks: list | torch.Tensor, modality: str | None = None
+) -> torch.Tensor:
+    """Compute the per-sample, per-class values of a cumulative metric, and reset it."""
+    metric(y_pred=preds, y=masks, **get_metric_kwargs(metric, modality))
+    buffer = metric.get_buffer()
+    metric.reset()
+    return buffer
+
+
+def reduce_sample_metrics(metric: Metric, buffer: torch.Tensor) -> list[float]:
+    """Reduce the per-sample, per-class values of a metric to the value of each sample."""
+    reduction = getattr(metric, "reduction", MetricReduction.MEAN)
+    # Transfer the values of all samples at once instead of synchronizing the device for each sample
+    sample_metrics = [do_metric_reduction(buffer[[i]], reduction)[0].squeeze(0) for i in range(len(buffer))]
+    return torch.stack(sample_metrics).tolist()
+
+
+def compute_sample_metrics(
+    metric: Metric, preds: list | torch.Tensor, masks: list | torch.Tensor, modality: str | None = None
+) -> list[float]:
+    """Compute the metric of each sample, which equals the metric of a batch containing only that sample."""
+    return reduce_sample_metrics(metric, get_metric_buffer(metric, preds, masks, modality))
 
 
 class BaseValidator:
@@ -28,7 +96,7 @@ class BaseValidator:
         self,
         metric: Callable | Metric,
         is_train: bool = False,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         unpack_item: Callable | Literal["monai", "pytorch"] = "pytorch",
         output_infer: bool = True,
     ):
@@ -36,11 +104,11 @@ class BaseValidator:
         Args:
             metric (monai.Metric): The metric used to evaluate the model's performance.
             is_train (bool): Flag indicating if the validator is for training. Defaults to False.
-            device (Literal["cuda", "cpu"]): The device to use for validation. Defaults to 'cuda'.
+            device (Literal["cuda", "cpu"]): The device to use for validation. Defaults to CUDA if available, else CPU.
         """
         self.metric = metric
         self.is_train = is_train
-        self.device = device
+        self.device = resolve_device(device)
         self.output_infer = output_infer
 
         if unpack_item == "pytorch":
@@ -97,7 +165,12 @@ class BaseValidator:
                     infer_out = module.forward(images)
 
                 # Compute validation metrics
-                batch_metric = self.metric(infer_out, targets).item()
+                if uses_label_maps(self.metric):
+                    self.metric(infer_out, targets)
+                    batch_metric = self.metric.aggregate().item()
+                    self.metric.reset()
+                else:
+                    batch_metric = self.metric(infer_out, targets).item()
                 val_metrics += [batch_metric]
 
                 # Update progressbar
@@ -119,7 +192,7 @@ class SmatDatasetValidator(BaseValidator):
         self,
         metric: Metric,
         is_train: bool = False,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         output_infer: bool = True,
     ):
         super().__init__(metric, is_train, device, unpack_item="monai", output_infer=output_infer)
@@ -149,6 +222,9 @@ class SmatDatasetValidator(BaseValidator):
         module.eval()
         val_metrics = {"ct": [], "mr": []}
         metric_means = {"mean": None, "ct": None, "mr": None}
+        one_hot = not uses_label_maps(self.metric)
+        if not one_hot:
+            self.metric.reset_statistics()
 
         if not isinstance(dataloader, (list, tuple)):
             dataloader = [dataloader]
@@ -163,41 +239,41 @@ class SmatDatasetValidator(BaseValidator):
 
         with torch.no_grad():
             for batch in pbar:
-                # Infer, decollate data into list of samples, and postprocess both predictions and labels
                 images, masks = self.unpack_item(batch)
-                modality_label = batch["modality"][0]
-                num_classes = int(batch["num_classes"])
-                background_classes = batch["background_classes"].numpy().flatten()
-
-                assert modality_label in set(["ct", "mr"]), f"Unknown/Invalid modality {modality_label}"
-                assert 0 in background_classes, "0 should be included in background_classes"
-
-                # Get inferred / forwarded results of module
-                if getattr(module, "inference", False) and self.output_infer:
-                    infer_out = module.inference(images, modality=modality_label)
-                else:
-                    infer_out = module.forward(images)
-
-                # Discretize the prediction and masks of ground truths
-                samples = decollate_batch({"prediction": infer_out, "ground_truth": masks})
-                preds: list = discretize_and_backgroundify_preds(samples, num_classes, background_classes)
-                masks: list = discretize_and_backgroundify_masks(samples, num_classes, background_classes)
-
-                # Compute validation metrics
-                self.metric(y_pred=preds, y=masks)
-                batch_metric = self.metric.aggregate().item()
-                val_metrics[modality_label] += [batch_metric]
-                self.metric.reset()
-
-                # Update progressbar
-                info = {
-                    "val_on_partial": set(background_classes) > set([0]),
-                    "metric_name": self.metric.__class__.__name__,
-                    "batch_metric": batch_metric,
-                    "global_step": global_step,
-                }
-                desc = self.pbar_description.format(**info)
-                pbar.set_description(desc)
+                for indices, modality_label, num_classes, background_classes in split_batch(batch):
+                    assert modality_label in set(["ct", "mr"]), f"Unknown/Invalid modality {modality_label}"
+                    assert 0 in background_classes, "0 should be included in background_classes"
+
+                    # Get inferred / forwarded results of module
+                    group_images = select_samples(images, indices)
+                    if getattr(module, "inference", False) and self.output_infer:
+                        infer_out = module.inference(group_images, modality=modality_label)
+                    else:
+                        infer_out = module.forward(group_images)
+
+                    # Discretize the prediction and masks of ground truths
+                    group_masks = select_samples(masks, indices)
+                    preds = discretize_and_backgroundify_batch_preds(
+                        infer_out, num_classes, background_classes, one_hot
+                    )
+                    group_masks = discretize_and_backgroundify_batch_masks(
+                        group_masks, num_classes, background_classes, one_hot
+                    )
+
+                    # Compute validation metrics of each sample
+                    sample_metrics = compute_sample_metrics(self.metric, preds, group_masks, modality_label)
+                    val_metrics[modality_label] += sample_metrics
+                    batch_metric = np.mean(sample_metrics)
+
+                    # Update progressbar
+                    info = {
+                        "val_on_partial": set(background_classes) > set([0]),
+                        "metric_name": self.metric.__class__.__name__,
+                        "batch_metric": batch_metric,
+                        "global_step": global_step,
+                    }
+                    desc = self.pbar_description.format(**info)
+                    pbar.set_description(desc)
 
         metric_means["mean"] = np.mean(val_metrics["ct"] + val_metrics["mr"])
         metric_means["ct"] = np.mean(val_metrics["ct"]) if len(val_metrics["ct"]) > 0 else np.nan
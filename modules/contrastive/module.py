@@ -5,16 +5,17 @@ from pathlib import Path
 from typing import Literal
 
 import torch
-from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss
 from torch import nn
 from torch.nn.modules.loss import _Loss
 from torch.optim import SGD, Adam, AdamW
 
-from lib.cyclegan.utils import load_cyclegan
+from lib.cyclegan.utils import get_shared_cyclegan
 from lib.loss.info_nce import InfoNCE
 from lib.loss.target_adaptative_loss import TargetAdaptativeLoss
 from lib.misc import Concat
+from lib.runtime import resolve_device
+from lib.sliding_window import sliding_window_inference
 
 
 class ContrasiveModule(nn.Module):
@@ -22,20 +23,22 @@ class ContrasiveModule(nn.Module):
         self,
         net: nn.Module = None,
         roi_size: tuple = (512, 512),
-        sw_batch_size: int = 1,
+        sw_batch_size: int | Literal["auto"] = 1,
         ct_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 1, 2]),
         mr_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 3]),
         contrast_loss: _Loss = InfoNCE(negative_mode="unpaired"),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pretrained: Path | None = None,
+        queue_size: int = 0,
+        queue_update_size: int = 64,
     ):
         super().__init__()
         self.roi_size = roi_size
         self.sw_batch_size = sw_batch_size
 
-        net = net.to(device)
+        net = net.to(resolve_device(device))
         self.encoder = net.encoder  # feature extractor
         self.decoder = (
             Concat(net.decoder, net.segmentation_head) if getattr(net, "segmentation_head") else net.decoder
@@ -60,15 +63,19 @@ class ContrasiveModule(nn.Module):
         if pretrained:
             self.load(pretrained)
 
-        # placeholders for prototypes
-        self.ct_prototypes = {}
-        self.ct_cluster_features = {}
-        self.mr_prototypes = {}
-        self.mr_cluster_features = {}
+        # Prototype bank of shape (num_domains, num_classes, feature_dim), where domain 0 is CT and domain 1 is MR,
+        # and whether each prototype has been observed. Both are allocated by the updater at the first step.
+        self.register_buffer("prototypes", None, persistent=False)
+        self.register_buffer("prototype_valid", None, persistent=False)
 
-        # temperatures used when calculating NCE for each cluster
-        self.ct_prototypes_t = {}
-        self.mr_prototypes_t = {}
+        # MoCo-style ring buffer of past pixel features for negatives, of shape
+        # (num_domains, num_classes, queue_size, feature_dim), with the enqueue pointer and the number of filled
+        # entries of each queue. At most `queue_update_size` features of each queue are enqueued per step.
+        self.queue_size = queue_size
+        self.queue_update_size = min(queue_update_size, queue_size)
+        self.register_buffer("feature_queue", None, persistent=False)
+        self.register_buffer("queue_ptr", None, persistent=False)
+        self.register_buffer("queue_filled", None, persistent=False)
 
     def forward(self, x):
         encoded = self.encoder(x)
@@ -79,14 +86,45 @@ class ContrasiveModule(nn.Module):
         self.encoder.train(mode)
         self.decoder.train(mode)
 
+    # Include the prototypes and the feature queues in the state dict of the module,
+    # so that they are saved with the training state
+    def get_extra_state(self):
+        return {name: getattr(self, name) for name in self.extra_state_names}
+
+    def set_extra_state(self, state):
+        device = next(self.encoder.parameters()).device
+        if "prototypes" not in state:
+            # The per-class prototype dicts of former training states are not restored, but estimated again
+            return
+        for name in self.extra_state_names:
+            value = state.get(name)
+            setattr(self, name, value.to(device) if torch.is_tensor(value) else None)
+
+    @property
+    def extra_state_names(self):
+        return ("prototypes", "prototype_valid", "feature_queue", "queue_ptr", "queue_filled")
+
+    # The memory of the feature queues in bytes
+    def get_queue_memory(self):
+        if self.feature_queue is None:
+            return 0
+        return self.feature_queue.numel() * self.feature_queue.element_size()
+
     def inference(self, x, modality):
         # Inference using the sliding window approach
         self.eval()
         return sliding_window_inference(x, self.roi_size, self.sw_batch_size, self.forward)
 
     def save(self, checkpoint_dir):
-        torch.save(self.encoder.state_dict(), os.path.join(checkpoint_dir, "encoder_state.pth"))
-        torch.save(self.decoder.state_dict(), os.path.join(checkpoint_dir, "decoder_state.pth"))
+        for filename, state_dict in self.get_state_dicts().items():
+            torch.save(state_dict, os.path.join(checkpoint_dir, filename))
+
+    # Collect the state dicts of the model components, keyed by their file names
+    def get_state_dicts(self):
+        return {
+            "encoder_state.pth": self.encoder.state_dict(),
+            "decoder_state.pth": self.decoder.state_dict(),
+        }
 
     def load(self, checkpoint_dir):
         try:
@@ -102,6 +140,12 @@ class ContrasiveModule(nn.Module):
         print("Optimizer:", self.optimizer.__class__.__name__, f"(lr = {self.lr})")
         print("Segmentation Loss:", {"ct": self.ct_criterion, "mr": self.mr_criterion})
         print("Contrastive Loss:", self.contrast_loss)
+        if self.queue_size > 0:
+            if self.feature_queue is not None:
+                memory = f"{tuple(self.feature_queue.shape)}, {self.get_queue_memory() / 2**20:.1f} MiB"
+            else:
+                memory = "allocated at the first step"
+            print("Feature Queue:", f"{self.queue_size} features per class and modality ({memory})")
 
 
 class CycleGanContrasiveModule(ContrasiveModule):
@@ -110,19 +154,32 @@ class CycleGanContrasiveModule(ContrasiveModule):
         cyclegan_checkpoints_dir: str,
         net: nn.Module = None,
         roi_size: tuple = (512, 512),
-        sw_batch_size: int = 1,
+        sw_batch_size: int | Literal["auto"] = 1,
         ct_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 1, 2]),
         mr_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 3]),
         contrast_loss: _Loss = InfoNCE(negative_mode="unpaired"),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pretrained: Path | None = None,
+        queue_size: int = 0,
+        queue_update_size: int = 64,
     ):
         super().__init__(
-            net, roi_size, sw_batch_size, ct_criterion, mr_criterion, contrast_loss, optimizer, lr, device, pretrained
+            net,
+            roi_size,
+            sw_batch_size,
+            ct_criterion,
+            mr_criterion,
+            contrast_loss,
+            optimizer,
+            lr,
+            device,
+            pretrained,
+            queue_size,
+            queue_update_size,
         )
-        self.cyclegan = load_cyclegan(cyclegan_checkpoints_dir, which_epoch="latest")
+        self.cyclegan = get_shared_cyclegan(cyclegan_checkpoints_dir, which_epoch="latest")
         self.dice2 = DiceCELoss(softmax=True, to_onehot_y=True)
 
     def forward(self, x):
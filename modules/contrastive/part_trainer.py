@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import random
 from typing import Literal
 
 import numpy as np
@@ -9,27 +8,11 @@ from monai.metrics import DiceMetric, Metric
 from torch import Tensor
 from tqdm import tqdm
 
+from lib.datasets.batch_stream import BatchStream, get_batch
 from modules.base.trainer import SmatDatasetTrainer, TrainLogger
 from modules.base.validator import BaseValidator
 
 
-def get_batch(ct_dataloader, mr_dataloader, mode):
-    if mode == "sequential":
-        batch1 = next(iter(ct_dataloader))
-        batch2 = next(iter(mr_dataloader))
-    elif mode == "random_swap":
-        batch1 = next(iter(ct_dataloader))
-        batch2 = next(iter(mr_dataloader))
-        if random.random() > 0.5:
-            batch1, batch2 = batch2, batch1
-    elif mode == "random_choice":
-        batch1 = next(iter(ct_dataloader)) if np.random.random(1) < 0.5 else next(iter(mr_dataloader))
-        batch2 = next(iter(ct_dataloader)) if np.random.random(1) < 0.5 else next(iter(mr_dataloader))
-    else:
-        raise ValueError("Invalid mode.")
-    return batch1, batch2
-
-
 class PartTrainerContrastive(SmatDatasetTrainer):
     def __init__(
         self,
@@ -37,11 +20,27 @@ class PartTrainerContrastive(SmatDatasetTrainer):
         eval_step: int = 100,
         metric: Metric = DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
         checkpoint_dir: str = "./checkpoints/",
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         dev: bool = False,
         validator: BaseValidator | None = None,
+        async_logging: bool = False,
+        keep_last: int = 0,
+        keep_best: int = 1,
+        async_checkpoint: bool = True,
     ):
-        super().__init__(max_iter, eval_step, metric, validator, checkpoint_dir, device, dev)
+        super().__init__(
+            max_iter,
+            eval_step,
+            metric,
+            validator,
+            checkpoint_dir,
+            device,
+            dev,
+            async_logging,
+            keep_last,
+            keep_best,
+            async_checkpoint,
+        )
         self.pbar_description = (
             "Training ({step} / {max_iter} Steps) ({modality1},{modality2})"
             "(seg_loss={seg_loss:2.5f}, nce_loss={nce_loss:2.5f})"
@@ -67,29 +66,41 @@ class PartTrainerContrastive(SmatDatasetTrainer):
         *,
         ct_dataloader: tuple[DataLoader, DataLoader] | None = None,
         mr_dataloader: tuple[DataLoader, DataLoader] | None = None,
+        resume_from: str | None = None,
     ):
         # Display training information and initialize metrics
         self.show_training_info(module, ct_dataloader=ct_dataloader, mr_dataloader=mr_dataloader)
 
-        # Initalize progress bar and tensorboard writer
-        train_pbar = tqdm(range(self.max_iter), dynamic_ncols=True)
-        logger = TrainLogger(self.checkpoint_dir)
+        # Initalize logger and checkpoint manager
+        logger = TrainLogger(self.checkpoint_dir, asynchronous=self.async_logging)
+        checkpoint = self.get_checkpoint_manager()
 
         # Initial stage. Note: updater(module) checks the module and returns a partial func of updating parameters.
         best_metric = 0
         module_update = updater(module)
 
+        # Keep the iterators of training dataloaders alive across steps
+        ct_stream, mr_stream = BatchStream(ct_dataloader[0]), BatchStream(mr_dataloader[0])
+
+        # Resume from the saved training state if specified
+        start_step = 0
+        if resume_from:
+            start_step, best_metric = self.resume(resume_from, module, updater, streams=(ct_stream, mr_stream))
+            logger.info(f"Training resumed from {resume_from} at step {start_step}")
+        train_pbar = tqdm(range(start_step, self.max_iter), initial=start_step, total=self.max_iter, dynamic_ncols=True)
+
         # Main training loop
         for step in train_pbar:
             module.train()
 
             # Load batches based on sampling mode
-            batch1, batch2 = get_batch(ct_dataloader[0], mr_dataloader[0], mode=updater.sampling_mode)
+            batch1, batch2 = get_batch(ct_stream, mr_stream, mode=updater.sampling_mode)
             images = Tensor(batch1["image"]).to(self.device), Tensor(batch2["image"]).to(self.device)
             masks = Tensor(batch1["label"]).to(self.device), Tensor(batch2["label"]).to(self.device)
             modalities = batch1["modality"], batch2["modality"]
 
-            # Adjust gradient reversal layer lambda based on training progress
+            # Schedule the loss weights based on training progress
+            updater.set_progress(step, self.max_iter)
             seg_loss, nce_loss = module_update(images, masks, modalities)
 
             # Update training progress description
@@ -125,8 +136,8 @@ class PartTrainerContrastive(SmatDatasetTrainer):
                     val_metric = val_metrics["mean"]
 
                 # Update best metric
+                checkpoint.save(module, step, val_metric, is_best=val_metric > best_metric)
                 if val_metric > best_metric:
-                    module.save(self.checkpoint_dir)
                     logger.success(
                         f"Model saved! Validation: (New) {val_metric:2.7f} > (Old) {best_metric:2.7f} "
                         f"(CT) {val_metrics['ct']:2.7f} (MR) {val_metrics['mr']:2.7f}"
@@ -137,3 +148,11 @@ class PartTrainerContrastive(SmatDatasetTrainer):
                         f"No improvement. Validation: (New) {val_metric:2.7f} <= (Old) {best_metric:2.7f} "
                         f"(CT) {val_metrics['ct']:2.7f} (MR) {val_metrics['mr']:2.7f}"
                     )
+
+                # Save the complete training state to resume from
+                checkpoint.save_state(
+                    self.get_training_state(module, updater, step, best_metric, streams=(ct_stream, mr_stream))
+                )
+
+        checkpoint.wait()
+        logger.close()
@@ -10,18 +10,63 @@ from torch import nn
 from torch.nn import functional as F
 from torch.nn.modules.loss import _Loss
 
+from lib.cyclegan.translation_cache import TranslationCache
 from lib.cyclegan.utils import load_cyclegan
-from lib.loss.info_nce import InfoNCE
+from lib.loss.info_nce import InfoNCE, sample_per_class
 from lib.loss.target_adaptative_loss import TargetAdaptativeLoss
+from lib.pseudo_label import PseudoLabelProvider
 from lib.tensor_shape import tensor
 from modules.base import BaseUpdater
 from modules.contrastive.module import CycleGanContrasiveModule
 
 
 class PartUpdaterCycleGanContrasive(BaseUpdater):
-    def __init__(self):
-        super().__init__()
+    def __init__(
+        self,
+        amp: bool = False,
+        amp_dtype: Literal["float16", "bfloat16"] | None = None,
+        channels_last: bool = False,
+        fused_backward: bool = True,
+        loss_weights: dict[str, float] | None = None,
+        loss_schedules: dict[str, Literal["constant", "linear", "sigmoid"]] | None = None,
+        translation_cache_size: int = 0,
+        translation_cache_dir: str | None = None,
+        translation_cache_write: bool = False,
+        pseudo_label_ema_decay: float | None = None,
+        pseudo_label_interval: int = 1,
+        pseudo_label_cache_size: int = 4096,
+    ):
+        super().__init__(amp, amp_dtype, channels_last, fused_backward, loss_weights, loss_schedules)
         self.sampling_mode = "sequential"
+        self.translation_cache_size = translation_cache_size
+        self.translation_cache_dir = translation_cache_dir
+        self.translation_cache_write = translation_cache_write
+
+        # Pseudo labels of the translated images are predicted without gradients,
+        # optionally by an EMA teacher and refreshed every `pseudo_label_interval` steps
+        self.pseudo_label_ema_decay = pseudo_label_ema_decay
+        self.pseudo_label_interval = pseudo_label_interval
+        self.pseudo_label_cache_size = pseudo_label_cache_size
+
+    def register_module(self, module):
+        update = super().register_module(module)
+        self.translator = TranslationCache(
+            module.cyclegan,
+            self.translation_cache_size,
+            self.translation_cache_dir,
+            self.translation_cache_write,
+        )
+        self.pseudo_labeler = PseudoLabelProvider(
+            self.pseudo_label_ema_decay, self.pseudo_label_interval, self.pseudo_label_cache_size
+        ).register_module(module)
+        return update
+
+    def state_dict(self) -> dict:
+        return {**super().state_dict(), "pseudo_labeler": self.pseudo_labeler.state_dict()}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        super().load_state_dict(state_dict)
+        self.pseudo_labeler.load_state_dict(state_dict.get("pseudo_labeler", {}))
 
     def check_module(self, module):
         # super().check_module(module)
@@ -38,160 +83,161 @@ class PartUpdaterCycleGanContrasive(BaseUpdater):
         masks = list(masks)
         module.optimizer.zero_grad()
 
-        ct, mr = "A", "B"
-        fake_mr = module.cyclegan.generate_image(input_image=images[0], from_domain=ct)
-        fake_ct = module.cyclegan.generate_image(input_image=images[1], from_domain=mr)
+        images = self.prepare(images)
+        with self.autocast():
+            ct, mr = "A", "B"
+            fake_mr = self.translator.translate(images[0], from_domain=ct)
+            fake_ct = self.translator.translate(images[1], from_domain=mr)
 
-        for i in (0, 1):
-            m = modalities[i][0]
+            for i in (0, 1):
+                m = modalities[i][0]
 
-            if m == "ct":
-                ct_encoded = module.encoder(images[i])
-                ct_output = module.decoder(*ct_encoded)
-                ct_feature = ct_encoded[-1] if isinstance(ct_encoded, (list, tuple)) else ct_encoded
-                ct_seg_loss = module.ct_criterion(ct_output, masks[i])
-
-                if ct_seg_loss.isnan():
-                    breakpoint()
-
-                fake_mr.require_grad = False
-                pseudo_softmax = module.decoder(*module.encoder(fake_mr))
-                ct_pseudo_label = masks[i] + torch.argmax(pseudo_softmax, dim=1, keepdim=True) * (masks[i] == 0)
-                ct_seg_loss += module.dice2(ct_output, ct_pseudo_label)
-
-                if ct_seg_loss.isnan():
-                    breakpoint()
-
-            else:
-                mr_encoded = module.encoder(images[i])
-                mr_output = module.decoder(*mr_encoded)
-                mr_feature = mr_encoded[-1] if isinstance(mr_encoded, (list, tuple)) else mr_encoded
-                mr_seg_loss = module.mr_criterion(mr_output, masks[i])
-
-                if mr_seg_loss.isnan():
-                    breakpoint()
-
-                fake_ct.require_grad = False
-                pseudo_softmax = module.decoder(*module.encoder(fake_ct))
-                mr_pseudo_label = masks[i] + torch.argmax(pseudo_softmax, dim=1, keepdim=True) * (masks[i] == 0)
-                mr_seg_loss += module.dice2(mr_output, mr_pseudo_label)
-
-                if mr_seg_loss.isnan():
-                    breakpoint()
+                if m == "ct":
+                    ct_encoded = module.encoder(images[i])
+                    ct_output = module.decoder(*ct_encoded)
+                    ct_feature = ct_encoded[-1] if isinstance(ct_encoded, (list, tuple)) else ct_encoded
+                    ct_seg_loss = module.ct_criterion(ct_output, masks[i])
+
+                    pseudo_label = self.pseudo_labeler.get_labels(module, fake_mr)
+                    ct_pseudo_label = masks[i] + pseudo_label * (masks[i] == 0)
+                    ct_seg_loss += module.dice2(ct_output, ct_pseudo_label)
+                else:
+                    mr_encoded = module.encoder(images[i])
+                    mr_output = module.decoder(*mr_encoded)
+                    mr_feature = mr_encoded[-1] if isinstance(mr_encoded, (list, tuple)) else mr_encoded
+                    mr_seg_loss = module.mr_criterion(mr_output, masks[i])
 
-        seg_loss = ct_seg_loss + mr_seg_loss
-        seg_loss.backward(retain_graph=True)
+                    pseudo_label = self.pseudo_labeler.get_labels(module, fake_ct)
+                    mr_pseudo_label = masks[i] + pseudo_label * (masks[i] == 0)
+                    mr_seg_loss += module.dice2(mr_output, mr_pseudo_label)
 
-        # Prototypical Contrastive
+            seg_loss = ct_seg_loss + mr_seg_loss
 
-        n, c, h, w = ct_feature.shape
-        nhw = n * h * w
+        # Prototypical Contrastive (in full precision)
         num_classes = ct_output.shape[1]
-        # alpha = 10
         momentum = 0.9
 
+        # Flatten the features and the pseudo labels of both domains (0: CT, 1: MR) into pixels
+        features, labels, domains = [], [], []
         for j in (0, 1):
             m = modalities[j][0]
-            if m == "ct":
-                resized_label: tensor[n, c, h, w] = F.interpolate(ct_pseudo_label, size=(h, w))
-                feature: tensor[nhw, c] = ct_feature.transpose(1, -1).reshape(-1, c)
-            else:
-                resized_label: tensor[n, c, h, w] = F.interpolate(mr_pseudo_label, size=(h, w))
-                feature: tensor[nhw, c] = mr_feature.transpose(1, -1).reshape(-1, c)
-
-            label_flatten: tensor[nhw] = resized_label.transpose(1, -1).reshape(-1)
-
-            for i in range(num_classes):
-                # z = torch.sum(label_flatten == i)  # cluster size
-                cluster_features = F.normalize(feature[label_flatten == i], dim=1)
-                cluster_prototype = cluster_features.mean(dim=0)
-                # cluster_t = (cluster_features - cluster_prototype).norm(dim=1).sum() / (z * np.log(z + alpha))
-                if m == "ct":
-                    module.ct_cluster_features[i] = cluster_features
-                    module.ct_prototypes[i] = update_tensor(
-                        module.ct_prototypes.get(i, None), cluster_prototype, momentum
-                    )
-                    # module.ct_prototypes_t[i] = cluster_t
-                else:
-                    module.mr_cluster_features[i] = cluster_features
-                    module.mr_prototypes[i] = update_tensor(
-                        module.mr_prototypes.get(i, None), cluster_prototype, momentum
-                    )
-                    # module.mr_prototypes_t[i] = cluster_t
-
-        nce_loss = 0
-        for k in range(num_classes):
-            # Compute Contrastive loss for CT features
-            query = module.ct_cluster_features[k]
-            # If query is not empty
-            if len(query) > 0:
-
-                if no_nan_in(module.mr_prototypes[k]):
-                    positive_key = module.mr_prototypes[k]
-                else:
-                    positive_key = module.ct_prototypes[k]
-
-                negative_keys = []
-                for j in range(num_classes):
-                    if j != k:
-                        if no_nan_in(module.ct_prototypes[j]):
-                            negative_keys.append(module.ct_prototypes[j])
-                        elif no_nan_in(module.mr_prototypes[j]):
-                            negative_keys.append(module.mr_prototypes[j])
-                        else:
-                            # there is no prototype of this class (from both modality), skip to next category
-                            pass
-                negative_keys = torch.vstack(negative_keys).detach().clone()
-                negative_keys.requires_grad = False
-
-                nce_loss += module.contrast_loss(query, positive_key, negative_keys, temperature=0.1)
-
-            # Compute Contrastive loss for MR features
-            query = module.mr_cluster_features[k]
-            # If query is not empty
-            if len(query) > 0:
-
-                if no_nan_in(module.ct_prototypes[k]):
-                    positive_key = module.ct_prototypes[k]
-                else:
-                    positive_key = module.mr_prototypes[k]
-
-                negative_keys = []
-                for j in range(num_classes):
-                    if j != k:
-                        if no_nan_in(module.mr_prototypes[j]):
-                            negative_keys.append(module.mr_prototypes[j])
-                        elif no_nan_in(module.mr_prototypes[j]):
-                            negative_keys.append(module.ct_prototypes[j])
-                        else:
-                            # there is no prototype of this class (from both modality), skip to next category
-                            pass
-                negative_keys = torch.vstack(negative_keys).detach().clone()
-                negative_keys.requires_grad = False
-
-                nce_loss += module.contrast_loss(query, positive_key, negative_keys, temperature=0.1)
-                # nce_loss *= 2
-
-        nce_loss.backward(retain_graph=True)
-        module.optimizer.step()
-        return seg_loss.item(), nce_loss.item()
-
-
-def no_nan_in(x):
-    return ~x.isnan().any()
-
-
-def update_tensor(x, x_new, momentum):
-    x_new = x_new.detach().clone()
-    x_new.require_grad = False
-    if x is None:
-        return x_new
-
-    x = x.detach().clone()
-    x.require_grad = False
-    if x.isnan().any():
-        return x_new
-    elif x_new.isnan().any():
-        return x
-    else:
-        return x * momentum + x_new * (1 - momentum)
+            feature, pseudo_label = (ct_feature, ct_pseudo_label) if m == "ct" else (mr_feature, mr_pseudo_label)
+            n, c, h, w = feature.shape
+            resized_label: tensor[n, 1, h, w] = F.interpolate(pseudo_label, size=(h, w))
+            features.append(feature.float().transpose(1, -1).reshape(-1, c))
+            labels.append(resized_label.transpose(1, -1).reshape(-1).long())
+            domains.append(torch.full_like(labels[-1], 0 if m == "ct" else 1))
+        label_flatten = torch.cat(labels)
+        nhw = len(label_flatten)
+        query: tensor[nhw, c] = F.normalize(torch.cat(features), dim=1)
+        domain_flatten: tensor[nhw] = torch.cat(domains)
+
+        # Update the prototype bank with the means of the normalized features of each (domain, class) at once
+        cluster_index: tensor[nhw] = domain_flatten * num_classes + label_flatten
+        cluster_prototypes, cluster_sizes = segment_means(query.detach(), cluster_index, 2 * num_classes)
+        update_prototypes(module, cluster_prototypes.view(2, num_classes, -1), cluster_sizes.view(2, -1) > 0, momentum)
+
+        # The positive key of a class is the prototype of the other domain (or of the same domain if not observed),
+        # and the negative keys are the prototypes of the other classes of the same domain (or of the other domain)
+        prototypes, valid = module.prototypes, module.prototype_valid
+        other_prototypes, other_valid = prototypes.flip(0), valid.flip(0)
+        positive_keys = torch.where(other_valid[..., None], other_prototypes, prototypes)
+        negative_keys = torch.where(valid[..., None], prototypes, other_prototypes)
+        negative_valid = valid | other_valid
+
+        positive_key: tensor[nhw, c] = positive_keys.view(2 * num_classes, -1)[cluster_index]
+
+        # Subsample the query pixels of each cluster by the query budget of the contrastive loss, if any
+        sample_queries = getattr(module.contrast_loss, "sample_queries", None)
+        index = sample_queries(query, positive_key, cluster_index) if sample_queries else None
+        if index is not None:
+            query, positive_key, cluster_index = query[index], positive_key[index], cluster_index[index]
+
+        # Compute the InfoNCE of all pixels against the negative keys of their domain in a single call,
+        # where the keys of the other domain, of their own class and of unobserved classes are masked out
+        negative_index = torch.arange(2 * num_classes, device=query.device)
+        negative_mask: tensor[nhw, 2 * num_classes] = (
+            (negative_index // num_classes == cluster_index[:, None] // num_classes)
+            & (negative_index != cluster_index[:, None])
+            & negative_valid.view(1, -1)
+        )
+        negative_keys = negative_keys.view(2 * num_classes, -1)
+
+        # Add the queued features of the other classes of both domains as negative keys
+        if module.feature_queue is not None:
+            queue_index = torch.arange(module.queue_size, device=query.device)
+            queue_valid = queue_index < module.queue_filled[..., None]
+            queue_class = torch.arange(num_classes, device=query.device)[:, None].expand_as(queue_valid)
+            negative_keys = torch.concat([negative_keys, module.feature_queue[queue_valid]])
+            negative_mask = torch.concat(
+                [negative_mask, queue_class[queue_valid] != cluster_index[:, None] % num_classes], dim=1
+            )
+
+        pixel_nce = module.contrast_loss(
+            query,
+            positive_key,
+            negative_keys,
+            temperature=0.1,
+            negative_mask=negative_mask,
+            reduction="none",
+        )
+
+        # Enqueue the features of this step, after they are compared with the former ones
+        if module.queue_size > 0:
+            enqueue_features(module, query.detach(), cluster_index, num_classes)
+
+        # Sum up the mean InfoNCE of each (domain, class) cluster
+        cluster_nce, _ = segment_means(pixel_nce[:, None], cluster_index, 2 * num_classes)
+        nce_loss = cluster_nce.sum()
+
+        # Back-propagate the weighted losses, in a single pass if fused_backward
+        losses = self.backward_losses({"seg_loss": seg_loss, "nce_loss": nce_loss})
+        self.step(module.optimizer)
+        self.pseudo_labeler.step(module)
+        return losses["seg_loss"], losses["nce_loss"]
+
+
+def segment_means(x: torch.Tensor, index: torch.Tensor, num_segments: int) -> tuple[torch.Tensor, torch.Tensor]:
+    """The means of the rows of `x` by segment index, and the sizes of segments. Empty segments have zero means."""
+    sums = torch.zeros(num_segments, x.shape[1], dtype=x.dtype, device=x.device).index_add_(0, index, x)
+    sizes = torch.bincount(index, minlength=num_segments)
+    return sums / sizes.clamp(min=1)[:, None], sizes
+
+
+@torch.no_grad()
+def update_prototypes(module, new_prototypes: torch.Tensor, observed: torch.Tensor, momentum: float) -> None:
+    """
+    Update the prototype bank of the module by exponential moving average, where prototypes observed for the first
+    time are taken as is, and prototypes not observed in the batch are kept.
+    """
+    if module.prototypes is None or module.prototypes.shape != new_prototypes.shape:
+        module.prototypes = torch.zeros_like(new_prototypes)
+        module.prototype_valid = torch.zeros_like(observed)
+    prototypes, valid = module.prototypes, module.prototype_valid
+    average = torch.where(valid[..., None], prototypes * momentum + new_prototypes * (1 - momentum), new_prototypes)
+    prototypes.copy_(torch.where(observed[..., None], average, prototypes))
+    valid |= observed
+
+
+@torch.no_grad()
+def enqueue_features(module, features: torch.Tensor, cluster_index: torch.Tensor, num_classes: int) -> None:
+    """
+    Enqueue at most `queue_update_size` random features of each (domain, class) cluster into the ring buffers of
+    the module at once, where the oldest features are overwritten.
+    """
+    num_clusters, queue_size = 2 * num_classes, module.queue_size
+    if module.feature_queue is None or module.feature_queue.shape[-1] != features.shape[1]:
+        module.feature_queue = features.new_zeros(2, num_classes, queue_size, features.shape[1])
+        module.queue_ptr = torch.zeros(2, num_classes, dtype=torch.long, device=features.device)
+        module.queue_filled = torch.zeros(2, num_classes, dtype=torch.long, device=features.device)
+
+    # The sampled features are sorted by cluster, so they are written after the pointer of the cluster by rank
+    index = sample_per_class(cluster_index, module.queue_update_size)
+    clusters = cluster_index[index]
+    sizes = torch.bincount(clusters, minlength=num_clusters)
+    ranks = torch.arange(len(index), device=features.device) - (torch.cumsum(sizes, dim=0) - sizes)[clusters]
+    ptr, filled = module.queue_ptr.view(-1), module.queue_filled.view(-1)
+    positions = (ptr[clusters] + ranks) % queue_size
+    module.feature_queue.view(num_clusters, queue_size, -1)[clusters, positions] = features[index]
+    ptr.copy_((ptr + sizes) % queue_size)
+    filled.copy_((filled + sizes).clamp(max=queue_size))
@@ -8,8 +8,10 @@ from monai.losses import DiceCELoss
 from torch import nn
 from torch.nn.modules.loss import _Loss
 
-from lib.cyclegan.utils import load_cyclegan
+from lib.cyclegan.translation_cache import TranslationCache
+from lib.cyclegan.utils import get_shared_cyclegan
 from lib.loss.target_adaptative_loss import TargetAdaptativeLoss
+from lib.pseudo_label import PseudoLabelProvider
 from modules.dann.module import DANNModule
 from modules.dann.part_updater import PartUpdaterDANN
 
@@ -29,13 +31,13 @@ class CycleGanDANNModule(DANNModule):
             nn.AdaptiveAvgPool2d(output_size=1),
         ),
         roi_size: tuple = (512, 512),
-        sw_batch_size: int = 1,
+        sw_batch_size: int | Literal["auto"] = 1,
         ct_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 1, 2]),
         mr_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 3]),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
         default_forward_branch: int = 0,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pretrained: Path | None = None,
     ):
         super().__init__(
@@ -51,7 +53,7 @@ class CycleGanDANNModule(DANNModule):
             device=device,
             pretrained=pretrained,
         )
-        self.cyclegan = load_cyclegan(cyclegan_checkpoints_dir, which_epoch="latest")
+        self.cyclegan = get_shared_cyclegan(cyclegan_checkpoints_dir, which_epoch="latest")
         self.dice2 = DiceCELoss(softmax=True, to_onehot_y=True)
 
 
@@ -59,9 +61,37 @@ class PartUpdaterCycleGanDANN(PartUpdaterDANN):
     def __init__(
         self,
         pixel_level_adv: bool = False,
+        amp: bool = False,
+        amp_dtype: Literal["float16", "bfloat16"] | None = None,
+        channels_last: bool = False,
+        fused_backward: bool = True,
+        loss_weights: dict[str, float] | None = None,
+        loss_schedules: dict[str, Literal["constant", "linear", "sigmoid"]] | None = None,
+        translation_cache_size: int = 0,
+        translation_cache_dir: str | None = None,
+        translation_cache_write: bool = False,
+        pseudo_label_ema_decay: float | None = None,
+        pseudo_label_interval: int = 1,
+        pseudo_label_cache_size: int = 4096,
     ):
-        super().__init__()
+        super().__init__(
+            amp=amp,
+            amp_dtype=amp_dtype,
+            channels_last=channels_last,
+            fused_backward=fused_backward,
+            loss_weights=loss_weights,
+            loss_schedules=loss_schedules,
+        )
         self.sampling_mode = "sequential"
+        self.translation_cache_size = translation_cache_size
+        self.translation_cache_dir = translation_cache_dir
+        self.translation_cache_write = translation_cache_write
+
+        # Pseudo labels of the translated images are predicted without gradients,
+        # optionally by an EMA teacher and refreshed every `pseudo_label_interval` steps
+        self.pseudo_label_ema_decay = pseudo_label_ema_decay
+        self.pseudo_label_interval = pseudo_label_interval
+        self.pseudo_label_cache_size = pseudo_label_cache_size
 
         # instead of predicting domain label of the whole image
         # predict the domain label of all pixels
@@ -73,6 +103,26 @@ class PartUpdaterCycleGanDANN(PartUpdaterDANN):
         # grl_lambda = 2.0 / (1.0 + np.exp(-8 * p)) - 1
         return p
 
+    def register_module(self, module):
+        update = super().register_module(module)
+        self.translator = TranslationCache(
+            module.cyclegan,
+            self.translation_cache_size,
+            self.translation_cache_dir,
+            self.translation_cache_write,
+        )
+        self.pseudo_labeler = PseudoLabelProvider(
+            self.pseudo_label_ema_decay, self.pseudo_label_interval, self.pseudo_label_cache_size
+        ).register_module(module)
+        return update
+
+    def state_dict(self) -> dict:
+        return {**super().state_dict(), "pseudo_labeler": self.pseudo_labeler.state_dict()}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        super().load_state_dict(state_dict)
+        self.pseudo_labeler.load_state_dict(state_dict.get("pseudo_labeler", {}))
+
     def check_module(self, module):
         super().check_module(module)
         assert isinstance(module, CycleGanDANNModule), "The specified module should inherit CycleGanDANNModule."
@@ -84,53 +134,56 @@ class PartUpdaterCycleGanDANN(PartUpdaterDANN):
         masks = list(masks)
         module.optimizer.zero_grad()
 
-        ct, mr = "A", "B"
-        fake_mr = module.cyclegan.generate_image(input_image=images[0], from_domain=ct)
-        fake_ct = module.cyclegan.generate_image(input_image=images[1], from_domain=mr)
+        images = self.prepare(images)
+        with self.autocast():
+            ct, mr = "A", "B"
+            fake_mr = self.translator.translate(images[0], from_domain=ct)
+            fake_ct = self.translator.translate(images[1], from_domain=mr)
+
+            for i in (0, 1):
+                m = modalities[i][0]
+
+                if m == "ct":
+                    ct_encoded = module.encoder(images[i])
+                    ct_output = module.decoder(*ct_encoded)
+                    ct_feature = ct_encoded[-1] if isinstance(ct_encoded, (list, tuple)) else ct_encoded
+                    ct_seg_loss = module.ct_criterion(ct_output, masks[i])
+
+                    pseudo_label = self.pseudo_labeler.get_labels(module, fake_mr)
+                    pseudo_label = masks[i] + pseudo_label * (masks[i] == 0)
+                    ct_seg_loss += module.dice2(ct_output, pseudo_label)
+                else:
+                    mr_encoded = module.encoder(images[i])
+                    mr_output = module.decoder(*mr_encoded)
+                    mr_feature = mr_encoded[-1] if isinstance(mr_encoded, (list, tuple)) else mr_encoded
+                    mr_seg_loss = module.mr_criterion(mr_output, masks[i])
+
+                    pseudo_label = self.pseudo_labeler.get_labels(module, fake_ct)
+                    pseudo_label = masks[i] + pseudo_label * (masks[i] == 0)
+                    mr_seg_loss += module.dice2(mr_output, pseudo_label)
+
+            seg_loss = ct_seg_loss + mr_seg_loss
+
+            # Compute adversarial loss for domain classification
+            if not self.pixel_level_adv:
+                ct_dom_pred_logits = module.dom_classifier(module.grl.apply(ct_feature))
+                mr_dom_pred_logits = module.dom_classifier(module.grl.apply(mr_feature))
+            else:
+                ct_dom_pred_logits = module.dom_classifier(None, module.grl.apply(ct_feature))
+                mr_dom_pred_logits = module.dom_classifier(None, module.grl.apply(mr_feature))
 
-        for i in (0, 1):
-            m = modalities[i][0]
+            # Combine domain predictions and true labels
+            ct_shape, mr_shape = ct_dom_pred_logits.shape, mr_dom_pred_logits.shape
+            dom_pred_logits = torch.cat([ct_dom_pred_logits, mr_dom_pred_logits])
+            device = dom_pred_logits.device
+            dom_true_label = torch.cat((torch.ones(ct_shape, device=device), torch.zeros(mr_shape, device=device)))
 
-            if m == "ct":
-                ct_encoded = module.encoder(images[i])
-                ct_output = module.decoder(*ct_encoded)
-                ct_feature = ct_encoded[-1] if isinstance(ct_encoded, (list, tuple)) else ct_encoded
-                ct_seg_loss = module.ct_criterion(ct_output, masks[i])
+            # Calculate adversarial loss
+            adv_loss = module.adv_loss(dom_pred_logits, dom_true_label)
 
-                fake_mr.require_grad = False
-                pseudo_softmax = module.decoder(*module.encoder(fake_mr))
-                pseudo_label = masks[i] + torch.argmax(pseudo_softmax, dim=1, keepdim=True) * (masks[i] == 0)
-                ct_seg_loss += module.dice2(ct_output, pseudo_label)
-            else:
-                mr_encoded = module.encoder(images[i])
-                mr_output = module.decoder(*mr_encoded)
-                mr_feature = mr_encoded[-1] if isinstance(mr_encoded, (list, tuple)) else mr_encoded
-                mr_seg_loss = module.mr_criterion(mr_output, masks[i])
-
-                fake_ct.require_grad = False
-                pseudo_softmax = module.decoder(*module.encoder(fake_ct))
-                pseudo_label = masks[i] + torch.argmax(pseudo_softmax, dim=1, keepdim=True) * (masks[i] == 0)
-                mr_seg_loss += module.dice2(mr_output, pseudo_label)
-
-        seg_loss = ct_seg_loss + mr_seg_loss
-        seg_loss.backward(retain_graph=True)
-
-        # Compute adversarial loss for domain classification
-        if not self.pixel_level_adv:
-            ct_dom_pred_logits = module.dom_classifier(module.grl.apply(ct_feature))
-            mr_dom_pred_logits = module.dom_classifier(module.grl.apply(mr_feature))
-        else:
-            ct_dom_pred_logits = module.dom_classifier(None, module.grl.apply(ct_feature))
-            mr_dom_pred_logits = module.dom_classifier(None, module.grl.apply(mr_feature))
-
-        # Combine domain predictions and true labels
-        ct_shape, mr_shape = ct_dom_pred_logits.shape, mr_dom_pred_logits.shape
-        dom_pred_logits = torch.cat([ct_dom_pred_logits, mr_dom_pred_logits])
-        dom_true_label = torch.cat((torch.ones(ct_shape, device="cuda"), torch.zeros(mr_shape, device="cuda")))
-
-        # Calculate adversarial loss and perform backward pass
-        adv_loss = module.adv_loss(dom_pred_logits, dom_true_label)
-        adv_loss.backward()
-
-        module.optimizer.step()
-        return seg_loss.item(), adv_loss.item()
+        # Back-propagate the weighted losses, in a single pass if fused_backward
+        losses = self.backward_losses({"seg_loss": seg_loss, "adv_loss": adv_loss})
+
+        self.step(module.optimizer)
+        self.pseudo_labeler.step(module)
+        return losses["seg_loss"], losses["adv_loss"]
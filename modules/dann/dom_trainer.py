@@ -1,34 +1,16 @@
 from __future__ import annotations
 
-import random
 from typing import Literal
 
-import numpy as np
 from monai.data import DataLoader
 from monai.metrics import DiceMetric, Metric
 from tqdm import tqdm
 
+from lib.datasets.batch_stream import BatchStream, get_batch
 from modules.base.trainer import BaseTrainer, TrainLogger
 from modules.validator.dom_adapt import DomValidator
 
 
-def get_batch(ct_dataloader, mr_dataloader, mode):
-    if mode == "sequential":
-        batch1 = next(iter(ct_dataloader))
-        batch2 = next(iter(mr_dataloader))
-    elif mode == "random_swap":
-        batch1 = next(iter(ct_dataloader))
-        batch2 = next(iter(mr_dataloader))
-        if random.random() > 0.5:
-            batch1, batch2 = batch2, batch1
-    elif mode == "random_choice":
-        batch1 = next(iter(ct_dataloader)) if np.random.random(1) < 0.5 else next(iter(mr_dataloader))
-        batch2 = next(iter(ct_dataloader)) if np.random.random(1) < 0.5 else next(iter(mr_dataloader))
-    else:
-        raise ValueError("Invalid mode.")
-    return batch1, batch2
-
-
 class DomTrainerDANN(BaseTrainer):
     def __init__(
         self,
@@ -36,10 +18,25 @@ class DomTrainerDANN(BaseTrainer):
         eval_step: int = 100,
         metric: Metric = DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
         checkpoint_dir: str = "./checkpoints/",
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         dev: bool = False,
+        async_logging: bool = False,
+        keep_last: int = 0,
+        keep_best: int = 1,
+        async_checkpoint: bool = True,
     ):
-        super().__init__(max_iter, eval_step, metric, checkpoint_dir, device, dev)
+        super().__init__(
+            max_iter,
+            eval_step,
+            metric,
+            checkpoint_dir=checkpoint_dir,
+            device=device,
+            dev=dev,
+            async_logging=async_logging,
+            keep_last=keep_last,
+            keep_best=keep_best,
+            async_checkpoint=async_checkpoint,
+        )
         self.pbar_description = (
             "Training ({step} / {max_iter} Steps) "
             "(grl_lambda={grl_lambda:2.3f}) "
@@ -67,17 +64,28 @@ class DomTrainerDANN(BaseTrainer):
         *,
         ct_dataloader: tuple[DataLoader, DataLoader] | None = None,
         mr_dataloader: tuple[DataLoader, DataLoader] | None = None,
+        resume_from: str | None = None,
     ):
         # Display training information and initialize metrics
         self.show_training_info(module, ct_dataloader=ct_dataloader, mr_dataloader=mr_dataloader)
 
-        # Initalize progress bar, logger and the best result
-        train_pbar = tqdm(range(self.max_iter), dynamic_ncols=True)
-        logger = TrainLogger(self.checkpoint_dir)
+        # Initalize logger, checkpoint manager and the best result
+        logger = TrainLogger(self.checkpoint_dir, asynchronous=self.async_logging)
+        checkpoint = self.get_checkpoint_manager()
         best_metric = 0
         # Note: updater(module) checks the module and returns a partial func of updating parameters.
         module_update = updater(module)
 
+        # Keep the iterators of training dataloaders alive across steps
+        ct_stream, mr_stream = BatchStream(ct_dataloader[0]), BatchStream(mr_dataloader[0])
+
+        # Resume from the saved training state if specified
+        start_step = 0
+        if resume_from:
+            start_step, best_metric = self.resume(resume_from, module, updater, streams=(ct_stream, mr_stream))
+            logger.info(f"Training resumed from {resume_from} at step {start_step}")
+        train_pbar = tqdm(range(start_step, self.max_iter), initial=start_step, total=self.max_iter, dynamic_ncols=True)
+
         # Main training loop
         for step in train_pbar:
             module.train()
@@ -85,13 +93,14 @@ class DomTrainerDANN(BaseTrainer):
             # Load batches based on sampling mode
             # source = batch1 = ct
             # target = batch2 = mr
-            batch1, batch2 = get_batch(ct_dataloader[0], mr_dataloader[0], mode="sequential")
+            batch1, batch2 = get_batch(ct_stream, mr_stream, mode="sequential")
             images = batch1["image"].to(self.device), batch2["image"].to(self.device)
             masks = batch1["label"].to(self.device), batch2["label"].to(self.device)
             modalities = batch1["modality"], batch2["modality"]
 
-            # Adjust gradient reversal layer lambda based on training progress
+            # Adjust gradient reversal layer lambda and loss weights based on training progress
             grl_lambda = updater.grl_lambda(step, self.max_iter)
+            updater.set_progress(step, self.max_iter)
             seg_loss, adv_loss = module_update(images, masks, modalities, alpha=grl_lambda)
 
             # Update training progress description
@@ -116,9 +125,17 @@ class DomTrainerDANN(BaseTrainer):
                 logger.log_val(self.metric, suffix=["Average"], value=[val_metric], step=step)
 
                 # Update best metric
+                checkpoint.save(module, step, val_metric, is_best=val_metric > best_metric)
                 if val_metric > best_metric:
-                    module.save(self.checkpoint_dir)
                     logger.success(f"Model saved! Validation: (New) {val_metric:2.7f} > (Old) {best_metric:2.7f}")
                     best_metric = val_metric
                 else:
                     logger.info(f"No improvement. Validation: (New) {val_metric:2.7f} <= (Old) {best_metric:2.7f}")
+
+                # Save the complete training state to resume from
+                checkpoint.save_state(
+                    self.get_training_state(module, updater, step, best_metric, streams=(ct_stream, mr_stream))
+                )
+
+        checkpoint.wait()
+        logger.close()
@@ -12,8 +12,14 @@ class DomUpdaterDANN(BaseUpdater):
     def __init__(
         self,
         sampling_mode: Literal["sequential", "random_swap", "random_choice"] = "sequential",
+        amp: bool = False,
+        amp_dtype: Literal["float16", "bfloat16"] | None = None,
+        channels_last: bool = False,
+        fused_backward: bool = True,
+        loss_weights: dict[str, float] | None = None,
+        loss_schedules: dict[str, Literal["constant", "linear", "sigmoid"]] | None = None,
     ):
-        super().__init__()
+        super().__init__(amp, amp_dtype, channels_last, fused_backward, loss_weights, loss_schedules)
         self.sampling_mode = sampling_mode
 
     @staticmethod
@@ -36,25 +42,29 @@ class DomUpdaterDANN(BaseUpdater):
         module.grl.set_alpha(alpha)
         module.optimizer.zero_grad()
 
+        images = self.prepare(images)
+
         # Segmentation
-        source_image, source_mask = images[0], masks[0]
-        target_image, _ = images[1], masks[1]
-        source_skips, source_feature = module.encoder(source_image)
-        _, target_feature = module.encoder(target_image)
-
-        source_output = module.decoder((source_skips, source_feature))
-        seg_loss = module.criterion(source_output, source_mask)
-        seg_loss.backward(retain_graph=True)
-
-        # Compute adversarial loss for domain classification
-        source_domain_pred = module.dom_classifier(module.grl.apply(source_feature))
-        target_domain_pred = module.dom_classifier(module.grl.apply(target_feature))
-        source_domain_label = torch.zeros(source_domain_pred.shape, device="cuda")
-        target_domain_label = torch.ones(target_domain_pred.shape, device="cuda")
-
-        adv_loss = module.adv_loss(source_domain_pred, source_domain_label)
-        adv_loss += module.adv_loss(target_domain_pred, target_domain_label)
-        adv_loss.backward()
-
-        module.optimizer.step()
-        return seg_loss.item(), adv_loss.item()
+        with self.autocast():
+            source_image, source_mask = images[0], masks[0]
+            target_image, _ = images[1], masks[1]
+            source_skips, source_feature = module.encoder(source_image)
+            _, target_feature = module.encoder(target_image)
+
+            source_output = module.decoder((source_skips, source_feature))
+            seg_loss = module.criterion(source_output, source_mask)
+
+            # Compute adversarial loss for domain classification
+            source_domain_pred = module.dom_classifier(module.grl.apply(source_feature))
+            target_domain_pred = module.dom_classifier(module.grl.apply(target_feature))
+            source_domain_label = torch.zeros(source_domain_pred.shape, device=source_domain_pred.device)
+            target_domain_label = torch.ones(target_domain_pred.shape, device=target_domain_pred.device)
+
+            adv_loss = module.adv_loss(source_domain_pred, source_domain_label)
+            adv_loss += module.adv_loss(target_domain_pred, target_domain_label)
+
+        # Back-propagate the weighted losses, in a single pass if fused_backward
+        losses = self.backward_losses({"seg_loss": seg_loss, "adv_loss": adv_loss})
+
+        self.step(module.optimizer)
+        return losses["seg_loss"], losses["adv_loss"]
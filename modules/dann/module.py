@@ -5,16 +5,17 @@ from pathlib import Path
 from typing import Literal
 
 import torch
-from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss
 from torch import nn
 from torch.nn import BCEWithLogitsLoss
 from torch.nn.modules.loss import _Loss
 from torch.optim import SGD, Adam, AdamW
 
-from lib.cyclegan.utils import load_cyclegan
+from lib.cyclegan.utils import get_shared_cyclegan
 from lib.loss.target_adaptative_loss import TargetAdaptativeLoss
 from lib.misc import Concat
+from lib.runtime import resolve_device
+from lib.sliding_window import sliding_window_inference
 
 
 # Define a gradient reversal layer for domain adaptation in neural networks
@@ -50,13 +51,13 @@ class DANNModule(nn.Module):
         net: nn.Module,
         dom_classifier: nn.Module,
         roi_size: tuple,
-        sw_batch_size: int,
+        sw_batch_size: int | Literal["auto"],
         ct_criterion: _Loss = DiceCELoss(to_onehot_y=True, softmax=True),
         mr_criterion: _Loss = DiceCELoss(to_onehot_y=True, softmax=True),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
         default_forward_branch: int = 0,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pretrained: Path | None = None,
     ):
         super().__init__()
@@ -64,6 +65,7 @@ class DANNModule(nn.Module):
         self.roi_size = roi_size
         self.sw_batch_size = sw_batch_size
 
+        device = resolve_device(device)
         net = net.to(device)
         self.encoder = net.encoder  # feature extractor
         self.decoder = (
@@ -122,9 +124,16 @@ class DANNModule(nn.Module):
 
     # Save the state of the model components
     def save(self, checkpoint_dir):
-        torch.save(self.encoder.state_dict(), os.path.join(checkpoint_dir, "encoder_state.pth"))
-        torch.save(self.decoder.state_dict(), os.path.join(checkpoint_dir, "decoder_state.pth"))
-        torch.save(self.dom_classifier.state_dict(), os.path.join(checkpoint_dir, "dom_classifier_state.pth"))
+        for filename, state_dict in self.get_state_dicts().items():
+            torch.save(state_dict, os.path.join(checkpoint_dir, filename))
+
+    # Collect the state dicts of the model components, keyed by their file names
+    def get_state_dicts(self):
+        return {
+            "encoder_state.pth": self.encoder.state_dict(),
+            "decoder_state.pth": self.decoder.state_dict(),
+            "dom_classifier_state.pth": self.dom_classifier.state_dict(),
+        }
 
     # Load the state of the model components
     def load(self, checkpoint_dir):
@@ -159,13 +168,13 @@ class CycleGanDANNModule(DANNModule):
             nn.AdaptiveAvgPool2d(output_size=1),
         ),
         roi_size: tuple = (512, 512),
-        sw_batch_size: int = 1,
+        sw_batch_size: int | Literal["auto"] = 1,
         ct_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 1, 2]),
         mr_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 3]),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
         default_forward_branch: int = 0,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pretrained: Path | None = None,
     ):
         super().__init__(
@@ -181,5 +190,5 @@ class CycleGanDANNModule(DANNModule):
             device=device,
             pretrained=pretrained,
         )
-        self.cyclegan = load_cyclegan(cyclegan_checkpoints_dir, which_epoch="latest")
+        self.cyclegan = get_shared_cyclegan(cyclegan_checkpoints_dir, which_epoch="latest")
         self.dice2 = DiceCELoss(softmax=True, to_onehot_y=True)
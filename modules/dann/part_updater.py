@@ -6,8 +6,11 @@ import numpy as np
 import torch
 from torch import ones, zeros
 
-from modules.base.updater import BaseUpdater
+from lib.cyclegan.translation_cache import TranslationCache
+from lib.pseudo_label import PseudoLabelProvider
+from modules.base.updater import BaseUpdater, split_domains
 from modules.dann.module import CycleGanDANNModule, DANNModule
+from networks.dsbn import DomainSpecificBatchNorm, domain_batch
 
 
 class PartUpdaterDANN(BaseUpdater):
@@ -15,11 +18,29 @@ class PartUpdaterDANN(BaseUpdater):
         self,
         sampling_mode: Literal["sequential", "random_swap", "random_choice"] = "sequential",
         pixel_level_adv: bool = False,
+        amp: bool = False,
+        amp_dtype: Literal["float16", "bfloat16"] | None = None,
+        channels_last: bool = False,
+        fused_backward: bool = True,
+        loss_weights: dict[str, float] | None = None,
+        loss_schedules: dict[str, Literal["constant", "linear", "sigmoid"]] | None = None,
+        concat_domains: bool = False,
+        domain_specific_bn: bool = True,
     ):
-        super().__init__()
+        super().__init__(amp, amp_dtype, channels_last, fused_backward, loss_weights, loss_schedules)
         self.sampling_mode = sampling_mode
         self.pixel_level_adv = pixel_level_adv
 
+        # Forward CT and MR images as one batch, where batch normalization layers
+        # are replaced with domain-specific ones to keep the statistics of domains apart
+        self.concat_domains = concat_domains
+        self.domain_specific_bn = domain_specific_bn
+
+    def register_module(self, module):
+        if self.concat_domains and self.domain_specific_bn:
+            DomainSpecificBatchNorm.convert_domain_specific_batchnorm(module)
+        return super().register_module(module)
+
     @staticmethod
     def grl_lambda(step, max_iter):
         p = float(step) / max_iter
@@ -48,54 +69,94 @@ class PartUpdaterDANN(BaseUpdater):
         module.grl.set_alpha(alpha)
         module.optimizer.zero_grad()
 
-        # Extract features and make predictions for CT and MR images
-        ct_image, ct_mask = images[0], masks[0]
-        ct_encoded = module.encoder(ct_image)
-        ct_output = module.decoder(*ct_encoded)
-        ct_feature = ct_encoded[-1] if isinstance(ct_encoded, (list, tuple)) else ct_encoded
-
-        mr_image, mr_mask = images[1], masks[1]
-        mr_encoded = module.encoder(mr_image)
-        mr_output = module.decoder(*mr_encoded)
-        mr_feature = mr_encoded[-1] if isinstance(mr_encoded, (list, tuple)) else mr_encoded
-
-        # Compute segmentation losses for CT and MR images
-        ct_seg_loss = module.ct_criterion(ct_output, ct_mask)
-        mr_seg_loss = module.mr_criterion(mr_output, mr_mask)
-
-        # Total segmentation loss is the sum of individual losses
-        seg_loss = ct_seg_loss + mr_seg_loss
-        seg_loss.backward(retain_graph=True)
-
-        # Compute adversarial loss for domain classification
-        if not self.pixel_level_adv:
-            ct_dom_pred_logits = module.dom_classifier(module.grl.apply(ct_feature))
-            mr_dom_pred_logits = module.dom_classifier(module.grl.apply(mr_feature))
-        else:
-            ct_dom_pred_logits = module.dom_classifier(None, module.grl.apply(ct_feature))
-            mr_dom_pred_logits = module.dom_classifier(None, module.grl.apply(mr_feature))
-
-        # Combine domain predictions and true labels
-        ct_shape, mr_shape = ct_dom_pred_logits.shape, mr_dom_pred_logits.shape
-        dom_pred_logits = torch.cat([ct_dom_pred_logits, mr_dom_pred_logits])
-        dom_true_label = torch.cat((ones(ct_shape, device="cuda"), zeros(mr_shape, device="cuda")))
-
-        # Calculate adversarial loss and perform backward pass
-        adv_loss = module.adv_loss(dom_pred_logits, dom_true_label)
-        adv_loss.backward()
+        images = self.prepare(images)
+        with self.autocast():
+            # Extract features and make predictions for CT and MR images
+            ct_image, ct_mask = images[0], masks[0]
+            mr_image, mr_mask = images[1], masks[1]
+            if self.concat_domains and ct_image.shape[1:] == mr_image.shape[1:]:
+                # Forward both domains as one batch and split the outputs back into domains
+                sizes = [len(ct_image), len(mr_image)]
+                with domain_batch(module, sizes):
+                    encoded = module.encoder(torch.cat([ct_image, mr_image]))
+                    output = module.decoder(*encoded)
+                ct_encoded, mr_encoded = split_domains(encoded, sizes)
+                ct_output, mr_output = output.split(sizes)
+            else:
+                ct_encoded = module.encoder(ct_image)
+                ct_output = module.decoder(*ct_encoded)
+                mr_encoded = module.encoder(mr_image)
+                mr_output = module.decoder(*mr_encoded)
+            ct_feature = ct_encoded[-1] if isinstance(ct_encoded, (list, tuple)) else ct_encoded
+            mr_feature = mr_encoded[-1] if isinstance(mr_encoded, (list, tuple)) else mr_encoded
+
+            # Compute segmentation losses for CT and MR images
+            ct_seg_loss = module.ct_criterion(ct_output, ct_mask)
+            mr_seg_loss = module.mr_criterion(mr_output, mr_mask)
+
+            # Total segmentation loss is the sum of individual losses
+            seg_loss = ct_seg_loss + mr_seg_loss
+
+            # Compute adversarial loss for domain classification
+            if not self.pixel_level_adv:
+                ct_dom_pred_logits = module.dom_classifier(module.grl.apply(ct_feature))
+                mr_dom_pred_logits = module.dom_classifier(module.grl.apply(mr_feature))
+            else:
+                ct_dom_pred_logits = module.dom_classifier(None, module.grl.apply(ct_feature))
+                mr_dom_pred_logits = module.dom_classifier(None, module.grl.apply(mr_feature))
+
+            # Combine domain predictions and true labels
+            ct_shape, mr_shape = ct_dom_pred_logits.shape, mr_dom_pred_logits.shape
+            dom_pred_logits = torch.cat([ct_dom_pred_logits, mr_dom_pred_logits])
+            device = dom_pred_logits.device
+            dom_true_label = torch.cat((ones(ct_shape, device=device), zeros(mr_shape, device=device)))
+
+            # Calculate adversarial loss
+            adv_loss = module.adv_loss(dom_pred_logits, dom_true_label)
+
+        # Back-propagate the weighted losses, in a single pass if fused_backward
+        losses = self.backward_losses({"seg_loss": seg_loss, "adv_loss": adv_loss})
 
         # Update the model parameters
-        module.optimizer.step()
-        return seg_loss.item(), adv_loss.item()
+        self.step(module.optimizer)
+        return losses["seg_loss"], losses["adv_loss"]
 
 
 class PartUpdaterCycleGanDANN(PartUpdaterDANN):
     def __init__(
         self,
         pixel_level_adv: bool = False,
+        amp: bool = False,
+        amp_dtype: Literal["float16", "bfloat16"] | None = None,
+        channels_last: bool = False,
+        fused_backward: bool = True,
+        loss_weights: dict[str, float] | None = None,
+        loss_schedules: dict[str, Literal["constant", "linear", "sigmoid"]] | None = None,
+        translation_cache_size: int = 0,
+        translation_cache_dir: str | None = None,
+        translation_cache_write: bool = False,
+        pseudo_label_ema_decay: float | None = None,
+        pseudo_label_interval: int = 1,
+        pseudo_label_cache_size: int = 4096,
     ):
-        super().__init__()
+        super().__init__(
+            amp=amp,
+            amp_dtype=amp_dtype,
+            channels_last=channels_last,
+            fused_backward=fused_backward,
+            loss_weights=loss_weights,
+            loss_schedules=loss_schedules,
+        )
         self.sampling_mode = "sequential"
+        self.translation_cache_size = translation_cache_size
+        self.translation_cache_dir = translation_cache_dir
+        self.translation_cache_write = translation_cache_write
+
+        # Pseudo labels of the translated images are predicted without gradients,
+        # optionally by an EMA teacher and refreshed every `pseudo_label_interval` steps
+        self.pseudo_label_ema_decay = pseudo_label_ema_decay
+        self.pseudo_label_interval = pseudo_label_interval
+        self.pseudo_label_cache_size = pseudo_label_cache_size
 
         # instead of predicting domain label of the whole image
         # predict the domain label of all pixels
@@ -107,6 +168,26 @@ class PartUpdaterCycleGanDANN(PartUpdaterDANN):
         # grl_lambda = 2.0 / (1.0 + np.exp(-8 * p)) - 1
         return p
 
+    def register_module(self, module):
+        update = super().register_module(module)
+        self.translator = TranslationCache(
+            module.cyclegan,
+            self.translation_cache_size,
+            self.translation_cache_dir,
+            self.translation_cache_write,
+        )
+        self.pseudo_labeler = PseudoLabelProvider(
+            self.pseudo_label_ema_decay, self.pseudo_label_interval, self.pseudo_label_cache_size
+        ).register_module(module)
+        return update
+
+    def state_dict(self) -> dict:
+        return {**super().state_dict(), "pseudo_labeler": self.pseudo_labeler.state_dict()}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        super().load_state_dict(state_dict)
+        self.pseudo_labeler.load_state_dict(state_dict.get("pseudo_labeler", {}))
+
     def check_module(self, module):
         super().check_module(module)
         assert isinstance(module, CycleGanDANNModule), "The specified module should inherit CycleGanDANNModule."
@@ -118,53 +199,56 @@ class PartUpdaterCycleGanDANN(PartUpdaterDANN):
         masks = list(masks)
         module.optimizer.zero_grad()
 
-        ct, mr = "A", "B"
-        fake_mr = module.cyclegan.generate_image(input_image=images[0], from_domain=ct)
-        fake_ct = module.cyclegan.generate_image(input_image=images[1], from_domain=mr)
+        images = self.prepare(images)
+        with self.autocast():
+            ct, mr = "A", "B"
+            fake_mr = self.translator.translate(images[0], from_domain=ct)
+            fake_ct = self.translator.translate(images[1], from_domain=mr)
+
+            for i in (0, 1):
+                m = modalities[i][0]
+
+                if m == "ct":
+                    ct_encoded = module.encoder(images[i])
+                    ct_output = module.decoder(*ct_encoded)
+                    ct_feature = ct_encoded[-1] if isinstance(ct_encoded, (list, tuple)) else ct_encoded
+                    ct_seg_loss = module.ct_criterion(ct_output, masks[i])
+
+                    pseudo_label = self.pseudo_labeler.get_labels(module, fake_mr)
+                    pseudo_label = masks[i] + pseudo_label * (masks[i] == 0)
+                    ct_seg_loss += module.dice2(ct_output, pseudo_label)
+                else:
+                    mr_encoded = module.encoder(images[i])
+                    mr_output = module.decoder(*mr_encoded)
+                    mr_feature = mr_encoded[-1] if isinstance(mr_encoded, (list, tuple)) else mr_encoded
+                    mr_seg_loss = module.mr_criterion(mr_output, masks[i])
+
+                    pseudo_label = self.pseudo_labeler.get_labels(module, fake_ct)
+                    pseudo_label = masks[i] + pseudo_label * (masks[i] == 0)
+                    mr_seg_loss += module.dice2(mr_output, pseudo_label)
+
+            seg_loss = ct_seg_loss + mr_seg_loss
+
+            # Compute adversarial loss for domain classification
+            if not self.pixel_level_adv:
+                ct_dom_pred_logits = module.dom_classifier(module.grl.apply(ct_feature))
+                mr_dom_pred_logits = module.dom_classifier(module.grl.apply(mr_feature))
+            else:
+                ct_dom_pred_logits = module.dom_classifier(None, module.grl.apply(ct_feature))
+                mr_dom_pred_logits = module.dom_classifier(None, module.grl.apply(mr_feature))
 
-        for i in (0, 1):
-            m = modalities[i][0]
+            # Combine domain predictions and true labels
+            ct_shape, mr_shape = ct_dom_pred_logits.shape, mr_dom_pred_logits.shape
+            dom_pred_logits = torch.cat([ct_dom_pred_logits, mr_dom_pred_logits])
+            device = dom_pred_logits.device
+            dom_true_label = torch.cat((torch.ones(ct_shape, device=device), torch.zeros(mr_shape, device=device)))
 
-            if m == "ct":
-                ct_encoded = module.encoder(images[i])
-                ct_output = module.decoder(*ct_encoded)
-                ct_feature = ct_encoded[-1] if isinstance(ct_encoded, (list, tuple)) else ct_encoded
-                ct_seg_loss = module.ct_criterion(ct_output, masks[i])
+            # Calculate adversarial loss
+            adv_loss = module.adv_loss(dom_pred_logits, dom_true_label)
 
-                fake_mr.require_grad = False
-                pseudo_softmax = module.decoder(*module.encoder(fake_mr))
-                pseudo_label = masks[i] + torch.argmax(pseudo_softmax, dim=1, keepdim=True) * (masks[i] == 0)
-                ct_seg_loss += module.dice2(ct_output, pseudo_label)
-            else:
-                mr_encoded = module.encoder(images[i])
-                mr_output = module.decoder(*mr_encoded)
-                mr_feature = mr_encoded[-1] if isinstance(mr_encoded, (list, tuple)) else mr_encoded
-                mr_seg_loss = module.mr_criterion(mr_output, masks[i])
-
-                fake_ct.require_grad = False
-                pseudo_softmax = module.decoder(*module.encoder(fake_ct))
-                pseudo_label = masks[i] + torch.argmax(pseudo_softmax, dim=1, keepdim=True) * (masks[i] == 0)
-                mr_seg_loss += module.dice2(mr_output, pseudo_label)
-
-        seg_loss = ct_seg_loss + mr_seg_loss
-        seg_loss.backward(retain_graph=True)
-
-        # Compute adversarial loss for domain classification
-        if not self.pixel_level_adv:
-            ct_dom_pred_logits = module.dom_classifier(module.grl.apply(ct_feature))
-            mr_dom_pred_logits = module.dom_classifier(module.grl.apply(mr_feature))
-        else:
-            ct_dom_pred_logits = module.dom_classifier(None, module.grl.apply(ct_feature))
-            mr_dom_pred_logits = module.dom_classifier(None, module.grl.apply(mr_feature))
-
-        # Combine domain predictions and true labels
-        ct_shape, mr_shape = ct_dom_pred_logits.shape, mr_dom_pred_logits.shape
-        dom_pred_logits = torch.cat([ct_dom_pred_logits, mr_dom_pred_logits])
-        dom_true_label = torch.cat((torch.ones(ct_shape, device="cuda"), torch.zeros(mr_shape, device="cuda")))
-
-        # Calculate adversarial loss and perform backward pass
-        adv_loss = module.adv_loss(dom_pred_logits, dom_true_label)
-        adv_loss.backward()
-
-        module.optimizer.step()
-        return seg_loss.item(), adv_loss.item()
+        # Back-propagate the weighted losses, in a single pass if fused_backward
+        losses = self.backward_losses({"seg_loss": seg_loss, "adv_loss": adv_loss})
+
+        self.step(module.optimizer)
+        self.pseudo_labeler.step(module)
+        return losses["seg_loss"], losses["adv_loss"]
@@ -5,13 +5,14 @@ from typing import Literal
 
 import torch
 import torch.nn.functional as F
-from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss
 from torch import nn
 from torch.nn.modules.loss import _Loss
 
 from lib.discrepancy.cdd import CDD
 from lib.loss.entropy_loss import EntropyLoss
+from lib.runtime import resolve_device
+from lib.sliding_window import sliding_window_inference
 from modules.base.updater import BaseUpdater
 from modules.mmd.mmd import MMDModule
 
@@ -24,12 +25,12 @@ class CDDModule(MMDModule):
         encoder: nn.Module,
         decoder: nn.Module,
         roi_size: tuple,
-        sw_batch_size: int,
+        sw_batch_size: int | Literal["auto"],
         ct_criterion: _Loss = DiceCELoss(to_onehot_y=True, softmax=True),
         mr_criterion: _Loss = DiceCELoss(to_onehot_y=True, softmax=True),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pretrained: Path | None = None,
     ):
         super().__init__(
@@ -49,7 +50,7 @@ class CDDModule(MMDModule):
         self.ent_loss = EntropyLoss(logits=True)
         if pretrained:
             self.load(pretrained)
-        self.to(device)
+        self.to(resolve_device(device))
 
     # Define the forward pass for the module
     def forward(self, x):
@@ -64,13 +65,28 @@ class CDDModule(MMDModule):
 
 
 class CDDUpdater(BaseUpdater):
+    default_loss_weights = {"discrepancy": 0.1}
+
     def __init__(
         self,
         sampling_mode: Literal["sequential", "random_swap", "random_choice"] = "sequential",
+        amp: bool = False,
+        amp_dtype: Literal["float16", "bfloat16"] | None = None,
+        channels_last: bool = False,
+        fused_backward: bool = True,
+        loss_weights: dict[str, float] | None = None,
+        loss_schedules: dict[str, Literal["constant", "linear", "sigmoid"]] | None = None,
+        class_features: Literal["reencode", "masked", "pooled"] = "masked",
     ):
-        super().__init__()
+        super().__init__(amp, amp_dtype, channels_last, fused_backward, loss_weights, loss_schedules)
         self.sampling_mode = sampling_mode
 
+        # How the class-specific features are extracted:
+        # "reencode": encode the images masked by the pseudo label of each class (one encoder pass for each class)
+        # "masked": mask the features of the images by the pseudo labels at the feature resolution
+        # "pooled": average the features of the images in the pseudo label of each class at the feature resolution
+        self.class_features = class_features
+
     def check_module(self, module):
         assert isinstance(module, torch.nn.Module), "The specified module should inherit torch.nn.Module."
         assert isinstance(module, MMDModule), "The specified module should inherit MMDModule."
@@ -83,27 +99,27 @@ class CDDUpdater(BaseUpdater):
         # Set alpha value for the gradient reversal layer and reset gradients
         module.optimizer.zero_grad()
 
-        # Extract features and make predictions for CT and MR images
-        ct_image, ct_mask = images[0], masks[0]
-        mr_image, mr_mask = images[1], masks[1]
-        _, ct_repr = module.encoder(ct_image)
-        _, mr_repr = module.encoder(mr_image)
-        no_skip_outputs = (None, None, None, None)
+        images = self.prepare(images)
+        with self.autocast():
+            # Extract features and make predictions for CT and MR images
+            ct_image, ct_mask = images[0], masks[0]
+            mr_image, mr_mask = images[1], masks[1]
+            _, ct_repr = module.encoder(ct_image)
+            _, mr_repr = module.encoder(mr_image)
+            no_skip_outputs = (None, None, None, None)
 
-        num_classes = 4 - 1
-        batch_size = ct_image.size(0)
-        feature_dim = ct_repr.size(1) * ct_repr.size(2) * ct_repr.size(3)
-        feat_repr = F.normalize(torch.cat([ct_repr, mr_repr]), dim=(1, 2, 3))
+            num_classes = 4 - 1
+            batch_size = ct_image.size(0)
+            feat_repr = F.normalize(torch.cat([ct_repr, mr_repr]), dim=(1, 2, 3))
 
-        ct_output = module.decoder((no_skip_outputs, feat_repr[:batch_size]))
-        mr_output = module.decoder((no_skip_outputs, feat_repr[batch_size:]))
+            ct_output = module.decoder((no_skip_outputs, feat_repr[:batch_size]))
+            mr_output = module.decoder((no_skip_outputs, feat_repr[batch_size:]))
 
-        # Compute segmentation losses for CT and MR images
-        ct_seg_loss = module.ct_criterion(ct_output, ct_mask)
-        mr_seg_loss = module.mr_criterion(mr_output, mr_mask)
-        # Total segmentation loss is the sum of individual losses
-        seg_loss = ct_seg_loss + mr_seg_loss
-        seg_loss.backward(retain_graph=True)
+            # Compute segmentation losses for CT and MR images
+            ct_seg_loss = module.ct_criterion(ct_output, ct_mask)
+            mr_seg_loss = module.mr_criterion(mr_output, mr_mask)
+            # Total segmentation loss is the sum of individual losses
+            seg_loss = ct_seg_loss + mr_seg_loss
 
         # Compute entropy loss
         # ct_ent_loss = module.ent_loss(ct_output)
@@ -115,24 +131,51 @@ class CDDUpdater(BaseUpdater):
         ct_plabel = ct_mask + torch.argmax(ct_output, dim=1, keepdim=True) * (ct_mask == 0)
         mr_plabel = mr_mask + torch.argmax(mr_output, dim=1, keepdim=True) * (mr_mask == 0)
 
-        # Generate masked images and class-specific features
-        # and then compute Discrepancy
-        ct_class_repr = torch.cat([module.encoder(ct_image * (ct_plabel == c + 1))[1] for c in range(num_classes)])
-        ct_class_repr = ct_class_repr.reshape(batch_size * num_classes, feature_dim)
-
-        mr_class_repr = torch.cat([module.encoder(mr_image * (mr_plabel == c + 1))[1] for c in range(num_classes)])
-        mr_class_repr = mr_class_repr.reshape(batch_size * num_classes, feature_dim)
-
-        class_repr = torch.Tensor(torch.cat([ct_class_repr, mr_class_repr]))
+        # Generate class-specific features and then compute Discrepancy
+        if self.class_features == "reencode":
+            with self.autocast():
+                ct_class_repr = self.encode_class_features(module, ct_image, ct_plabel, num_classes)
+                mr_class_repr = self.encode_class_features(module, mr_image, mr_plabel, num_classes)
+            ct_class_label = torch.arange(num_classes).repeat_interleave(len(ct_image))
+            mr_class_label = torch.arange(num_classes).repeat_interleave(len(mr_image))
+        else:
+            ct_class_repr, ct_class_label = self.pool_class_features(ct_repr, ct_plabel, num_classes)
+            mr_class_repr, mr_class_label = self.pool_class_features(mr_repr, mr_plabel, num_classes)
+
+        class_repr = torch.cat([ct_class_repr, mr_class_repr]).float()
         class_repr = F.normalize(class_repr, dim=1)
-        ct_class_repr = class_repr[0 : batch_size * num_classes]
-        mr_class_repr = class_repr[batch_size * num_classes :]
+        ct_class_repr = class_repr[: len(ct_class_repr)]
+        mr_class_repr = class_repr[len(ct_class_repr) :]
+        discrepancy = module.discrepancy(ct_class_repr, mr_class_repr, ct_class_label, mr_class_label, num_classes)
 
-        class_repr_label = torch.cat([torch.ones(batch_size) * c for c in range(num_classes)]).byte()
-        discrepancy = module.discrepancy(ct_class_repr, mr_class_repr, class_repr_label, class_repr_label, num_classes)
-        w_discrepancy = discrepancy * 0.1
-        w_discrepancy.backward()
+        # Back-propagate the weighted losses, in a single pass if fused_backward
+        losses = self.backward_losses({"seg_loss": seg_loss, "discrepancy": discrepancy})
 
         # Update the model parameters
-        module.optimizer.step()
-        return seg_loss.item(), discrepancy.item()
+        self.step(module.optimizer)
+        return losses["seg_loss"], losses["discrepancy"]
+
+    @staticmethod
+    def encode_class_features(module, image, plabel, num_classes):
+        # Encode the image masked by the pseudo label of each class (foreground classes start from 1)
+        class_repr = torch.cat([module.encoder(image * (plabel == c + 1))[1] for c in range(num_classes)])
+        return class_repr.flatten(1)
+
+    def pool_class_features(self, feature, plabel, num_classes):
+        """
+        The class-specific features of the images from the features of a single encoder pass, ordered by class and
+        then by image, with their class labels. Images without a class are labeled -1, which CDD ignores.
+        """
+        n, c, h, w = feature.shape
+        plabel = F.interpolate(plabel.float(), size=(h, w), mode="nearest").long()
+        masks = F.one_hot(plabel[:, 0], num_classes + 1)[..., 1:].permute(3, 0, 1, 2).to(feature)
+        if self.class_features == "masked":
+            class_repr = (masks[:, :, None] * feature[None]).reshape(num_classes * n, c * h * w)
+        elif self.class_features == "pooled":
+            class_repr = torch.einsum("knhw,nchw->knc", masks, feature) / masks.sum((2, 3))[..., None].clamp(min=1)
+            class_repr = class_repr.reshape(num_classes * n, c)
+        else:
+            raise ValueError(f"Unknown class features {self.class_features}.")
+        class_label = torch.arange(num_classes, device=feature.device).repeat_interleave(n)
+        class_label = torch.where(masks.flatten(2).any(dim=2).flatten(), class_label, -1)
+        return class_repr, class_label
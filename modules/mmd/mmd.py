@@ -1,14 +1,12 @@
 from __future__ import annotations
 
 import os
-import random
 from pathlib import Path
 from typing import Literal
 
 import numpy as np
 import torch
 from monai.data import DataLoader
-from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss
 from monai.metrics import DiceMetric, Metric
 from torch import nn
@@ -17,9 +15,13 @@ from torch.nn.modules.loss import _Loss
 from torch.optim import SGD, Adam, AdamW
 from tqdm import tqdm
 
+from lib.datasets.batch_stream import BatchStream, get_batch
 from lib.discrepancy.mmd import MMD
+from lib.runtime import resolve_device
+from lib.sliding_window import sliding_window_inference
 from modules.base.trainer import BaseTrainer, TrainLogger
-from modules.base.updater import BaseUpdater
+from modules.base.updater import BaseUpdater, split_domains
+from networks.dsbn import DomainSpecificBatchNorm, domain_batch
 
 
 class MMDModule(nn.Module):
@@ -30,13 +32,14 @@ class MMDModule(nn.Module):
         encoder: nn.Module,
         decoder: nn.Module,
         roi_size: tuple,
-        sw_batch_size: int,
+        sw_batch_size: int | Literal["auto"],
         ct_criterion: _Loss = DiceCELoss(to_onehot_y=True, softmax=True),
         mr_criterion: _Loss = DiceCELoss(to_onehot_y=True, softmax=True),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pretrained: Path | None = None,
+        discrepancy: nn.Module = MMD(gamma=None),
     ):
         super().__init__()
         self.roi_size = roi_size
@@ -46,7 +49,7 @@ class MMDModule(nn.Module):
         self.decoder = decoder
         self.ct_criterion = ct_criterion
         self.mr_criterion = mr_criterion
-        self.discrepancy = MMD(gamma=None)
+        self.discrepancy = discrepancy
 
         # Set up the optimizer for training
         self.params = list(self.encoder.parameters()) + list(self.decoder.parameters())
@@ -63,7 +66,7 @@ class MMDModule(nn.Module):
         if pretrained:
             self.load(pretrained)
 
-        self.to(device)
+        self.to(resolve_device(device))
 
     # Define the forward pass for the module
     def forward(self, x):
@@ -78,8 +81,15 @@ class MMDModule(nn.Module):
 
     # Save the state of the model components
     def save(self, checkpoint_dir):
-        torch.save(self.encoder.state_dict(), os.path.join(checkpoint_dir, "encoder_state.pth"))
-        torch.save(self.decoder.state_dict(), os.path.join(checkpoint_dir, "decoder_state.pth"))
+        for filename, state_dict in self.get_state_dicts().items():
+            torch.save(state_dict, os.path.join(checkpoint_dir, filename))
+
+    # Collect the state dicts of the model components, keyed by their file names
+    def get_state_dicts(self):
+        return {
+            "encoder_state.pth": self.encoder.state_dict(),
+            "decoder_state.pth": self.decoder.state_dict(),
+        }
 
     # Load the state of the model components
     def load(self, checkpoint_dir):
@@ -101,10 +111,28 @@ class MMDUpdater(BaseUpdater):
     def __init__(
         self,
         sampling_mode: Literal["sequential", "random_swap", "random_choice"] = "sequential",
+        amp: bool = False,
+        amp_dtype: Literal["float16", "bfloat16"] | None = None,
+        channels_last: bool = False,
+        fused_backward: bool = True,
+        loss_weights: dict[str, float] | None = None,
+        loss_schedules: dict[str, Literal["constant", "linear", "sigmoid"]] | None = None,
+        concat_domains: bool = False,
+        domain_specific_bn: bool = True,
     ):
-        super().__init__()
+        super().__init__(amp, amp_dtype, channels_last, fused_backward, loss_weights, loss_schedules)
         self.sampling_mode = sampling_mode
 
+        # Forward CT and MR images as one batch, where batch normalization layers
+        # are replaced with domain-specific ones to keep the statistics of domains apart
+        self.concat_domains = concat_domains
+        self.domain_specific_bn = domain_specific_bn
+
+    def register_module(self, module):
+        if self.concat_domains and self.domain_specific_bn:
+            DomainSpecificBatchNorm.convert_domain_specific_batchnorm(module)
+        return super().register_module(module)
+
     def check_module(self, module):
         assert isinstance(module, torch.nn.Module), "The specified module should inherit torch.nn.Module."
         assert isinstance(module, MMDModule), "The specified module should inherit MMDModule."
@@ -117,49 +145,45 @@ class MMDUpdater(BaseUpdater):
         # Set alpha value for the gradient reversal layer and reset gradients
         module.optimizer.zero_grad()
 
-        # Extract features and make predictions for CT and MR images
-        ct_image, ct_mask = images[0], masks[0]
-        mr_image, mr_mask = images[1], masks[1]
-        ct_skip_outputs, ct_feature = module.encoder(ct_image)
-        ct_output = module.decoder((ct_skip_outputs, ct_feature))
-        mr_skip_outputs, mr_feature = module.encoder(mr_image)
-        mr_output = module.decoder((mr_skip_outputs, mr_feature))
-
-        # Compute segmentation losses for CT and MR images
-        ct_seg_loss = module.ct_criterion(ct_output, ct_mask)
-        mr_seg_loss = module.mr_criterion(mr_output, mr_mask)
-        # Total segmentation loss is the sum of individual losses
-        seg_loss = ct_seg_loss + mr_seg_loss
-        seg_loss.backward(retain_graph=True)
-
-        # Compute Discrepancy
+        images = self.prepare(images)
+        with self.autocast():
+            # Extract features and make predictions for CT and MR images
+            ct_image, ct_mask = images[0], masks[0]
+            mr_image, mr_mask = images[1], masks[1]
+            if self.concat_domains and ct_image.shape[1:] == mr_image.shape[1:]:
+                # Forward both domains as one batch and split the outputs back into domains
+                sizes = [len(ct_image), len(mr_image)]
+                with domain_batch(module, sizes):
+                    skip_outputs, feature = module.encoder(torch.cat([ct_image, mr_image]))
+                    output = module.decoder((skip_outputs, feature))
+                ct_skip_outputs, mr_skip_outputs = split_domains(skip_outputs, sizes)
+                ct_feature, mr_feature = feature.split(sizes)
+                ct_output, mr_output = output.split(sizes)
+            else:
+                ct_skip_outputs, ct_feature = module.encoder(ct_image)
+                ct_output = module.decoder((ct_skip_outputs, ct_feature))
+                mr_skip_outputs, mr_feature = module.encoder(mr_image)
+                mr_output = module.decoder((mr_skip_outputs, mr_feature))
+
+            # Compute segmentation losses for CT and MR images
+            ct_seg_loss = module.ct_criterion(ct_output, ct_mask)
+            mr_seg_loss = module.mr_criterion(mr_output, mr_mask)
+            # Total segmentation loss is the sum of individual losses
+            seg_loss = ct_seg_loss + mr_seg_loss
+
+        # Compute Discrepancy in full precision
+        ct_feature, mr_feature = ct_feature.float(), mr_feature.float()
         ct_feature = ct_feature.reshape(-1, ct_feature.size(1) * ct_feature.size(2) * ct_feature.size(3))
         ct_feature = F.normalize(ct_feature)
         mr_feature = mr_feature.reshape(-1, mr_feature.size(1) * mr_feature.size(2) * mr_feature.size(3))
         mr_feature = F.normalize(mr_feature)
-        discrepancy = module.discrepancy(torch.Tensor(ct_feature), torch.Tensor(mr_feature))
-        discrepancy.backward()
+        discrepancy = module.discrepancy(ct_feature, mr_feature)
+        # Back-propagate the weighted losses, in a single pass if fused_backward
+        losses = self.backward_losses({"seg_loss": seg_loss, "discrepancy": discrepancy})
 
         # Update the model parameters
-        module.optimizer.step()
-        return seg_loss.item(), discrepancy.item()
-
-
-def get_batch(ct_dataloader, mr_dataloader, mode):
-    if mode == "sequential":
-        batch1 = next(iter(ct_dataloader))
-        batch2 = next(iter(mr_dataloader))
-    elif mode == "random_swap":
-        batch1 = next(iter(ct_dataloader))
-        batch2 = next(iter(mr_dataloader))
-        if random.random() > 0.5:
-            batch1, batch2 = batch2, batch1
-    elif mode == "random_choice":
-        batch1 = next(iter(ct_dataloader)) if np.random.random(1) < 0.5 else next(iter(mr_dataloader))
-        batch2 = next(iter(ct_dataloader)) if np.random.random(1) < 0.5 else next(iter(mr_dataloader))
-    else:
-        raise ValueError("Invalid mode.")
-    return batch1, batch2
+        self.step(module.optimizer)
+        return losses["seg_loss"], losses["discrepancy"]
 
 
 # Trainer class for MMD model
@@ -170,10 +194,25 @@ class MMDTrainer(BaseTrainer):
         eval_step: int = 100,
         metric: Metric = DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
         checkpoint_dir: str = "./checkpoints/",
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         dev: bool = False,
+        async_logging: bool = False,
+        keep_last: int = 0,
+        keep_best: int = 1,
+        async_checkpoint: bool = True,
     ):
-        super().__init__(max_iter, eval_step, metric, checkpoint_dir, device, dev)
+        super().__init__(
+            max_iter,
+            eval_step,
+            metric,
+            checkpoint_dir=checkpoint_dir,
+            device=device,
+            dev=dev,
+            async_logging=async_logging,
+            keep_last=keep_last,
+            keep_best=keep_best,
+            async_checkpoint=async_checkpoint,
+        )
         self.pbar_description = (
             "Training ({step} / {max_iter} Steps) ({modality1},{modality2})"
             "(seg_loss={seg_loss:2.5f}, discrepancy={discrepancy:2.5f})"
@@ -200,29 +239,41 @@ class MMDTrainer(BaseTrainer):
         *,
         ct_dataloader: tuple[DataLoader, DataLoader] | None = None,
         mr_dataloader: tuple[DataLoader, DataLoader] | None = None,
+        resume_from: str | None = None,
     ):
         # Display training information and initialize metrics
         self.show_training_info(module, ct_dataloader=ct_dataloader, mr_dataloader=mr_dataloader)
 
-        # Initalize progress bar and tensorboard writer
-        train_pbar = tqdm(range(self.max_iter), dynamic_ncols=True)
-        logger = TrainLogger(self.checkpoint_dir)
+        # Initalize logger and checkpoint manager
+        logger = TrainLogger(self.checkpoint_dir, asynchronous=self.async_logging)
+        checkpoint = self.get_checkpoint_manager()
 
         # Initial stage. Note: updater(module) checks the module and returns a partial func of updating parameters.
         best_metric = 0
         module_update = updater(module)
 
+        # Keep the iterators of training dataloaders alive across steps
+        ct_stream, mr_stream = BatchStream(ct_dataloader[0]), BatchStream(mr_dataloader[0])
+
+        # Resume from the saved training state if specified
+        start_step = 0
+        if resume_from:
+            start_step, best_metric = self.resume(resume_from, module, updater, streams=(ct_stream, mr_stream))
+            logger.info(f"Training resumed from {resume_from} at step {start_step}")
+        train_pbar = tqdm(range(start_step, self.max_iter), initial=start_step, total=self.max_iter, dynamic_ncols=True)
+
         # Main training loop
         for step in train_pbar:
             module.train()
 
             # Load batches based on sampling mode
-            batch1, batch2 = get_batch(ct_dataloader[0], mr_dataloader[0], mode=updater.sampling_mode)
+            batch1, batch2 = get_batch(ct_stream, mr_stream, mode=updater.sampling_mode)
             images = batch1["image"].to(self.device), batch2["image"].to(self.device)
             masks = batch1["label"].to(self.device), batch2["label"].to(self.device)
             modalities = batch1["modality"], batch2["modality"]
 
-            # Adjust gradient reversal layer lambda based on training progress
+            # Schedule the loss weights based on training progress
+            updater.set_progress(step, self.max_iter)
             seg_loss, discrepancy = module_update(images, masks, modalities)
 
             # Update training progress description
@@ -257,8 +308,8 @@ class MMDTrainer(BaseTrainer):
                     val_metric = val_metrics["mean"]
 
                 # Update best metric
+                checkpoint.save(module, step, val_metric, is_best=val_metric > best_metric)
                 if val_metric > best_metric:
-                    module.save(self.checkpoint_dir)
                     logger.success(
                         f"Model saved! Validation: (New) {val_metric:2.7f} > (Old) {best_metric:2.7f} "
                         f"(CT) {val_metrics['ct']:2.7f} (MR) {val_metrics['mr']:2.7f}"
@@ -269,3 +320,11 @@ class MMDTrainer(BaseTrainer):
                         f"No improvement. Validation: (New) {val_metric:2.7f} <= (Old) {best_metric:2.7f} "
                         f"(CT) {val_metrics['ct']:2.7f} (MR) {val_metrics['mr']:2.7f}"
                     )
+
+                # Save the complete training state to resume from
+                checkpoint.save_state(
+                    self.get_training_state(module, updater, step, best_metric, streams=(ct_stream, mr_stream))
+                )
+
+        checkpoint.wait()
+        logger.close()
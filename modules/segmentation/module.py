@@ -6,15 +6,16 @@ from typing import Literal, Union
 
 import torch
 from monai.data import DataLoader as MonaiDataLoader
-from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss
 from torch import nn
 from torch.nn.modules.loss import _Loss
 from torch.optim import SGD, Adam, AdamW
 from torch.utils.data import DataLoader as PyTorchDataLoader
 
-from lib.cyclegan.utils import load_cyclegan
+from lib.cyclegan.utils import get_shared_cyclegan
 from lib.loss.target_adaptative_loss import TargetAdaptativeLoss
+from lib.runtime import resolve_device
+from lib.sliding_window import sliding_window_inference
 from networks.unet import BasicUNet
 
 DataLoader = Union[MonaiDataLoader, PyTorchDataLoader]
@@ -27,11 +28,11 @@ class SegmentationModule(nn.Module):
         self,
         net: nn.Module,
         roi_size: tuple,
-        sw_batch_size: int,
+        sw_batch_size: int | Literal["auto"],
         criterion: _Loss = DiceCELoss(to_onehot_y=True, softmax=True),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pretrained: Path | None = None,
     ):
         super().__init__()
@@ -40,7 +41,7 @@ class SegmentationModule(nn.Module):
         self.net = net
         self.criterion = criterion
         self.lr = lr
-        self.device = device
+        self.device = resolve_device(device)
 
         params = self.net.parameters()
         differentiable_params = [p for p in params if p.requires_grad]
@@ -55,7 +56,7 @@ class SegmentationModule(nn.Module):
         if pretrained:
             self.load(pretrained)
 
-        self.to(device)
+        self.to(self.device)
 
     def forward(self, x):
         y = self.net(x)
@@ -68,7 +69,11 @@ class SegmentationModule(nn.Module):
 
     def save(self, checkpoint_dir):
         Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
-        torch.save(self.net.state_dict(), os.path.join(checkpoint_dir, "net.pth"))
+        for filename, state_dict in self.get_state_dicts().items():
+            torch.save(state_dict, os.path.join(checkpoint_dir, filename))
+
+    def get_state_dicts(self):
+        return {"net.pth": self.net.state_dict()}
 
     def load(self, checkpoint_dir):
         self.net.load_state_dict(torch.load(os.path.join(checkpoint_dir, "net.pth")))
@@ -87,7 +92,7 @@ class SegmentationEncoderDecoder(nn.Module):
         encoder: nn.Module,
         decoder: nn.Module,
         roi_size: tuple,
-        sw_batch_size: int,
+        sw_batch_size: int | Literal["auto"],
         criterion: _Loss = DiceCELoss(to_onehot_y=True, softmax=True),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
@@ -123,8 +128,14 @@ class SegmentationEncoderDecoder(nn.Module):
 
     def save(self, checkpoint_dir):
         Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
-        torch.save(self.encoder.state_dict(), os.path.join(checkpoint_dir, "encoder_state.pth"))
-        torch.save(self.decoder.state_dict(), os.path.join(checkpoint_dir, "decoder_state.pth"))
+        for filename, state_dict in self.get_state_dicts().items():
+            torch.save(state_dict, os.path.join(checkpoint_dir, filename))
+
+    def get_state_dicts(self):
+        return {
+            "encoder_state.pth": self.encoder.state_dict(),
+            "decoder_state.pth": self.decoder.state_dict(),
+        }
 
     def load(self, checkpoint_dir):
         self.encoder.load_state_dict(torch.load(os.path.join(checkpoint_dir, "encoder_state.pth")))
@@ -143,12 +154,12 @@ class CycleGanSegmentationModule(SegmentationModule):
         cyclegan_checkpoints_dir: str,
         net: nn.Module = BasicUNet(spatial_dims=2, in_channels=1, out_channels=4, features=(32, 32, 64, 128, 256, 32)),
         roi_size: tuple = (512, 512),
-        sw_batch_size: int = 1,
+        sw_batch_size: int | Literal["auto"] = 1,
         ct_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 1, 2]),
         mr_criterion: _Loss = TargetAdaptativeLoss(num_classes=4, background_classes=[0, 3]),
         optimizer: str = "AdamW",
         lr: float = 0.0001,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pretrained: Path | None = None,
     ):
         super().__init__(
@@ -164,7 +175,7 @@ class CycleGanSegmentationModule(SegmentationModule):
         self.ct_criterion = ct_criterion
         self.mr_criterion = mr_criterion
         # self.cycle_gan = CycleGANModel()
-        self.cyclegan = load_cyclegan(cyclegan_checkpoints_dir, which_epoch="latest")
+        self.cyclegan = get_shared_cyclegan(cyclegan_checkpoints_dir, which_epoch="latest")
 
     def print_info(self):
         print("Module:", self.net.__class__.__name__)
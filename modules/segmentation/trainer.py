@@ -21,11 +21,28 @@ class SegmentationTrainer(BaseTrainer):
         eval_step: int = 500,
         metric: Metric = DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
         checkpoint_dir: str = "./checkpoints/",
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         unpack_item: Callable | Literal["monai", "pytorch"] = "monai",
         dev: bool = False,
+        async_logging: bool = False,
+        keep_last: int = 0,
+        keep_best: int = 1,
+        async_checkpoint: bool = True,
     ):
-        super().__init__(max_iter, eval_step, metric, None, checkpoint_dir, device, unpack_item, dev)
+        super().__init__(
+            max_iter,
+            eval_step,
+            metric,
+            None,
+            checkpoint_dir,
+            device,
+            unpack_item,
+            dev,
+            async_logging,
+            keep_last,
+            keep_best,
+            async_checkpoint,
+        )
 
     def train(
         self,
@@ -36,6 +53,7 @@ class SegmentationTrainer(BaseTrainer):
         val_dataloader: DataLoader | None = None,
         ct_dataloader: tuple[DataLoader, DataLoader] | None = None,
         mr_dataloader: tuple[DataLoader, DataLoader] | None = None,
+        resume_from: str | None = None,
     ):
         valid_ct_data = ct_dataloader[0] and ct_dataloader[1]
         valid_mr_data = mr_dataloader[0] and mr_dataloader[1]
@@ -68,6 +86,7 @@ class SegmentationTrainer(BaseTrainer):
             updater,
             train_dataloader=train_dataloader,
             val_dataloader=val_dataloader,
+            resume_from=resume_from,
         )
 
 
@@ -111,10 +130,26 @@ class SmatDatasetSegmentationTrainer(SmatDatasetTrainer):
         eval_step: int = 500,
         metric: Metric = DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
         checkpoint_dir: str = "./checkpoints/",
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         dev: bool = False,
+        async_logging: bool = False,
+        keep_last: int = 0,
+        keep_best: int = 1,
+        async_checkpoint: bool = True,
     ):
-        super().__init__(max_iter, eval_step, metric, None, checkpoint_dir, device, dev)
+        super().__init__(
+            max_iter,
+            eval_step,
+            metric,
+            None,
+            checkpoint_dir,
+            device,
+            dev,
+            async_logging,
+            keep_last,
+            keep_best,
+            async_checkpoint,
+        )
 
     def train(
         self,
@@ -123,6 +158,7 @@ class SmatDatasetSegmentationTrainer(SmatDatasetTrainer):
         *,
         ct_dataloader: tuple[DataLoader, DataLoader] | None = None,
         mr_dataloader: tuple[DataLoader, DataLoader] | None = None,
+        resume_from: str | None = None,
     ):
         valid_ct_data = ct_dataloader[0] and ct_dataloader[1]
         valid_mr_data = mr_dataloader[0] and mr_dataloader[1]
@@ -155,4 +191,5 @@ class SmatDatasetSegmentationTrainer(SmatDatasetTrainer):
             updater,
             train_dataloader=train_dataloader,
             val_dataloader=val_dataloader,
+            resume_from=resume_from,
         )
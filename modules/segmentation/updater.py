@@ -1,12 +1,13 @@
 from __future__ import annotations
 
-from typing import Union
+from typing import Literal, Union
 
 import torch
 from monai.data import DataLoader as MonaiDataLoader
 from torch import nn
 from torch.utils.data import DataLoader as PyTorchDataLoader
 
+from lib.cyclegan.translation_cache import TranslationCache
 from modules.base.updater import BaseUpdater
 from modules.segmentation.module import (
     CycleGanSegmentationModule,
@@ -34,17 +35,42 @@ class SegmentationUpdater(BaseUpdater):
 
     def update(self, module, images, masks, modalities=None):
         module.optimizer.zero_grad()
-        output = module.forward(images)
-        loss = module.criterion(output, masks)
-        loss.backward()
-        module.optimizer.step()
+        with self.autocast():
+            output = module.forward(self.prepare(images))
+            loss = module.criterion(output, masks)
+        self.backward(loss)
+        self.step(module.optimizer)
         return loss.item()
 
 
 class CycleGanSegmentationUpdater(SegmentationUpdater):
-    def __init__(self):
-        super().__init__()
+    def __init__(
+        self,
+        amp: bool = False,
+        amp_dtype: Literal["float16", "bfloat16"] | None = None,
+        channels_last: bool = False,
+        fused_backward: bool = True,
+        loss_weights: dict[str, float] | None = None,
+        loss_schedules: dict[str, Literal["constant", "linear", "sigmoid"]] | None = None,
+        translation_cache_size: int = 0,
+        translation_cache_dir: str | None = None,
+        translation_cache_write: bool = False,
+    ):
+        super().__init__(amp, amp_dtype, channels_last, fused_backward, loss_weights, loss_schedules)
         self.sampling_mode = "sequential"
+        self.translation_cache_size = translation_cache_size
+        self.translation_cache_dir = translation_cache_dir
+        self.translation_cache_write = translation_cache_write
+
+    def register_module(self, module):
+        update = super().register_module(module)
+        self.translator = TranslationCache(
+            module.cyclegan,
+            self.translation_cache_size,
+            self.translation_cache_dir,
+            self.translation_cache_write,
+        )
+        return update
 
     def check_module(self, module):
         assert isinstance(module, nn.Module), "The specified module should inherit torch.nn.Module."
@@ -58,25 +84,27 @@ class CycleGanSegmentationUpdater(SegmentationUpdater):
 
     def update(self, module, images, masks, modalities):
         module.optimizer.zero_grad()
+        images = self.prepare(images)
 
         ct, mr = "A", "B"
 
-        if modalities == 0:
-            # Train network with fake MR scans (generated from CT)
-            fake_mr = module.cyclegan.generate_image(input_image=images, from_domain=ct)
-            ct_images, ct_mask = fake_mr, masks
-            ct_output = module.net(ct_images)
-            seg_loss = module.ct_criterion(ct_output, ct_mask)
-            seg_loss += module.ct_criterion(images, ct_mask)
-        else:
-            # Train network with real MR scans
-            fake_ct = module.cyclegan.generate_image(input_image=images, from_domain=mr)
-            mr_images, mr_mask = fake_ct, masks
-            mr_output = module.net(mr_images)
-            seg_loss = module.mr_criterion(mr_output, mr_mask)
-            seg_loss += module.mr_criterion(images, mr_mask)
+        with self.autocast():
+            if modalities == 0:
+                # Train network with fake MR scans (generated from CT)
+                fake_mr = self.translator.translate(images, from_domain=ct)
+                ct_images, ct_mask = fake_mr, masks
+                ct_output = module.net(ct_images)
+                seg_loss = module.ct_criterion(ct_output, ct_mask)
+                seg_loss += module.ct_criterion(images, ct_mask)
+            else:
+                # Train network with real MR scans
+                fake_ct = self.translator.translate(images, from_domain=mr)
+                mr_images, mr_mask = fake_ct, masks
+                mr_output = module.net(mr_images)
+                seg_loss = module.mr_criterion(mr_output, mr_mask)
+                seg_loss += module.mr_criterion(images, mr_mask)
 
         # Back-prop
-        seg_loss.backward()
-        module.optimizer.step()
+        self.backward(seg_loss)
+        self.step(module.optimizer)
         return seg_loss.item()
@@ -1,2 +1,3 @@
 from .categorical import CategoricalMinValidator, CategoricalValidator
 from .dom_adapt import DomValidator
+from .engine import EvaluationEngine, SummaryAccumulator
@@ -8,17 +8,67 @@ import numpy as np
 import pandas as pd
 import torch
 import tqdm
-from monai.data import DataLoader, decollate_batch
+from monai.data import DataLoader
 from monai.metrics import Metric
+from monai.metrics.utils import do_metric_reduction
+from monai.utils import MetricReduction
 from torch import nn
 from tqdm.auto import tqdm
 
 from lib.datasets.dnb import (
-    discretize_and_backgroundify_masks,
-    discretize_and_backgroundify_preds,
+    discretize_and_backgroundify_batch_masks,
+    discretize_and_backgroundify_batch_preds,
 )
 from lib.tensor_shape import tensor
-from modules.base.validator import BaseValidator
+from modules.base.validator import (
+    BaseValidator,
+    get_metric_buffer,
+    select_samples,
+    split_batch,
+    uses_label_maps,
+)
+
+
+def compute_class_metrics(
+    metric: Metric,
+    preds: list | torch.Tensor,
+    masks: list | torch.Tensor,
+    num_classes: int,
+    modality: str | None = None,
+) -> list[list[float]]:
+    """
+    Compute the metric of every class for each sample with a single multi-channel metric call.
+
+    Since the predictions are one-hot encoded, channel c is the binary prediction of class c.
+    The metric is then computed on all channels at once, and each (sample, class) entry of the buffer is reduced
+    with the reduction of the metric, which equals computing each class of each sample separately.
+
+    Args:
+        metric (monai.Metric): A cumulative metric, e.g. DiceMetric or HausdorffDistanceMetric.
+        preds (list | torch.Tensor): One-hot-encoded predictions of the samples, each of shape (channel, spatial...).
+        masks (list | torch.Tensor): One-hot-encoded ground truths of the samples, each of shape (channel, spatial...).
+        num_classes (int): The number of classes to be evaluated.
+        modality (str | None): The modality of the samples, passed to metrics based on label maps.
+
+    Returns:
+        list[list[float]]: The metric of each class for each sample.
+    """
+    class_preds, class_masks = [p[:num_classes] for p in preds], [m[:num_classes] for m in masks]
+    return reduce_class_metrics(metric, get_metric_buffer(metric, class_preds, class_masks, modality), num_classes)
+
+
+def reduce_class_metrics(metric: Metric, buffer: torch.Tensor, num_classes: int) -> list[list[float]]:
+    """Reduce each (sample, class) entry of the per-sample, per-class values of a metric."""
+    # The first channel is dropped by the metric if include_background is False
+    offset = num_classes - buffer.shape[1]
+    reduction = getattr(metric, "reduction", MetricReduction.MEAN)
+    class_metrics = [
+        [do_metric_reduction(buffer[[i]][:, [c]], reduction)[0].squeeze(0) for c in range(buffer.shape[1])]
+        for i in range(len(buffer))
+    ]
+    # Transfer the values of all samples at once instead of synchronizing the device for each value
+    class_metrics = torch.stack([torch.stack(sample_metrics) for sample_metrics in class_metrics]).tolist()
+    return [[np.nan] * offset + sample_metrics for sample_metrics in class_metrics]
 
 
 class CategoricalValidator(BaseValidator):
@@ -27,7 +77,7 @@ class CategoricalValidator(BaseValidator):
         metric: Metric,
         num_classes: int,
         is_train: bool = False,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
         pred_logits: bool = True,
     ):
         super().__init__(metric, is_train, device, pred_logits)
@@ -57,66 +107,54 @@ class CategoricalValidator(BaseValidator):
             dataloader = [dl for dl in dataloader if dl is not None]
 
         module.eval()
+        one_hot = not uses_label_maps(self.metric)
+        if not one_hot:
+            self.metric.reset_statistics()
+        val_metrics = {c: {"ct": [], "mr": []} for c in range(self.num_classes)}
         metric_means = {c: {"mean": None, "ct": None, "mr": None} for c in range(self.num_classes)}
-        for c in range(self.num_classes):
-            val_metrics = {"ct": [], "mr": []}
-            pbar = tqdm(
-                itertools.chain(*dataloader), total=sum(len(dl) for dl in dataloader), dynamic_ncols=True, disable=True
-            )
-            with torch.no_grad():
-                for batch in pbar:
-                    # Infer, decollate data into list of samples, and postprocess both predictions and labels
-                    images, masks = batch["image"].to(self.device), batch["label"].to(self.device)
-                    modality_label = batch["modality"][0]
-                    num_classes = int(batch["num_classes"])
-                    background_classes = batch["background_classes"].numpy().flatten()
-
+        pbar = tqdm(
+            itertools.chain(*dataloader), total=sum(len(dl) for dl in dataloader), dynamic_ncols=True, disable=True
+        )
+        with torch.no_grad():
+            for batch in pbar:
+                images, masks = batch["image"].to(self.device), batch["label"].to(self.device)
+                for indices, modality_label, num_classes, background_classes in split_batch(batch):
                     assert modality_label in set(["ct", "mr"]), f"Unknown/Invalid modality {modality_label}"
                     assert 0 in background_classes, "0 should be included in background_classes"
 
                     # Get inferred / forwarded results of module
+                    group_images = select_samples(images, indices)
                     if getattr(module, "inference", False):
                         try:
-                            infer_out = module.inference(images, modality=modality_label)
+                            infer_out = module.inference(group_images, modality=modality_label)
                         except TypeError:
-                            infer_out = module.inference(images)
+                            infer_out = module.inference(group_images)
                     else:
-                        infer_out = module.forward(images)
+                        infer_out = module.forward(group_images)
 
                     # Discretize the prediction and masks of ground truths
-                    samples = decollate_batch({"prediction": infer_out, "ground_truth": masks})
-                    preds: list[tensor["c w d"]] = discretize_and_backgroundify_preds(
-                        samples, num_classes, background_classes
+                    group_masks = select_samples(masks, indices)
+                    preds: tensor["b c w d"] = discretize_and_backgroundify_batch_preds(
+                        infer_out, num_classes, background_classes, one_hot
                     )
-                    masks: list[tensor["c w d"]] = discretize_and_backgroundify_masks(
-                        samples, num_classes, background_classes
+                    group_masks: tensor["b c w d"] = discretize_and_backgroundify_batch_masks(
+                        group_masks, num_classes, background_classes, one_hot
                     )
-                    class_binary_preds = [1 * (torch.argmax(p, dim=0) == c)[None, None, :] for p in preds]
-                    class_binary_masks = [m[None, [c], :] for m in masks]
 
                     # Compute validation metrics, omit the calculation of masked catergories during training
-                    if (not self.is_train) or (c not in set(background_classes) - {0}):
-                        self.metric(y_pred=class_binary_preds, y=class_binary_masks)
-                        batch_metric = self.metric.aggregate().item()
-                        val_metrics[modality_label] += [batch_metric]
-                        self.metric.reset()
-                    else:
-                        batch_metric = np.nan
-                        val_metrics[modality_label] += [batch_metric]
-
-                    # Update progressbar
-                    info = {
-                        "val_on_partial": set(background_classes) > set([0]),
-                        "metric_name": self.metric.__class__.__name__,
-                        "batch_metric": batch_metric,
-                        "global_step": global_step,
-                    }
-                    desc = self.pbar_description.format(**info)
-                    pbar.set_description(desc)
-
-            metric_means[c]["mean"] = np.mean(val_metrics["ct"] + val_metrics["mr"])
-            metric_means[c]["ct"] = np.mean(val_metrics["ct"]) if len(val_metrics["ct"]) > 0 else np.nan
-            metric_means[c]["mr"] = np.mean(val_metrics["mr"]) if len(val_metrics["mr"]) > 0 else np.nan
+                    for sample_metrics in compute_class_metrics(
+                        self.metric, preds, group_masks, self.num_classes, modality_label
+                    ):
+                        for c in range(self.num_classes):
+                            if (not self.is_train) or (c not in set(background_classes) - {0}):
+                                val_metrics[c][modality_label] += [sample_metrics[c]]
+                            else:
+                                val_metrics[c][modality_label] += [np.nan]
+
+        for c in range(self.num_classes):
+            metric_means[c]["mean"] = np.mean(val_metrics[c]["ct"] + val_metrics[c]["mr"])
+            metric_means[c]["ct"] = np.mean(val_metrics[c]["ct"]) if len(val_metrics[c]["ct"]) > 0 else np.nan
+            metric_means[c]["mr"] = np.mean(val_metrics[c]["mr"]) if len(val_metrics[c]["mr"]) > 0 else np.nan
 
         return metric_means
 
@@ -127,7 +165,7 @@ class CategoricalMinValidator(CategoricalValidator):
         metric: Metric,
         num_classes: int,
         is_train: bool = False,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
     ):
         super().__init__(metric, num_classes, is_train, device)
 
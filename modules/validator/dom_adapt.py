@@ -6,16 +6,23 @@ from typing import Literal
 import numpy as np
 import torch
 import tqdm
-from monai.data import DataLoader, decollate_batch
+from monai.data import DataLoader
 from monai.metrics import Metric
 from torch import nn
 from tqdm.auto import tqdm
 
 from lib.datasets.dnb import (
-    discretize_and_backgroundify_masks,
-    discretize_and_backgroundify_preds,
+    discretize_and_backgroundify_batch_masks,
+    discretize_and_backgroundify_batch_preds,
+)
+from lib.runtime import resolve_device
+from modules.base.validator import (
+    BaseValidator,
+    compute_sample_metrics,
+    select_samples,
+    split_batch,
+    uses_label_maps,
 )
-from modules.base.validator import BaseValidator
 
 
 class DomValidator(BaseValidator):
@@ -23,11 +30,11 @@ class DomValidator(BaseValidator):
         self,
         metric: Metric,
         is_train: bool = False,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
     ):
         self.metric = metric
         self.is_train = is_train
-        self.device = device
+        self.device = resolve_device(device)
 
         if is_train:
             self.pbar_description = "Validate ({global_step} Steps) ({metric_name}={batch_metric:2.5f})"
@@ -66,35 +73,37 @@ class DomValidator(BaseValidator):
         pbar = tqdm(data_iter, total=n_data, dynamic_ncols=True)
 
         module.eval()
+        one_hot = not uses_label_maps(self.metric)
+        if not one_hot:
+            self.metric.reset_statistics()
         with torch.no_grad():
             for batch in pbar:
-                # Infer, decollate data into list of samples, and postprocess both predictions and labels
                 images, masks = batch["image"].to(self.device), batch["label"].to(self.device)
-                modality_label = batch["modality"][0]
-                num_classes = int(batch["num_classes"])
-                background_classes = batch["background_classes"].numpy().flatten()
-
-                assert modality_label in {"ct", "mr"}, f"Unknown/Invalid modality {modality_label}"
-                assert 0 in background_classes, "0 should be included in background_classes"
-
-                infer_out = module.inference(images)
-                samples = decollate_batch({"prediction": infer_out, "ground_truth": masks})
-                preds: list = discretize_and_backgroundify_preds(samples, num_classes, background_classes)
-                masks: list = discretize_and_backgroundify_masks(samples, num_classes, background_classes)
-
-                # Compute validation metrics
-                self.metric(y_pred=preds, y=masks)
-                batch_metric = self.metric.aggregate().item()
-                val_metrics += [batch_metric]
-                self.metric.reset()
-
-                # Update progress bar
-                info = {
-                    "metric_name": self.metric.__class__.__name__,
-                    "batch_metric": batch_metric,
-                    "global_step": global_step,
-                }
-                desc = self.pbar_description.format(**info)
-                pbar.set_description(desc)
+                for indices, modality_label, num_classes, background_classes in split_batch(batch):
+                    assert modality_label in {"ct", "mr"}, f"Unknown/Invalid modality {modality_label}"
+                    assert 0 in background_classes, "0 should be included in background_classes"
+
+                    infer_out = module.inference(select_samples(images, indices))
+                    group_masks = select_samples(masks, indices)
+                    preds = discretize_and_backgroundify_batch_preds(
+                        infer_out, num_classes, background_classes, one_hot
+                    )
+                    group_masks = discretize_and_backgroundify_batch_masks(
+                        group_masks, num_classes, background_classes, one_hot
+                    )
+
+                    # Compute validation metrics of each sample
+                    sample_metrics = compute_sample_metrics(self.metric, preds, group_masks, modality_label)
+                    val_metrics += sample_metrics
+                    batch_metric = np.mean(sample_metrics)
+
+                    # Update progress bar
+                    info = {
+                        "metric_name": self.metric.__class__.__name__,
+                        "batch_metric": batch_metric,
+                        "global_step": global_step,
+                    }
+                    desc = self.pbar_description.format(**info)
+                    pbar.set_description(desc)
 
         return np.mean(val_metrics)
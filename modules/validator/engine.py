@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import itertools
+from abc import ABC, abstractmethod
+from collections.abc import Sequence
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+import torch
+from monai.data import DataLoader
+from monai.metrics import Metric
+from torch import nn
+from tqdm.auto import tqdm
+
+from lib.datasets.dnb import (
+    discretize_and_backgroundify_batch_masks,
+    discretize_and_backgroundify_batch_preds,
+)
+from modules.base.validator import (
+    BaseValidator,
+    get_metric_buffer,
+    reduce_sample_metrics,
+    select_samples,
+    split_batch,
+)
+from modules.validator.categorical import reduce_class_metrics
+
+
+def get_metric_means(val_metrics: dict) -> dict:
+    """Average the per-batch metric values collected for 'ct' and 'mr' modalities."""
+    return {
+        "mean": np.mean(val_metrics["ct"] + val_metrics["mr"]),
+        "ct": np.mean(val_metrics["ct"]) if len(val_metrics["ct"]) > 0 else np.nan,
+        "mr": np.mean(val_metrics["mr"]) if len(val_metrics["mr"]) > 0 else np.nan,
+    }
+
+
+class Accumulator(ABC):
+    """
+    The base class of metric accumulators and sinks registered to an EvaluationEngine.
+
+    For every batch, the engine calls `update` with a dictionary containing
+        batch: the original batch from the dataloader.
+        indices: the indices of the samples in the batch. Samples are grouped by modality and background classes.
+        image, label: the images and ground truths of the samples moved to the device of the engine.
+        prediction: the inferred logits of the module.
+        preds, masks: batches of discretized (one-hot) and backgroundified predictions and ground truths.
+        modality, num_classes, background_classes, global_step: information of the batch.
+    """
+
+    def reset(self) -> None:
+        pass
+
+    @abstractmethod
+    def update(self, output: dict) -> None:
+        pass
+
+    def compute(self):
+        return None
+
+    def close(self) -> None:
+        """Release the resources held across batches, e.g. process pools, once the validation ends."""
+        pass
+
+
+class SummaryAccumulator(Accumulator):
+    """
+    Accumulate a metric into the summary table produced by SmatSummmaryValidator,
+    i.e. one row for each class and an "all" row, with the columns "mean", "ct" and "mr".
+
+    Args:
+        metric (monai.Metric): The metric to be accumulated.
+        num_classes (int): The number of classes.
+        is_train (bool): If True, the metrics of masked (partially-labelled) classes are omitted.
+        categorical (bool): If False, only the "all" row is computed.
+    """
+
+    def __init__(self, metric: Metric, num_classes: int, is_train: bool = False, categorical: bool = True):
+        self.metric = metric
+        self.num_classes = num_classes
+        self.is_train = is_train
+        self.categorical = categorical
+        self.reset()
+
+    def reset(self):
+        self.class_metrics = {c: {"ct": [], "mr": []} for c in range(self.num_classes)}
+        self.total_metrics = {"ct": [], "mr": []}
+
+    def update(self, output: dict):
+        preds, masks = output["preds"], output["masks"]
+        modality_label, background_classes = output["modality"], output["background_classes"]
+
+        # Compute the metric once for both the per-class metrics and the metric over all classes
+        buffer = get_metric_buffer(self.metric, preds, masks, modality_label)
+
+        # Per-class metrics: omit the calculation of masked catergories during training
+        if self.categorical:
+            for sample_metrics in reduce_class_metrics(self.metric, buffer, self.num_classes):
+                for c in range(self.num_classes):
+                    if (not self.is_train) or (c not in set(background_classes) - {0}):
+                        self.class_metrics[c][modality_label] += [sample_metrics[c]]
+                    else:
+                        self.class_metrics[c][modality_label] += [np.nan]
+
+        # Metric over all classes
+        self.total_metrics[modality_label] += reduce_sample_metrics(self.metric, buffer)
+
+    def close(self):
+        if getattr(self.metric, "close", False):
+            self.metric.close()
+
+    def compute(self) -> pd.DataFrame:
+        total_means = get_metric_means(self.total_metrics)
+        total_table = pd.DataFrame({k: [v] for k, v in total_means.items()}, index=["all"])
+        if not self.categorical:
+            return total_table
+
+        category_means = {c: get_metric_means(val_metrics) for c, val_metrics in self.class_metrics.items()}
+        category_table = pd.DataFrame.from_dict(category_means, orient="index")
+        return pd.concat([category_table, total_table])
+
+
+class EvaluationEngine(BaseValidator):
+    """
+    An evaluator which runs inference only once per batch and sends the discretized predictions
+    to any number of registered accumulators and sinks (e.g. SummaryAccumulator, SegVisualizer).
+
+    Examples:
+        >>> engine = EvaluationEngine(
+        ...     accumulators={
+        ...         "dice": SummaryAccumulator(DiceMetric(), num_classes=4),
+        ...         "hausdorff": SummaryAccumulator(HausdorffDistanceMetric(), num_classes=4),
+        ...         "images": SegVisualizer(num_classes=4, output_dir="./images"),
+        ...     }
+        ... )
+        >>> results = engine.validation(module, dataloader=(ct_test_dataloader, mr_test_dataloader))
+        >>> results["dice"].to_csv("dice.csv")
+    """
+
+    def __init__(
+        self,
+        accumulators: dict[str, Accumulator] | None = None,
+        device: Literal["cuda", "cpu"] | None = None,
+        output_infer: bool = True,
+    ):
+        super().__init__(metric=None, is_train=False, device=device, unpack_item="monai", output_infer=output_infer)
+        self.accumulators = dict(accumulators) if accumulators else {}
+        self.pbar_description = "Evaluate ({num_accumulators} accumulators) ({modality})"
+
+    def register(self, name: str, accumulator: Accumulator) -> EvaluationEngine:
+        self.accumulators[name] = accumulator
+        return self
+
+    def infer(self, module: nn.Module, images: torch.Tensor, modality_label: str) -> torch.Tensor:
+        if getattr(module, "inference", False) and self.output_infer:
+            try:
+                return module.inference(images, modality=modality_label)
+            except TypeError:
+                return module.inference(images)
+        return module.forward(images)
+
+    def validation(
+        self,
+        module: nn.Module,
+        dataloader: DataLoader | Sequence[DataLoader],
+        global_step: int | None = None,
+    ) -> dict:
+        """
+        Perform inference over the dataloader(s) once and accumulate the results.
+
+        Returns:
+            dict: The output of `compute()` of every registered accumulator, keyed by its name.
+        """
+        module.eval()
+        for accumulator in self.accumulators.values():
+            accumulator.reset()
+
+        if not isinstance(dataloader, (list, tuple)):
+            dataloader = [dataloader]
+        else:
+            dataloader = [dl for dl in dataloader if dl is not None]
+        pbar = tqdm(
+            itertools.chain(*dataloader),
+            total=sum(len(dl) for dl in dataloader),
+            dynamic_ncols=True,
+        )
+
+        with torch.no_grad():
+            for batch in pbar:
+                images, masks = self.unpack_item(batch)
+                for indices, modality_label, num_classes, background_classes in split_batch(batch):
+                    assert modality_label in set(["ct", "mr"]), f"Unknown/Invalid modality {modality_label}"
+                    assert 0 in background_classes, "0 should be included in background_classes"
+
+                    # Infer once and share the discretized results with all accumulators
+                    group_images, group_masks = select_samples(images, indices), select_samples(masks, indices)
+                    infer_out = self.infer(module, group_images, modality_label)
+                    output = {
+                        "batch": batch,
+                        "indices": indices,
+                        "image": group_images,
+                        "label": group_masks,
+                        "prediction": infer_out,
+                        "preds": discretize_and_backgroundify_batch_preds(infer_out, num_classes, background_classes),
+                        "masks": discretize_and_backgroundify_batch_masks(group_masks, num_classes, background_classes),
+                        "modality": modality_label,
+                        "num_classes": num_classes,
+                        "background_classes": background_classes,
+                        "global_step": global_step,
+                    }
+                    for accumulator in self.accumulators.values():
+                        accumulator.update(output)
+
+                    info = {"num_accumulators": len(self.accumulators), "modality": modality_label}
+                    pbar.set_description(self.pbar_description.format(**info))
+
+        results = {name: accumulator.compute() for name, accumulator in self.accumulators.items()}
+        for accumulator in self.accumulators.values():
+            if getattr(accumulator, "close", False):
+                accumulator.close()
+        return results
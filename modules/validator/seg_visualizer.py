@@ -10,17 +10,17 @@ import numpy as np
 import torch
 import torchvision.transforms.functional as F
 import tqdm
-from monai.data import DataLoader, decollate_batch
+from monai.data import DataLoader
 from torch import nn
 from torchvision.utils import draw_segmentation_masks
 from tqdm.auto import tqdm
 
 from lib.datasets.dnb import (
-    discretize_and_backgroundify_masks,
-    discretize_and_backgroundify_preds,
+    discretize_and_backgroundify_batch_masks,
+    discretize_and_backgroundify_batch_preds,
 )
 from lib.tensor_shape import tensor
-from modules.base.validator import BaseValidator
+from modules.base.validator import BaseValidator, select_samples, split_batch
 
 DEFAULT_COLORS = [
     "red",
@@ -38,7 +38,11 @@ DEFAULT_COLORS = [
 
 class SegVisualizer(BaseValidator):
     def __init__(
-        self, num_classes: int, device: Literal["cuda", "cpu"] = "cuda", output_dir: str = "./images", ground_truth=True
+        self,
+        num_classes: int,
+        device: Literal["cuda", "cpu"] | None = None,
+        output_dir: str = "./images",
+        ground_truth=True,
     ):
         super().__init__(
             metric=None,
@@ -71,46 +75,65 @@ class SegVisualizer(BaseValidator):
 
         with torch.no_grad():
             for batch in pbar:
-                # Infer, decollate data into list of samples, and postprocess both predictions and labels
-                image: tensor["1 1 h w"] = torch.Tensor(batch["image"]).to(self.device)
-                mask: tensor["1 1 h w"] = torch.Tensor(batch["label"]).to(self.device)
-                modality_label = batch["modality"][0]
-                num_classes = int(batch["num_classes"])
-                background_classes = batch["background_classes"].numpy().flatten()
-
-                assert modality_label in set(["ct", "mr"]), f"Unknown/Invalid modality {modality_label}"
-                assert 0 in background_classes, "0 should be included in background_classes"
-
-                # Get inferred / forwarded results of module
-                if getattr(module, "inference", False):
-                    try:
-                        infer_out = module.inference(image, modality=modality_label)
-                    except TypeError:
-                        infer_out = module.inference(image)
-                else:
-                    infer_out = module.forward(image)
-
-                # Discretize the prediction and mask of ground truths
-                samples = decollate_batch({"prediction": infer_out, "ground_truth": mask})
-                pred: list = discretize_and_backgroundify_preds(samples, num_classes, background=[0])
-                mask: list = discretize_and_backgroundify_masks(samples, num_classes, background=[0])
-                pred, mask = pred[0][1:, :], mask[0][1:, :]  # background is not plotted
-
-                # Transform the single-channel image into a 3-channel (rgb) image
-                image: tensor["1 1 h w"] = (image * 256).to(torch.uint8)
-                image_rgb: tensor["3 h w"] = torch.concat([image, image, image], dim=1).squeeze()
-                mask_overlayed_image = image_rgb
-                if self.ground_truth:
-                    mask_overlayed_image = draw_segmentation_masks(
-                        image_rgb, mask.bool(), alpha=0.3, colors=DEFAULT_COLORS[:num_classes]
-                    )
-                pred_overlayed_image = draw_segmentation_masks(
-                    image_rgb, pred.bool(), alpha=0.3, colors=DEFAULT_COLORS[:num_classes]
-                )
-                save(
-                    imgs=[mask_overlayed_image, pred_overlayed_image],
-                    name=self.output_dir / Path(batch["image"].meta["filename_or_obj"][0]).name,
+                images: tensor["b 1 h w"] = torch.Tensor(batch["image"]).to(self.device)
+                for indices, modality_label, num_classes, background_classes in split_batch(batch):
+                    assert modality_label in set(["ct", "mr"]), f"Unknown/Invalid modality {modality_label}"
+                    assert 0 in background_classes, "0 should be included in background_classes"
+
+                    # Get inferred / forwarded results of module
+                    group_images = select_samples(images, indices)
+                    if getattr(module, "inference", False):
+                        try:
+                            infer_out = module.inference(group_images, modality=modality_label)
+                        except TypeError:
+                            infer_out = module.inference(group_images)
+                    else:
+                        infer_out = module.forward(group_images)
+
+                    output = {
+                        "batch": batch,
+                        "indices": indices,
+                        "image": group_images,
+                        "prediction": infer_out,
+                        "num_classes": num_classes,
+                    }
+                    self.update(output)
+
+    def reset(self):
+        pass
+
+    def update(self, output: dict):
+        """Draw the overlays of a batch. It can be registered to an EvaluationEngine as a sink."""
+        batch, infer_out, num_classes = output["batch"], output["prediction"], output["num_classes"]
+        indices = output.get("indices", list(range(len(infer_out))))
+        images: tensor["b 1 h w"] = torch.Tensor(output["image"]).to(self.device)
+        masks: tensor["b 1 h w"] = select_samples(torch.Tensor(batch["label"]), indices).to(self.device)
+
+        # Discretize the predictions and masks of ground truths
+        preds: tensor["b c h w"] = discretize_and_backgroundify_batch_preds(infer_out, num_classes, background=[0])
+        masks: tensor["b c h w"] = discretize_and_backgroundify_batch_masks(masks, num_classes, background=[0])
+
+        for i, image, pred, mask in zip(indices, images, preds, masks):
+            pred, mask = pred[1:, :], mask[1:, :]  # background is not plotted
+
+            # Transform the single-channel image into a 3-channel (rgb) image
+            image: tensor["1 h w"] = (image * 256).to(torch.uint8)
+            image_rgb: tensor["3 h w"] = torch.concat([image, image, image], dim=0)
+            mask_overlayed_image = image_rgb
+            if self.ground_truth:
+                mask_overlayed_image = draw_segmentation_masks(
+                    image_rgb, mask.bool(), alpha=0.3, colors=DEFAULT_COLORS[:num_classes]
                 )
+            pred_overlayed_image = draw_segmentation_masks(
+                image_rgb, pred.bool(), alpha=0.3, colors=DEFAULT_COLORS[:num_classes]
+            )
+            save(
+                imgs=[mask_overlayed_image, pred_overlayed_image],
+                name=self.output_dir / Path(batch["image"].meta["filename_or_obj"][i]).name,
+            )
+
+    def compute(self):
+        return self.output_dir
 
 
 def save(imgs, name):
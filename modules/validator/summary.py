@@ -10,6 +10,7 @@ from torch import nn
 
 from modules.base.validator import BaseValidator, SmatDatasetValidator
 from modules.validator.categorical import CategoricalValidator
+from modules.validator.engine import EvaluationEngine, SummaryAccumulator
 
 
 class SummmaryValidator(CategoricalValidator, BaseValidator):
@@ -18,7 +19,7 @@ class SummmaryValidator(CategoricalValidator, BaseValidator):
         metric: Metric,
         num_classes: int,
         is_train: bool = False,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
     ):
         super().__init__(metric, num_classes, is_train, device)
 
@@ -44,7 +45,7 @@ class SmatSummmaryValidator(CategoricalValidator, SmatDatasetValidator):
         metric: Metric,
         num_classes: int,
         is_train: bool = False,
-        device: Literal["cuda", "cpu"] = "cuda",
+        device: Literal["cuda", "cpu"] | None = None,
     ):
         super().__init__(metric, num_classes, is_train, device)
 
@@ -54,11 +55,10 @@ class SmatSummmaryValidator(CategoricalValidator, SmatDatasetValidator):
         dataloader: DataLoader | Sequence[DataLoader],
         global_step: int | None = None,
     ) -> dict:
-        category_means = CategoricalValidator.validation(self, module, dataloader, global_step)
-        category_table = pd.DataFrame.from_dict(category_means, orient="index")
-
-        total_means = SmatDatasetValidator.validation(self, module, dataloader, global_step)
-        total_table = pd.DataFrame({k: [v] for k, v in total_means.items()}, index=["all"])
-
-        output = pd.concat([category_table, total_table])
-        return output
+        # Per-class and overall metrics are accumulated in a single inference pass
+        engine = EvaluationEngine(
+            accumulators={"summary": SummaryAccumulator(self.metric, self.num_classes, self.is_train)},
+            device=self.device,
+            output_infer=self.output_infer,
+        )
+        return engine.validation(module, dataloader, global_step)["summary"]
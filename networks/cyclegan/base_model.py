@@ -110,22 +110,35 @@ class BaseModel:
             self.__patch_instance_norm_state_dict(state_dict, getattr(module, key), keys, i + 1)
 
     # load models from the disk
-    def load_networks(self, which_epoch):
+    def load_networks(self, which_epoch, mmap=False):
         for name in self.model_names:
             if isinstance(name, str):
                 load_filename = f"{which_epoch}_net_{name}.pth"
                 load_path = os.path.join(self.save_dir, load_filename)
                 net = getattr(self, "net" + name)
-                # if isinstance(net, torch.nn.DataParallel):
-                # net = net.module
+                if isinstance(net, torch.nn.DataParallel):
+                    net = net.module
                 # print(f"loading the model from {load_path}")
-                # if you are using PyTorch newer than 0.4 (e.g., built from
-                # GitHub source), you can remove str() on self.device
-                state_dict = torch.load(load_path, map_location=str(self.device))
+                # memory-mapped state dicts are loaded lazily on CPU, and moved to the device afterwards
+                map_location = "cpu" if mmap else str(self.device)
+                state_dict = torch.load(load_path, map_location=map_location, mmap=mmap)
+                # checkpoints of DataParallel networks
+                state_dict = {key.removeprefix("module."): value for key, value in state_dict.items()}
                 # patch InstanceNorm checkpoints prior to 0.4
                 for key in list(state_dict.keys()):  # need to copy keys here because we mutate in loop
                     self.__patch_instance_norm_state_dict(state_dict, net, key.split("."))
-                net.load_state_dict(state_dict)
+                # networks built on the meta device take the loaded tensors as their parameters
+                is_meta = any(tensor.is_meta for tensor in [*net.parameters(), *net.buffers()])
+                net.load_state_dict(state_dict, assign=is_meta)
+                net.to(self.device)
+
+    # freeze the networks for inference
+    def freeze(self):
+        for name in self.model_names:
+            if isinstance(name, str):
+                net = getattr(self, "net" + name)
+                net.eval()
+                net.requires_grad_(False)
 
     # print network information
     def print_networks(self, verbose):
@@ -4,8 +4,10 @@
 #
 # and has been partially revised for this research.
 
+from contextlib import nullcontext
 from typing import Literal
 
+import torch
 from torch import nn
 
 from . import networks
@@ -22,30 +24,36 @@ class CycleGANModel(BaseModel):
     def name(self):
         return "CycleGANModel"
 
-    def initialize(self, opt):
+    def initialize(self, opt, meta=False):
         BaseModel.initialize(self, opt)
         opt = self.opt
         self.model_names = ["G_A", "G_B"]
-        self.netG_A = networks.define_G(
-            opt.input_nc,
-            opt.output_nc,
-            opt.ngf,
-            opt.which_model_netG,
-            opt.norm,
-            not opt.no_dropout,
-            opt.init_type,
-            self.gpu_ids,
-        )
-        self.netG_B = networks.define_G(
-            opt.output_nc,
-            opt.input_nc,
-            opt.ngf,
-            opt.which_model_netG,
-            opt.norm,
-            not opt.no_dropout,
-            opt.init_type,
-            self.gpu_ids,
-        )
+
+        # With meta=True, the generators are built on the meta device without initialization and without being
+        # moved to GPUs, and their weights are assigned by load_networks()
+        with torch.device("meta") if meta else nullcontext():
+            self.netG_A = networks.define_G(
+                opt.input_nc,
+                opt.output_nc,
+                opt.ngf,
+                opt.which_model_netG,
+                opt.norm,
+                not opt.no_dropout,
+                opt.init_type,
+                () if meta else self.gpu_ids,
+                initialize=not meta,
+            )
+            self.netG_B = networks.define_G(
+                opt.output_nc,
+                opt.input_nc,
+                opt.ngf,
+                opt.which_model_netG,
+                opt.norm,
+                not opt.no_dropout,
+                opt.init_type,
+                () if meta else self.gpu_ids,
+                initialize=not meta,
+            )
 
     def set_input(self, input_data):
         AtoB = self.opt.which_direction == "AtoB"
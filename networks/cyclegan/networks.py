@@ -56,17 +56,26 @@ def init_weights(net, init_type="normal", gain=0.02):
     net.apply(init_func)
 
 
-def init_net(net, init_type="normal", gpu_ids=()):
+def init_net(net, init_type="normal", gpu_ids=(), initialize=True):
     if len(gpu_ids) > 0:
         assert torch.cuda.is_available()
         net.to(gpu_ids[0])
         net = torch.nn.DataParallel(net, gpu_ids)
-    init_weights(net, init_type)
+    if initialize:
+        init_weights(net, init_type)
     return net
 
 
 def define_G(
-    input_nc, output_nc, ngf, which_model_netG, norm="batch", use_dropout=False, init_type="normal", gpu_ids=()
+    input_nc,
+    output_nc,
+    ngf,
+    which_model_netG,
+    norm="batch",
+    use_dropout=False,
+    init_type="normal",
+    gpu_ids=(),
+    initialize=True,
 ):
     netG = None
     norm_layer = get_norm_layer(norm_type=norm)
@@ -81,7 +90,7 @@ def define_G(
         netG = UnetGenerator(input_nc, output_nc, 8, ngf, norm_layer=norm_layer, use_dropout=use_dropout)
     else:
         raise NotImplementedError(f"Generator model name [{which_model_netG}] is not recognized")
-    return init_net(netG, init_type, gpu_ids)
+    return init_net(netG, init_type, gpu_ids, initialize)
 
 
 ##############################################################################
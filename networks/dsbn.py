@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from contextlib import contextmanager
+
+import torch
+from torch import nn
+from torch.nn.modules.batchnorm import _BatchNorm
+
+
+class DomainSpecificBatchNorm(_BatchNorm):
+    """
+    A batch normalization layer for batches concatenated from several domains.
+
+    In training mode, each domain part of the batch (given by `domain_sizes`) is normalized with its own batch
+    statistics, so that the statistics of domains are not mixed, while the affine parameters and the running
+    statistics are shared. The outputs are thus the same as forwarding the domains one by one. Without
+    `domain_sizes`, or in evaluation mode, it behaves as a plain batch normalization layer.
+    """
+
+    domain_sizes: Sequence[int] | None = None
+
+    def _check_input_dim(self, input):
+        if input.dim() < 2:
+            raise ValueError(f"expected at least 2D input (got {input.dim()}D input)")
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        if self.training and self.domain_sizes is not None and len(self.domain_sizes) > 1:
+            batch_norm = super().forward
+            return torch.cat([batch_norm(part) for part in input.split(list(self.domain_sizes))])
+        return super().forward(input)
+
+    @classmethod
+    def convert_domain_specific_batchnorm(cls, module: nn.Module) -> nn.Module:
+        """
+        Replace the batch normalization layers of the module with DomainSpecificBatchNorm, as
+        `nn.SyncBatchNorm.convert_sync_batchnorm`. The parameters and buffers are shared with the original layers,
+        so that existing optimizers and checkpoints remain valid.
+        """
+        if isinstance(module, _BatchNorm) and not isinstance(module, (cls, nn.SyncBatchNorm)):
+            converted = cls(module.num_features, module.eps, module.momentum, module.affine, module.track_running_stats)
+            for name, parameter in module.named_parameters(recurse=False):
+                setattr(converted, name, parameter)
+            for name, buffer in module.named_buffers(recurse=False):
+                setattr(converted, name, buffer)
+            converted.train(module.training)
+            return converted
+
+        for name, child in module.named_children():
+            module.add_module(name, cls.convert_domain_specific_batchnorm(child))
+        return module
+
+
+@contextmanager
+def domain_batch(module: nn.Module, domain_sizes: Sequence[int]):
+    """Let the DomainSpecificBatchNorm layers of the module split the batches into domains of the given sizes."""
+    layers = [m for m in module.modules() if isinstance(m, DomainSpecificBatchNorm)]
+    for layer in layers:
+        layer.domain_sizes = domain_sizes
+    try:
+        yield module
+    finally:
+        for layer in layers:
+            layer.domain_sizes = None
@@ -0,0 +1,78 @@
+"""
+Benchmark of the training throughput and peak memory of an updater in fp32, AMP and channels-last modes.
+
+Usage:
+    python scripts/benchmark_amp.py --batch_size 8 --size 256 --device cuda
+"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from typing import Literal
+
+import torch
+from jsonargparse import CLI
+from monai.losses import DiceCELoss
+from torch import nn
+from torch.optim import AdamW
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from modules.base.updater import BaseUpdater  # noqa: E402
+from networks.unet import BasicUNet  # noqa: E402
+from scripts.benchmark_utils import time_cuda  # noqa: E402
+
+
+class UNetModule(nn.Module):
+    """A 2D UNet with the components used by `BaseUpdater.update`."""
+
+    def __init__(self, num_classes, lr=0.0001):
+        super().__init__()
+        self.net = BasicUNet(spatial_dims=2, in_channels=1, out_channels=num_classes)
+        self.criterion = DiceCELoss(to_onehot_y=True, softmax=True)
+        self.optimizer = AdamW(self.net.parameters(), lr=lr)
+
+    def forward(self, x):
+        return self.net(x)
+
+
+def benchmark(updater, repeats, batch_size, num_classes, size, device):
+    torch.manual_seed(0)
+    module = UNetModule(num_classes).to(device)
+    module.train()
+    update = updater(module)
+
+    images = torch.randn(batch_size, 1, size, size, device=device)
+    masks = torch.randint(0, num_classes, (batch_size, 1, size, size), device=device).float()
+
+    return time_cuda(lambda: update(images, masks), repeats, device)
+
+
+def main(
+    repeats: int = 10,
+    batch_size: int = 8,
+    num_classes: int = 4,
+    size: int = 256,
+    device: Literal["cuda", "cpu"] = "cuda",
+):
+    modes = {
+        "fp32": BaseUpdater(),
+        "fp32 + channels-last": BaseUpdater(channels_last=True),
+        "amp": BaseUpdater(amp=True),
+        "amp + channels-last": BaseUpdater(amp=True, channels_last=True),
+    }
+
+    print(f"Batch size: {batch_size}, size: {size}x{size}, classes: {num_classes}, device: {device}")
+    baseline = None
+    for name, updater in modes.items():
+        seconds, peak_memory, loss = benchmark(updater, repeats, batch_size, num_classes, size, device)
+        baseline = baseline or seconds
+        print(
+            f"{name:<22} {batch_size / seconds:8.2f} images/s ({baseline / seconds:.2f}x), "
+            f"peak memory: {peak_memory:8.1f} MiB, loss: {loss:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    CLI(main)
@@ -0,0 +1,72 @@
+"""
+Benchmark of drawing training batches with `next(iter(dataloader))` versus a persistent BatchStream.
+
+Usage:
+    python scripts/benchmark_batch_stream.py --num_workers 4 --steps 200
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+from pathlib import Path
+
+import torch
+from jsonargparse import CLI
+from torch.utils.data import DataLoader, Dataset
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.datasets.batch_stream import BatchStream, get_batch  # noqa: E402
+
+
+class SyntheticSliceDataset(Dataset):
+    """Random 2D slices with an artificial decoding delay per item."""
+
+    def __init__(self, length: int = 256, size: int = 512, delay: float = 0.002):
+        self.length = length
+        self.size = size
+        self.delay = delay
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        time.sleep(self.delay)
+        image = torch.rand(1, self.size, self.size)
+        label = torch.randint(0, 4, (1, self.size, self.size))
+        return {"image": image, "label": label}
+
+
+def steps_per_sec(ct_data, mr_data, steps, mode):
+    start = time.perf_counter()
+    for _ in range(steps):
+        get_batch(ct_data, mr_data, mode=mode)
+    return steps / (time.perf_counter() - start)
+
+
+def main(
+    steps: int = 100,
+    batch_size: int = 8,
+    num_workers: int = 4,
+    length: int = 256,
+    size: int = 512,
+    delay: float = 0.002,
+    mode: str = "sequential",
+):
+    def make_dataloader():
+        # Built as in the trainers, without persistent workers, so that next(iter(dataloader)) restarts the workers
+        dataset = SyntheticSliceDataset(length, size, delay)
+        return DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=num_workers)
+
+    ct_dataloader, mr_dataloader = make_dataloader(), make_dataloader()
+    before = steps_per_sec(ct_dataloader, mr_dataloader, steps, mode)
+    after = steps_per_sec(BatchStream(ct_dataloader), BatchStream(mr_dataloader), steps, mode)
+
+    print(f"Sampling mode: {mode}, batch size: {batch_size}, workers: {num_workers}")
+    print(f"next(iter(dataloader)): {before:8.2f} steps/sec")
+    print(f"BatchStream:            {after:8.2f} steps/sec ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    CLI(main)
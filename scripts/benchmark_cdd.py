@@ -0,0 +1,79 @@
+"""
+Benchmark of the class-specific features of `CDDUpdater.update`: re-encoding the images masked by the pseudo label
+of each class ("reencode"), versus masking ("masked") or pooling ("pooled") the features of a single encoder pass,
+by the step time and the peak CUDA memory.
+
+Usage:
+    python scripts/benchmark_cdd.py --batch_size 8 --size 256 --device cuda
+"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from typing import Literal
+
+import torch
+from jsonargparse import CLI
+from monai.losses import DiceCELoss
+from torch import nn
+from torch.nn import functional as F
+from torch.optim import AdamW
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.discrepancy.cdd import CDD  # noqa: E402
+from modules.mmd.cdd import CDDUpdater  # noqa: E402
+from networks.unet.basic_unet import BasicUNetEncoder  # noqa: E402
+from scripts.benchmark_utils import time_cuda  # noqa: E402
+
+
+class BottleneckDecoder(nn.Module):
+    """Predict the logits from the bottleneck feature only, as `CDDUpdater` passes no skip outputs."""
+
+    def __init__(self, in_channels, num_classes, scale_factor=16):
+        super().__init__()
+        self.head = nn.Conv2d(in_channels, num_classes, kernel_size=1)
+        self.scale_factor = scale_factor
+
+    def forward(self, x):
+        _, feature = x
+        return F.interpolate(self.head(feature), scale_factor=self.scale_factor)
+
+
+class ToyCDDModule(nn.Module):
+    def __init__(self, num_classes=4, lr=0.0001):
+        super().__init__()
+        self.encoder = BasicUNetEncoder(spatial_dims=2, in_channels=1)
+        self.decoder = BottleneckDecoder(256, num_classes)
+        self.ct_criterion = DiceCELoss(to_onehot_y=True, softmax=True)
+        self.mr_criterion = DiceCELoss(to_onehot_y=True, softmax=True)
+        self.discrepancy = CDD()
+        self.optimizer = AdamW(self.parameters(), lr=lr)
+
+
+def benchmark(updater, repeats, batch_size, size, device):
+    torch.manual_seed(0)
+    module = ToyCDDModule().to(device)
+    images = tuple(torch.randn(batch_size, 1, size, size, device=device) for _ in range(2))
+    masks = tuple(torch.randint(0, 4, (batch_size, 1, size, size), device=device).float() for _ in range(2))
+
+    # The module check is skipped, since the toy module is not a MMDModule
+    return time_cuda(lambda: updater.update(module, images, masks, None), repeats, device)
+
+
+def main(repeats: int = 10, batch_size: int = 8, size: int = 256, device: Literal["cuda", "cpu"] = "cuda"):
+    print(f"Batch size: {batch_size}, size: {size}x{size}, device: {device}")
+    baseline = None
+    for class_features in ("reencode", "masked", "pooled"):
+        updater = CDDUpdater(class_features=class_features)
+        seconds, peak_memory, (seg_loss, discrepancy) = benchmark(updater, repeats, batch_size, size, device)
+        baseline = baseline or seconds
+        print(
+            f"{class_features:<10} {seconds * 1000:8.1f} ms/step ({baseline / seconds:.2f}x), "
+            f"peak memory: {peak_memory:8.1f} MiB, seg_loss: {seg_loss:.4f}, discrepancy: {discrepancy:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    CLI(main)
@@ -0,0 +1,73 @@
+"""
+Benchmark of the CPU throughput of a segmentation module, for training steps (fp32 and bfloat16 AMP) and
+sliding-window inference (fp32 and bfloat16 autocast), with the CPU profile of different numbers of threads.
+
+Usage:
+    python scripts/benchmark_cpu.py --threads [1,4,8] --batch_size 2 --size 128
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+from pathlib import Path
+
+import torch
+from jsonargparse import CLI
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.runtime import CPUProfile, get_num_cpus  # noqa: E402
+from modules.base.updater import BaseUpdater  # noqa: E402
+from modules.segmentation.module import SegmentationModule  # noqa: E402
+from networks.unet import BasicUNet  # noqa: E402
+
+
+def seconds_per_call(func, repeats, *args):
+    func(*args)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func(*args)
+    return (time.perf_counter() - start) / repeats
+
+
+def main(
+    repeats: int = 3,
+    threads: list[int] | None = None,
+    batch_size: int = 2,
+    num_classes: int = 4,
+    size: int = 128,
+):
+    threads = threads or sorted({1, get_num_cpus()})
+    torch.manual_seed(0)
+    images = torch.randn(batch_size, 1, size, size)
+    masks = torch.randint(0, num_classes, (batch_size, 1, size, size)).float()
+
+    print(f"Batch size: {batch_size}, size: {size}x{size}, classes: {num_classes}, CPUs: {get_num_cpus()}")
+    for num_threads in threads:
+        for bf16 in (False, True):
+            profile = CPUProfile(num_threads=num_threads, bf16=bf16).apply()
+            module = SegmentationModule(
+                net=BasicUNet(spatial_dims=2, in_channels=1, out_channels=num_classes),
+                roi_size=(size, size),
+                sw_batch_size=batch_size,
+                device="cpu",
+            )
+            module.train()
+            update = BaseUpdater(amp=bf16)(module)
+            train_seconds = seconds_per_call(update, repeats, images, masks)
+
+            def infer(x):
+                with torch.no_grad(), profile.autocast():
+                    return module.inference(x, None)
+
+            infer_seconds = seconds_per_call(infer, repeats, images)
+            print(
+                f"{num_threads:3d} threads, {'bf16' if bf16 else 'fp32'}: "
+                f"training {batch_size / train_seconds:8.2f} images/s, "
+                f"inference {batch_size / infer_seconds:8.2f} images/s"
+            )
+
+
+if __name__ == "__main__":
+    CLI(main)
@@ -0,0 +1,77 @@
+"""
+Benchmark of the per-sample `discretize_and_backgroundify_*` post-processing versus the batched one.
+
+Usage:
+    python scripts/benchmark_dnb.py --batch_size 8 --size 512 --device cuda
+"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from typing import Literal
+
+import torch
+from jsonargparse import CLI
+from monai.data import decollate_batch
+from monai.transforms import AsDiscrete, Compose
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.datasets.dnb import (  # noqa: E402
+    discretize_and_backgroundify_batch_masks,
+    discretize_and_backgroundify_batch_preds,
+)
+from medaset.transforms import BackgroundifyClasses  # noqa: E402
+from scripts.benchmark_utils import time_cuda  # noqa: E402
+
+
+def per_sample_postprocess(logits, labels, num_classes, background):
+    """The previous post-processing, which builds the transforms on every call and applies them sample by sample."""
+    samples = decollate_batch({"prediction": logits, "ground_truth": labels})
+    postprocess_pred = Compose(
+        [AsDiscrete(argmax=True, to_onehot=num_classes), BackgroundifyClasses(channel_dim=0, classes=background)]
+    )
+    postprocess_mask = Compose(
+        [AsDiscrete(to_onehot=num_classes), BackgroundifyClasses(channel_dim=0, classes=background)]
+    )
+    preds = [postprocess_pred(sample["prediction"]) for sample in samples]
+    masks = [postprocess_mask(sample["ground_truth"]) for sample in samples]
+    return preds, masks
+
+
+def batched_postprocess(logits, labels, num_classes, background, one_hot=True):
+    preds = discretize_and_backgroundify_batch_preds(logits, num_classes, background, one_hot)
+    masks = discretize_and_backgroundify_batch_masks(labels, num_classes, background, one_hot)
+    return preds, masks
+
+
+def seconds_per_call(func, repeats, device, *args, **kwargs):
+    return time_cuda(lambda: func(*args, **kwargs), repeats, device)[0]
+
+
+def main(
+    repeats: int = 20,
+    batch_size: int = 8,
+    num_classes: int = 4,
+    background: list[int] = [0, 3],
+    size: int = 512,
+    device: Literal["cuda", "cpu"] = "cuda",
+):
+    logits = torch.randn(batch_size, num_classes, size, size, device=device)
+    labels = torch.randint(0, num_classes, (batch_size, 1, size, size), device=device).float()
+
+    before = seconds_per_call(per_sample_postprocess, repeats, device, logits, labels, num_classes, background)
+    after = seconds_per_call(batched_postprocess, repeats, device, logits, labels, num_classes, background)
+    label_maps = seconds_per_call(
+        batched_postprocess, repeats, device, logits, labels, num_classes, background, one_hot=False
+    )
+
+    print(f"Batch size: {batch_size}, size: {size}x{size}, classes: {num_classes}, background: {background}")
+    print(f"Per-sample transforms: {before * 1000:8.2f} ms/batch")
+    print(f"Batched one-hot:       {after * 1000:8.2f} ms/batch ({before / after:.1f}x)")
+    print(f"Batched label maps:    {label_maps * 1000:8.2f} ms/batch ({before / label_maps:.1f}x)")
+
+
+if __name__ == "__main__":
+    CLI(main)
@@ -0,0 +1,86 @@
+"""
+Benchmark of a single fused backward pass of the segmentation + discrepancy losses versus one backward pass
+for each loss (with retain_graph=True), by the time and the peak CUDA memory of `MMDUpdater.update`.
+
+Usage:
+    python scripts/benchmark_fused_backward.py --batch_size 8 --size 256 --device cuda
+"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from typing import Literal
+
+import torch
+from jsonargparse import CLI
+from monai.losses import DiceCELoss
+from torch import nn
+from torch.nn import functional as F
+from torch.optim import AdamW
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.discrepancy.mmd import MMD  # noqa: E402
+from modules.mmd.mmd import MMDUpdater  # noqa: E402
+from networks.unet.basic_unet import BasicUNetEncoder  # noqa: E402
+from scripts.benchmark_utils import time_cuda  # noqa: E402
+
+
+class BottleneckDecoder(nn.Module):
+    """Predict the logits from the bottleneck feature only, as the decoders used with `MMDUpdater`."""
+
+    def __init__(self, in_channels, num_classes, scale_factor=16):
+        super().__init__()
+        self.head = nn.Conv2d(in_channels, num_classes, kernel_size=1)
+        self.scale_factor = scale_factor
+
+    def forward(self, x):
+        _, feature = x
+        return F.interpolate(self.head(feature), scale_factor=self.scale_factor)
+
+
+class ToyMMDModule(nn.Module):
+    def __init__(self, num_classes, lr=0.0001):
+        super().__init__()
+        self.encoder = BasicUNetEncoder(spatial_dims=2, in_channels=1)
+        self.decoder = BottleneckDecoder(256, num_classes)
+        self.ct_criterion = DiceCELoss(to_onehot_y=True, softmax=True)
+        self.mr_criterion = DiceCELoss(to_onehot_y=True, softmax=True)
+        self.discrepancy = MMD(gamma=None)
+        self.optimizer = AdamW(self.parameters(), lr=lr)
+
+
+def benchmark(updater, repeats, batch_size, num_classes, size, device):
+    torch.manual_seed(0)
+    module = ToyMMDModule(num_classes).to(device)
+    images = tuple(torch.randn(batch_size, 1, size, size, device=device) for _ in range(2))
+    masks = tuple(torch.randint(0, num_classes, (batch_size, 1, size, size), device=device).float() for _ in range(2))
+
+    # The module check is skipped, since the toy module is not a MMDModule
+    return time_cuda(lambda: updater.update(module, images, masks, None), repeats, device)
+
+
+def main(
+    repeats: int = 10,
+    batch_size: int = 8,
+    num_classes: int = 4,
+    size: int = 256,
+    device: Literal["cuda", "cpu"] = "cuda",
+):
+    print(f"Batch size: {batch_size}, size: {size}x{size}, classes: {num_classes}, device: {device}")
+    baseline = None
+    for name, fused_backward in (("separate backward", False), ("fused backward", True)):
+        updater = MMDUpdater(fused_backward=fused_backward)
+        seconds, peak_memory, (seg_loss, discrepancy) = benchmark(
+            updater, repeats, batch_size, num_classes, size, device
+        )
+        baseline = baseline or seconds
+        print(
+            f"{name:<18} {seconds * 1000:8.1f} ms/step ({baseline / seconds:.2f}x), "
+            f"peak memory: {peak_memory:8.1f} MiB, seg_loss: {seg_loss:.4f}, discrepancy: {discrepancy:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    CLI(main)
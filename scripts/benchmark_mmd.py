@@ -0,0 +1,60 @@
+"""
+Benchmark of the MMD estimators (forward and backward) by the time and the peak CUDA memory, for feature batches
+of increasing sizes.
+
+Usage:
+    python scripts/benchmark_mmd.py --sizes [256,1024,4096] --dim 256 --device cuda
+"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from typing import Literal
+
+import torch
+from jsonargparse import CLI
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.discrepancy.mmd import MMD  # noqa: E402
+from scripts.benchmark_utils import time_cuda  # noqa: E402
+
+
+def benchmark(discrepancy, repeats, size, dim, device):
+    torch.manual_seed(0)
+    source = torch.randn(size, dim, device=device, requires_grad=True)
+    target = torch.randn(size, dim, device=device) + 0.1
+
+    def step():
+        source.grad = None
+        mmd = discrepancy(source, target)
+        mmd.backward()
+        return mmd
+
+    seconds, peak_memory, mmd = time_cuda(step, repeats, device)
+    return seconds, peak_memory, mmd.item()
+
+
+def main(
+    repeats: int = 5,
+    sizes: list[int] = [256, 1024, 4096],
+    dim: int = 256,
+    block_size: int = 1024,
+    device: Literal["cuda", "cpu"] = "cuda",
+):
+    estimators = {
+        "quadratic": MMD(),
+        "block": MMD(estimator="block", block_size=block_size),
+        "linear": MMD(estimator="linear"),
+        "multi-kernel block": MMD(estimator="block", block_size=block_size, kernel_multipliers=(0.25, 0.5, 1, 2, 4)),
+    }
+    for size in sizes:
+        print(f"Samples: {size} x {dim}, device: {device}")
+        for name, discrepancy in estimators.items():
+            seconds, peak_memory, mmd = benchmark(discrepancy, repeats, size, dim, device)
+            print(f"  {name:<20} {seconds * 1000:9.1f} ms, peak memory: {peak_memory:8.1f} MiB, mmd: {mmd:.5f}")
+
+
+if __name__ == "__main__":
+    CLI(main)
@@ -0,0 +1,123 @@
+"""
+Check that `CachedTransform` returns the same samples as the transform chain it caches, and benchmark the loading
+time per epoch without the cache, in the epoch filling the cache, and in the later epochs (or runs) reading it.
+
+The samples are synthetic 2D slices saved as `.npy` files, preprocessed like the SMAT CT slices (loading,
+intensity scaling, foreground cropping, padding and cropping), optionally followed by random augmentations.
+
+Usage:
+    python scripts/benchmark_slice_cache.py --num_samples 64 --size 512
+"""
+
+from __future__ import annotations
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from jsonargparse import CLI
+from monai.transforms import (
+    Compose,
+    CropForegroundd,
+    EnsureChannelFirstd,
+    LoadImaged,
+    RandFlipd,
+    ScaleIntensityRanged,
+    SpatialCropd,
+    SpatialPadd,
+    ToTensord,
+)
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.datasets.slice_cache import CachedTransform  # noqa: E402
+
+
+def get_transform(size, augment=False):
+    return Compose(
+        [
+            LoadImaged(keys=["image", "label"]),
+            EnsureChannelFirstd(keys=["image", "label"], channel_dim="no_channel"),
+            ScaleIntensityRanged(keys=["image"], a_min=-200, a_max=200, b_min=0, b_max=1, clip=True),
+            CropForegroundd(keys=["image", "label"], source_key="label"),
+            SpatialPadd(keys=["image", "label"], spatial_size=(size, size)),
+            SpatialCropd(keys=["image", "label"], roi_center=(size // 2, size // 2), roi_size=(size, size)),
+            *([RandFlipd(keys=["image", "label"], prob=0.5, spatial_axis=0)] if augment else []),
+            ToTensord(keys=["image", "label"]),
+        ]
+    )
+
+
+def make_samples(data_dir, num_samples, size):
+    rng = np.random.default_rng(0)
+    samples = []
+    for i in range(num_samples):
+        image = rng.normal(0, 300, (size, size)).astype(np.float32)
+        label = np.zeros((size, size), dtype=np.float32)
+        label[size // 4 : 3 * size // 4 - i % 7, size // 3 : 2 * size // 3] = 1 + i % 3
+        np.save(data_dir / f"image_{i}.npy", image)
+        np.save(data_dir / f"label_{i}.npy", label)
+        samples.append({"image": str(data_dir / f"image_{i}.npy"), "label": str(data_dir / f"label_{i}.npy")})
+    return samples
+
+
+def check_equivalence(samples, cache_dir, size):
+    transform = get_transform(size)
+    for cached in (CachedTransform(transform, cache_dir), CachedTransform(transform, cache_dir)):
+        for sample in samples:
+            expected, output = transform(dict(sample)), cached(dict(sample))
+            for key in ("image", "label"):
+                assert torch.equal(torch.as_tensor(expected[key]), torch.as_tensor(output[key]))
+            assert output["image"].meta["filename_or_obj"] == expected["image"].meta["filename_or_obj"]
+    assert cached.hits == len(samples) and cached.misses == 0
+
+    # Sources which are not paths cannot identify a sample, and are rejected instead of sharing an entry
+    try:
+        cached({"image": np.zeros((size, size)), "label": samples[0]["label"]})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("A source which is not a path should be rejected.")
+
+    # The random augmentations run after the cached prefix, with the same random state as without the cache
+    transform = get_transform(size, augment=True)
+    cached = CachedTransform(get_transform(size, augment=True), cache_dir)
+    transform.set_random_state(seed=0)
+    cached.suffix.set_random_state(seed=0)
+    for sample in samples:
+        assert torch.equal(torch.as_tensor(transform(dict(sample))["image"]), cached(dict(sample))["image"])
+
+
+def seconds_per_epoch(transform, samples):
+    start = time.perf_counter()
+    for sample in samples:
+        output = transform(dict(sample))
+        float(output["image"].sum())  # read the pixels of memory-mapped arrays
+    return time.perf_counter() - start
+
+
+def main(num_samples: int = 64, size: int = 512, epochs: int = 3):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = Path(tmp_dir) / "data"
+        data_dir.mkdir()
+        samples = make_samples(data_dir, num_samples, size)
+
+        check_equivalence(samples[:8], Path(tmp_dir) / "check_cache", size)
+        print("CachedTransform returns the same samples as the uncached transform.")
+
+        transform = get_transform(size)
+        print(f"Samples: {num_samples}, size: {size}x{size}")
+        print(f"{'uncached':<24} {seconds_per_epoch(transform, samples):8.3f} s/epoch")
+        cache_dir = Path(tmp_dir) / "cache"
+        print(f"{'cached, first epoch':<24} {seconds_per_epoch(CachedTransform(transform, cache_dir), samples):8.3f} s")
+        for epoch in range(1, epochs):
+            # A new instance, as in a new run or worker process
+            seconds = seconds_per_epoch(CachedTransform(transform, cache_dir), samples)
+            print(f"{f'cached, epoch {epoch + 1}':<24} {seconds:8.3f} s/epoch")
+
+
+if __name__ == "__main__":
+    CLI(main)
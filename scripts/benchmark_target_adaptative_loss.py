@@ -0,0 +1,104 @@
+"""
+Check of the numerical equivalence of `TargetAdaptativeLoss` with the reference implementation by channel-wise
+matrix products, for 2D and 3D logits, and benchmark of their time and peak CUDA memory (forward and backward).
+
+The check always runs on CPU in float64, and can be run alone as the test of the loss with `--check_only true`.
+
+Usage:
+    python scripts/benchmark_target_adaptative_loss.py --check_only true
+    python scripts/benchmark_target_adaptative_loss.py --batch_size 8 --size 512 --device cuda
+"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from typing import Literal
+
+import torch
+import torch.nn.functional as F
+from jsonargparse import CLI
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.loss.target_adaptative_loss import TargetAdaptativeLoss  # noqa: E402
+from lib.runtime import resolve_device  # noqa: E402
+from scripts.benchmark_utils import time_cuda  # noqa: E402
+
+
+def channelwise_matmul(x1, x2):
+    return torch.movedim(torch.movedim(x1, 1, -1) @ x2, -1, 1)
+
+
+def reference_target_adaptative_loss(logits, target, num_classes, background_classes):
+    """The former implementation, merging the background probabilities by matrix products."""
+    foreground = list(set(range(1, num_classes)) - set(background_classes))
+    prob_merge_mat = logits.new_ones((num_classes, 1))
+    prob_merge_mat[foreground, 0] = 0
+    mat_a = torch.eye(num_classes, num_classes).to(logits)
+    mat_a[0, 0] = 0
+    mat_a[background_classes, background_classes] = 0
+    mat_b = logits.new_zeros(1, num_classes)
+    mat_b[0, [0] + list(background_classes)] = 1
+
+    log_prob = F.log_softmax(logits, dim=1)
+    fg_log_prob = channelwise_matmul(log_prob, mat_a).contiguous()
+    bg_log_prob_value = torch.log(channelwise_matmul(torch.exp(log_prob), prob_merge_mat)).contiguous()
+    bg_log_prob = channelwise_matmul(bg_log_prob_value, mat_b).contiguous()
+    return F.nll_loss(fg_log_prob + bg_log_prob, target[:, 0].long())
+
+
+def check_equivalence(num_classes, background_classes, shape, device="cpu"):
+    torch.manual_seed(0)
+    logits = (3 * torch.randn(shape[0], num_classes, *shape[1:], device=device, dtype=torch.float64)).requires_grad_()
+    target = torch.randint(0, num_classes, (shape[0], 1, *shape[1:]), device=device).float()
+    criterion = TargetAdaptativeLoss(num_classes, background_classes).to(device)
+
+    loss = criterion(logits, target)
+    (grad,) = torch.autograd.grad(loss, logits)
+    reference_loss = reference_target_adaptative_loss(logits, target, num_classes, background_classes)
+    (reference_grad,) = torch.autograd.grad(reference_loss, logits)
+    assert torch.allclose(loss, reference_loss), (loss.item(), reference_loss.item())
+    assert torch.allclose(grad, reference_grad)
+
+
+def benchmark(loss_fn, repeats, logits, target, device):
+    def step():
+        logits.grad = None
+        loss_fn(logits, target).backward()
+
+    seconds, peak_memory, _ = time_cuda(step, repeats, device)
+    return seconds, peak_memory
+
+
+def main(
+    repeats: int = 10,
+    batch_size: int = 8,
+    num_classes: int = 4,
+    size: int = 512,
+    device: Literal["cuda", "cpu"] | None = None,
+    check_only: bool = False,
+):
+    for background_classes in ([0, 1, 2], [0, 3]):
+        check_equivalence(num_classes, background_classes, (2, 16, 16))
+        check_equivalence(num_classes, background_classes, (2, 8, 8, 8))
+    print("TargetAdaptativeLoss is equivalent to the reference implementation for 2D and 3D logits.")
+    if check_only:
+        return
+
+    device = resolve_device(device)
+    background_classes = [0, 1, 2]
+    logits = torch.randn(batch_size, num_classes, size, size, device=device, requires_grad=True)
+    target = torch.randint(0, num_classes, (batch_size, 1, size, size), device=device).float()
+    criterion = TargetAdaptativeLoss(num_classes, background_classes).to(device)
+    print(f"Batch size: {batch_size}, size: {size}x{size}, classes: {num_classes}, device: {device}")
+    for name, loss_fn in (
+        ("reference", lambda x, y: reference_target_adaptative_loss(x, y, num_classes, background_classes)),
+        ("gather/logsumexp", criterion),
+    ):
+        seconds, peak_memory = benchmark(loss_fn, repeats, logits, target, device)
+        print(f"{name:<18} {seconds * 1000:8.1f} ms, peak memory: {peak_memory:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    CLI(main)
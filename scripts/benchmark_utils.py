@@ -0,0 +1,32 @@
+"""
+Shared helpers of the benchmark scripts.
+"""
+
+from __future__ import annotations
+
+import time
+from collections.abc import Callable
+
+import torch
+
+
+def time_cuda(fn: Callable, repeats: int, device: str) -> tuple[float, float, object]:
+    """
+    Time a function after a warm-up call, synchronizing CUDA devices before reading the clock.
+
+    Returns:
+        tuple: The seconds per call, the peak CUDA memory in MiB (nan on other devices), and the output of
+            the last call.
+    """
+    fn()  # warm up
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        output = fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    seconds = (time.perf_counter() - start) / repeats
+    peak_memory = torch.cuda.max_memory_allocated() / 2**20 if device == "cuda" else float("nan")
+    return seconds, peak_memory, output
@@ -0,0 +1,124 @@
+"""
+Check that the per-class metrics of `CategoricalValidator` and `SummaryAccumulator`, computed from one metric call
+per batch, equal the metric of each class of each sample computed separately, including the training case where
+the masked classes of partially-labelled samples are omitted.
+
+Usage:
+    python scripts/check_categorical_validator.py --batch_size 2 --size 64
+"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from jsonargparse import CLI
+from monai.metrics import DiceMetric
+from torch import nn
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.datasets.dnb import (  # noqa: E402
+    discretize_and_backgroundify_batch_masks,
+    discretize_and_backgroundify_batch_preds,
+)
+from modules.validator.categorical import CategoricalValidator  # noqa: E402
+from modules.validator.engine import SummaryAccumulator  # noqa: E402
+
+
+class LabelModule(nn.Module):
+    """A module predicting the label map given as its image, as one-hot logits."""
+
+    def __init__(self, num_classes):
+        super().__init__()
+        self.num_classes = num_classes
+
+    def forward(self, x):
+        return F.one_hot(x[:, 0].long(), self.num_classes).movedim(-1, 1).float()
+
+
+def make_batch(modality, background_classes, batch_size, num_classes, size, generator):
+    labels = torch.randint(0, num_classes, (batch_size, 1, size, size), generator=generator).float()
+    # Predict the label with some errors
+    errors = torch.rand(labels.shape, generator=generator) < 0.3
+    preds = torch.where(errors, torch.randint(0, num_classes, labels.shape, generator=generator).float(), labels)
+    return {
+        "image": preds,
+        "label": labels,
+        "modality": [modality] * batch_size,
+        "num_classes": torch.tensor([num_classes] * batch_size),
+        "background_classes": torch.tensor([background_classes] * batch_size),
+    }
+
+
+def get_expected_metrics(batches, num_classes, is_train):
+    # The metric of each class of each sample, computed separately as before the single-call validation
+    metric = DiceMetric()
+    val_metrics = {c: {"ct": [], "mr": []} for c in range(num_classes)}
+    for batch in batches:
+        background_classes = batch["background_classes"][0].tolist()
+        preds = discretize_and_backgroundify_batch_preds(
+            LabelModule(num_classes)(batch["image"]), num_classes, background_classes
+        )
+        masks = discretize_and_backgroundify_batch_masks(batch["label"], num_classes, background_classes)
+        for i in range(len(preds)):
+            for c in range(num_classes):
+                if is_train and c in set(background_classes) - {0}:
+                    value = np.nan
+                else:
+                    metric(y_pred=preds[[i]][:, [c]], y=masks[[i]][:, [c]])
+                    value = metric.aggregate().item()
+                    metric.reset()
+                val_metrics[c][batch["modality"][0]].append(value)
+    return {
+        c: {"mean": np.mean(m["ct"] + m["mr"]), "ct": np.mean(m["ct"]), "mr": np.mean(m["mr"])}
+        for c, m in val_metrics.items()
+    }
+
+
+def assert_metrics_equal(output, expected):
+    for c in expected:
+        for key in ("mean", "ct", "mr"):
+            assert isinstance(output[c][key], float), f"class {c}, {key}: {output[c][key]!r} is not a float"
+            assert np.allclose(output[c][key], expected[c][key], equal_nan=True), (c, key, output[c][key])
+
+
+def main(batch_size: int = 2, num_classes: int = 4, size: int = 64):
+    generator = torch.Generator().manual_seed(0)
+    # Fully-labelled CT samples and MR samples whose class 2 is not labelled
+    batches = [
+        make_batch("ct", [0], batch_size, num_classes, size, generator),
+        make_batch("mr", [0, 2], batch_size, num_classes, size, generator),
+    ]
+
+    for is_train in (False, True):
+        expected = get_expected_metrics(batches, num_classes, is_train)
+
+        validator = CategoricalValidator(DiceMetric(), num_classes, is_train=is_train, device="cpu")
+        assert_metrics_equal(validator.validation(LabelModule(num_classes), [batches]), expected)
+
+        accumulator = SummaryAccumulator(DiceMetric(), num_classes, is_train=is_train)
+        for batch in batches:
+            background_classes = batch["background_classes"][0].tolist()
+            accumulator.update(
+                {
+                    "preds": discretize_and_backgroundify_batch_preds(
+                        LabelModule(num_classes)(batch["image"]), num_classes, background_classes
+                    ),
+                    "masks": discretize_and_backgroundify_batch_masks(batch["label"], num_classes, background_classes),
+                    "modality": batch["modality"][0],
+                    "background_classes": background_classes,
+                }
+            )
+        assert all(isinstance(v, float) for m in accumulator.total_metrics.values() for v in m)
+        table = accumulator.compute()
+        output = {c: {key: float(table.loc[c, key]) for key in ("mean", "ct", "mr")} for c in expected}
+        assert_metrics_equal(output, expected)
+        print(f"is_train={is_train}: the per-class metrics equal the metrics computed separately.")
+
+
+if __name__ == "__main__":
+    CLI(main)
@@ -0,0 +1,59 @@
+"""
+Offline pass translating the training images of a dataset with a CycleGAN, and writing the fake images
+to a translation cache directory next to the dataset, which is read by the CycleGAN updaters via
+`translation_cache_dir`.
+
+Usage:
+    python scripts/pretranslate_cyclegan.py --config pretranslate.yml
+    python scripts/pretranslate_cyclegan.py --dataset.class_path lib.datasets.smat.SmatCtDataset \
+        --dataset.init_args.in_use true --dataset.init_args.root_dir <dir> \
+        --cyclegan_checkpoints_dir <dir> --from_domain A
+"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from typing import Literal
+
+from jsonargparse import CLI
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from lib.cyclegan.translation_cache import TranslationCache  # noqa: E402
+from lib.cyclegan.utils import load_cyclegan  # noqa: E402
+from lib.datasets.dataset_wrapper import Dataset  # noqa: E402
+from lib.runtime import resolve_device  # noqa: E402
+
+
+def main(
+    dataset: Dataset,
+    cyclegan_checkpoints_dir: str,
+    from_domain: Literal["A", "B"],
+    cache_dir: str | None = None,
+    which_epoch: str = "latest",
+    device: Literal["cuda", "cpu"] | None = None,
+):
+    """
+    Args:
+        dataset: The dataset whose training images are translated.
+        cyclegan_checkpoints_dir: The checkpoint directory of the CycleGAN.
+        from_domain: The domain of the dataset images, "A" (CT) or "B" (MR).
+        cache_dir: The translation cache directory. Defaults to `<dataset root_dir>/cyclegan_translations`.
+        which_epoch: The epoch of the CycleGAN checkpoint. Defaults to "latest".
+        device: The device of the images. Defaults to CUDA if available, else CPU.
+    """
+    cache_dir = cache_dir or str(Path(dataset.root_dir) / "cyclegan_translations")
+    translator = TranslationCache(
+        load_cyclegan(cyclegan_checkpoints_dir, which_epoch=which_epoch), 0, cache_dir, write=True
+    )
+
+    train_dataloader, _, _ = dataset.get_data()
+    for batch in tqdm(train_dataloader, dynamic_ncols=True):
+        translator.translate(batch["image"].to(resolve_device(device)), from_domain=from_domain)
+    print(f"{translator.misses} images translated, {translator.hits} found in {cache_dir}.")
+
+
+if __name__ == "__main__":
+    CLI(main)
@@ -1,14 +1,17 @@
 from __future__ import annotations
 
+from contextlib import nullcontext
 from pathlib import Path
 
 import torch
 from jsonargparse import CLI
-from monai.metrics import DiceMetric, HausdorffDistanceMetric
+from monai.metrics import DiceMetric
 from torch import nn
 
 from lib.datasets.dataset_wrapper import Dataset
-from modules.base.validator import SmatDatasetValidator
+from lib.metrics.surface_distance import FastSurfaceDistanceMetric
+from lib.runtime import CPUProfile, resolve_device
+from modules.validator.engine import EvaluationEngine, SummaryAccumulator
 from modules.validator.seg_visualizer import SegVisualizer
 
 
@@ -18,25 +21,33 @@ def setup(
     module: nn.Module,
     pretrained: str | None = None,
     evaluator: str = None,
-    device: str = "cuda",
+    device: str | None = None,
+    cpu_profile: CPUProfile = CPUProfile(),
 ):
+    device = resolve_device(device)
     module = module.to(device)
 
+    # Set up the threads and kernels of CPU-only inference
+    if device == "cpu":
+        cpu_profile.apply().print_info()
+    else:
+        cpu_profile = None
+
     # Load pretrained module / network
     if pretrained is not None:
         if getattr(module, "load", False):
             module.load(pretrained)
         else:
             module = module.to(device)
-            module.load_state_dict(torch.load(pretrained))
+            module.load_state_dict(torch.load(pretrained, map_location=device))
 
     # default evaluator for testing: SummaryValidator with DiceMetric
 
-    return ct_data, mr_data, module, evaluator, pretrained
+    return ct_data, mr_data, module, evaluator, pretrained, cpu_profile
 
 
 def main():
-    ct_data, mr_data, module, evaluator, pretrained = CLI(setup, parser_mode="omegaconf")
+    ct_data, mr_data, module, evaluator, pretrained, cpu_profile = CLI(setup, parser_mode="omegaconf")
     ct_dataloader = ct_data.get_data()
     mr_dataloader = mr_data.get_data()
 
@@ -45,34 +56,46 @@ def main():
     else:
         pretrained = str(Path(pretrained).parents[0])
 
+    # Register the requested metrics and sinks, and infer the testing set only once
+    num_classes = getattr(ct_data, "num_classes", getattr(mr_data, "num_classes", None))
+    engine = EvaluationEngine()
     if evaluator is None or evaluator == "summary" or evaluator == "all":
-        num_classes = getattr(ct_data, "num_classes", getattr(mr_data, "num_classes", None))
-        dice_evaluator = SmatDatasetValidator(
-            metric=DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
-            num_classes=num_classes,
+        engine.register(
+            "dice",
+            SummaryAccumulator(
+                metric=DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
+                num_classes=num_classes,
+                categorical=False,
+            ),
         )
-        dice = dice_evaluator.validation(module, dataloader=(ct_dataloader[2], mr_dataloader[2]))
-        print(dice)
-        dice.to_csv(f"{pretrained}/dice.csv")
-
     if evaluator == "hausdorff" or evaluator == "all":
-        num_classes = getattr(ct_data, "num_classes", getattr(mr_data, "num_classes", None))
-        hausdorff_evaluator = SmatDatasetValidator(
-            metric=HausdorffDistanceMetric(include_background=True, reduction="mean", get_not_nans=False),
-            num_classes=num_classes,
+        engine.register(
+            "hausdorff",
+            SummaryAccumulator(
+                metric=FastSurfaceDistanceMetric(num_classes=num_classes, include_background=True),
+                num_classes=num_classes,
+                categorical=False,
+            ),
         )
-        hausdorff = hausdorff_evaluator.validation(module, dataloader=(ct_dataloader[2], mr_dataloader[2]))
-        print(hausdorff)
-        hausdorff.to_csv(f"{pretrained}/hausdorff.csv")
-
     if evaluator == "draw" or evaluator == "all":
-        num_classes = getattr(ct_data, "num_classes", getattr(mr_data, "num_classes", None))
-        evaluator = SegVisualizer(
-            num_classes=num_classes,
-            output_dir=f"{pretrained}/images/",
-            ground_truth=False,
+        engine.register(
+            "images",
+            SegVisualizer(
+                num_classes=num_classes,
+                output_dir=f"{pretrained}/images/",
+                ground_truth=False,
+            ),
         )
-        performance = evaluator.validation(module, dataloader=(ct_dataloader[2], mr_dataloader[2]))
+    with cpu_profile.autocast() if cpu_profile else nullcontext():
+        results = engine.validation(module, dataloader=(ct_dataloader[2], mr_dataloader[2]))
+
+    for name in ("dice", "hausdorff"):
+        if name in results:
+            print(results[name])
+            results[name].to_csv(f"{pretrained}/{name}.csv")
+    if "hausdorff" in results:
+        timings = engine.accumulators["hausdorff"].metric.summary()
+        print("Hausdorff distance (sec/volume):", timings.groupby("modality")["seconds"].mean().to_dict())
 
 
 if __name__ == "__main__":
@@ -3,20 +3,24 @@ import inspect
 import os
 import shutil
 import warnings
+from contextlib import nullcontext
 from datetime import datetime
 from pathlib import Path
 
 from jsonargparse import CLI, ArgumentParser
 from jsonargparse.typing import Path_fr
-from monai.metrics import DiceMetric, HausdorffDistanceMetric
+from monai.metrics import DiceMetric
 from monai.utils import set_determinism
 from ruamel.yaml import YAML
 from torch import nn
 
 from lib.datasets.dataset_wrapper import Dataset
+from lib.metrics.surface_distance import FastSurfaceDistanceMetric
+from lib.runtime import CPUProfile, resolve_device
 from modules.base.trainer import BaseTrainer
 from modules.base.updater import BaseUpdater
 from modules.base.validator import BaseValidator
+from modules.validator.engine import EvaluationEngine, SummaryAccumulator
 from modules.validator.seg_visualizer import SegVisualizer
 from modules.validator.summary import SmatSummmaryValidator
 
@@ -28,15 +32,23 @@ def setup(
     updater: BaseUpdater,
     trainer: BaseTrainer,
     evaluator: BaseValidator = None,
-    device: str = "cuda",
+    device: str | None = None,
+    cpu_profile: CPUProfile = CPUProfile(),
     dev: bool = False,
     deterministic: bool = False,
+    resume_from: str | None = None,
 ):
     if deterministic:
         set_determinism(seed=0)
     if dev:
         os.environ["MONAI_DEBUG"] = "True"
 
+    # Set up the threads and kernels of CPU-only runs
+    if resolve_device(device) == "cpu":
+        cpu_profile.apply().print_info()
+    else:
+        cpu_profile = None
+
     # checkpoint name
     suffix = "{time}_{module}_{trainer}_{updater}_LR{lr}_{optimizer}_{ct_dataset}_{mr_dataset}_Step{step}"
     info = {
@@ -59,7 +71,7 @@ def setup(
             metric=DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
             num_classes=num_classes,
         )
-    return ct_data, mr_data, module, trainer, updater, evaluator
+    return ct_data, mr_data, module, trainer, updater, evaluator, resume_from, cpu_profile
 
 
 def save_config_to(dir_path):
@@ -88,7 +100,9 @@ def save_source_to(dir_path, objects):
 
 
 def main():
-    ct_data, mr_data, module, trainer, updater, evaluator = CLI(setup, parser_mode="omegaconf")
+    ct_data, mr_data, module, trainer, updater, evaluator, resume_from, cpu_profile = CLI(
+        setup, parser_mode="omegaconf"
+    )
     num_classes = getattr(ct_data, "num_classes", getattr(mr_data, "num_classes", None))
     assert num_classes is not None
 
@@ -106,36 +120,42 @@ def main():
         updater,
         ct_dataloader=ct_dataloader,
         mr_dataloader=mr_dataloader,
+        resume_from=resume_from,
     )
     # performance = evaluator.validation(module, dataloader=(ct_dataloader[2], mr_dataloader[2]))
     # print(performance)
 
-    dice_evaluator = SmatSummmaryValidator(
-        metric=DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
-        num_classes=num_classes,
-    )
-    dice = dice_evaluator.validation(module, dataloader=(ct_dataloader[2], mr_dataloader[2]))
+    # Infer the testing set once and feed all metrics and the visualizer
+    hausdorff_metric = FastSurfaceDistanceMetric(num_classes=num_classes, include_background=True)
+    with warnings.catch_warnings(), cpu_profile.autocast() if cpu_profile else nullcontext():
+        warnings.simplefilter("ignore")
+        engine = EvaluationEngine(
+            accumulators={
+                "dice": SummaryAccumulator(
+                    metric=DiceMetric(include_background=True, reduction="mean", get_not_nans=False),
+                    num_classes=num_classes,
+                ),
+                "hausdorff": SummaryAccumulator(metric=hausdorff_metric, num_classes=num_classes),
+                "images": SegVisualizer(
+                    num_classes=num_classes,
+                    output_dir=f"{trainer.checkpoint_dir}/images",
+                    ground_truth=True,
+                ),
+            }
+        )
+        results = engine.validation(module, dataloader=(ct_dataloader[2], mr_dataloader[2]))
+
+    dice = results["dice"]
     print(dice)
     dice.to_csv(f"{trainer.checkpoint_dir}/dice.csv")
 
     print("---------------------------")
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        hausdorff_evaluator = SmatSummmaryValidator(
-            metric=HausdorffDistanceMetric(include_background=True, reduction="mean", get_not_nans=False),
-            num_classes=num_classes,
-        )
-        hausdorff = hausdorff_evaluator.validation(module, dataloader=(ct_dataloader[2], mr_dataloader[2]))
-        print(hausdorff)
-        hausdorff.to_csv(f"{trainer.checkpoint_dir}/hausdorff.csv")
-
-    visualizer = SegVisualizer(
-        num_classes=num_classes,
-        output_dir=f"{trainer.checkpoint_dir}/images",
-        ground_truth=True,
-    )
-    visualizer.validation(module, dataloader=(ct_dataloader[2], mr_dataloader[2]))
+    hausdorff = results["hausdorff"]
+    print(hausdorff)
+    hausdorff.to_csv(f"{trainer.checkpoint_dir}/hausdorff.csv")
+    timings = hausdorff_metric.summary().groupby("modality")["seconds"].mean()
+    print("Hausdorff distance (sec/volume):", timings.to_dict())
 
 
 if __name__ == "__main__":